@@ -0,0 +1,231 @@
+"""Service request SLA rollups.
+
+Each document in request_rollups counts what happened to one society's
+requests of one category and priority on one day:
+    {'_id': 'default|2026-10-19|plumbing|urgent', 'society_id', 'day': datetime, 'category',
+     'priority', 'created', 'resolved', 'cancelled', 'reopened',
+     'resolve_seconds', 'resolve_samples'}
+They are updated with $inc as requests are created and change status, so
+reports read rollups instead of scanning service_requests.
+
+Rebuild from history with: python analytics.py backfill
+"""
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from config import CATEGORIES, PRIORITY_LEVELS
+from tenancy import DEFAULT_SOCIETY_ID
+
+CLOSED_STATUSES = ('resolved', 'cancelled')
+COUNTER_FIELDS = ('created', 'resolved', 'cancelled', 'reopened',
+                  'resolve_seconds', 'resolve_samples')
+REBUILD_COLLECTION = 'request_rollups_rebuild'
+
+
+def _day(dt):
+    return datetime(dt.year, dt.month, dt.day)
+
+
+def _stored_now():
+    """utcnow() truncated to milliseconds, the precision MongoDB stores"""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _dimensions(request_doc):
+    category = request_doc.get('category')
+    priority = request_doc.get('priority')
+    return (request_doc.get('society_id') or DEFAULT_SOCIETY_ID,
+            category if category in CATEGORIES else 'other',
+            priority if priority in PRIORITY_LEVELS else 'medium')
+
+
+def _rollup_update(society_id, day, category, priority, increments):
+    """Filter and $inc update for one rollup document"""
+    return (
+        {'_id': '%s|%s|%s|%s' % (society_id, day.strftime('%Y-%m-%d'),
+                                 category, priority)},
+        {'$inc': increments,
+         '$setOnInsert': {'society_id': society_id, 'day': day,
+                          'category': category, 'priority': priority}})
+
+
+def transition_increments(request_doc, old_status, new_status, at):
+    """Rollup counters affected by one status change"""
+    increments = {}
+    if new_status in CLOSED_STATUSES and old_status not in CLOSED_STATUSES:
+        increments[new_status] = 1
+        if new_status == 'resolved' and request_doc.get('created_at'):
+            increments['resolve_seconds'] = int(
+                (at - request_doc['created_at']).total_seconds())
+            increments['resolve_samples'] = 1
+    elif old_status in CLOSED_STATUSES and new_status not in CLOSED_STATUSES:
+        increments['reopened'] = 1
+    return increments
+
+
+def record_created(db, request_doc):
+    """Count a new request in its creation day's rollup"""
+    society_id, category, priority = _dimensions(request_doc)
+    db.request_rollups.update_one(*_rollup_update(
+        society_id, _day(request_doc['created_at']), category, priority,
+        {'created': 1}), upsert=True)
+
+
+def record_transition(db, request_doc, old_status, new_status, at):
+    """Add one status change to the day's rollup"""
+    increments = transition_increments(request_doc, old_status, new_status, at)
+    if not increments:
+        return
+    society_id, category, priority = _dimensions(request_doc)
+    db.request_rollups.update_one(
+        *_rollup_update(society_id, _day(at), category, priority, increments),
+        upsert=True)
+
+
+def create_rollup_indexes(collection):
+    # Reports read rollups by society and day range
+    collection.create_index([('society_id', 1), ('day', 1)])
+
+
+def _add_events(totals, request_doc, start=None, end=None):
+    """Add the creation and status changes of a request that happened in
+    [start, end) to totals"""
+    def within(at):
+        return (start is None or at >= start) and (end is None or at < end)
+
+    society_id, category, priority = _dimensions(request_doc)
+    created_at = request_doc['created_at']
+    if within(created_at):
+        totals[(society_id, _day(created_at), category, priority)]['created'] += 1
+
+    history = request_doc.get('status_history')
+    if history:
+        old_status = 'pending'
+        for change in history:
+            if within(change['at']):
+                increments = transition_increments(
+                    request_doc, old_status, change['status'], change['at'])
+                key = (society_id, _day(change['at']), category, priority)
+                for field, value in increments.items():
+                    totals[key][field] += value
+            old_status = change['status']
+    elif request_doc.get('status') in CLOSED_STATUSES and within(created_at):
+        key = (society_id, _day(created_at), category, priority)
+        totals[key][request_doc['status']] += 1
+
+
+def _tally(db, query, start=None, end=None, batch_size=1000):
+    totals = defaultdict(lambda: defaultdict(int))
+    cursor = db.service_requests.find(
+        query, {'society_id': 1, 'category': 1, 'priority': 1, 'status': 1,
+                'created_at': 1, 'status_history': 1}).batch_size(batch_size)
+    for request_doc in cursor:
+        if request_doc.get('created_at'):
+            _add_events(totals, request_doc, start, end)
+    return totals
+
+
+def _write(collection, totals, batch_size=1000):
+    operations = [UpdateOne(*_rollup_update(*key, dict(counts)), upsert=True)
+                  for key, counts in totals.items()]
+    for start in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[start:start + batch_size], ordered=False)
+    return len(operations)
+
+
+def backfill_rollups(db, batch_size=1000):
+    """Rebuild request_rollups from service_requests and their status history.
+
+    The rollups are built in a scratch collection and swapped in with
+    renameCollection, so reports never see missing or partial counts.
+    The scan counts events before the rebuild started. Events during the
+    rebuild were $inc'ed into the collection being replaced, so they are
+    counted again from service_requests after the swap. Events within a few
+    milliseconds of the swap itself can still be miscounted.
+
+    Requests created before transitions were recorded only contribute
+    their creation and, if closed, a closing event without a duration.
+    """
+    as_of = _stored_now()
+    totals = _tally(db, {}, end=as_of, batch_size=batch_size)
+
+    scratch = db[REBUILD_COLLECTION]
+    scratch.drop()
+    create_rollup_indexes(scratch)
+    _write(scratch, totals, batch_size)
+    scratch.rename('request_rollups', dropTarget=True)
+    swapped_at = _stored_now()
+
+    missed = _tally(db, {'$or': [{'created_at': {'$gte': as_of}},
+                                 {'status_history.at': {'$gte': as_of}}]},
+                    start=as_of, end=swapped_at, batch_size=batch_size)
+    _write(db.request_rollups, missed, batch_size)
+    return len(totals)
+
+
+def sla_report(db, society_id, weeks=12, now=None):
+    """Average resolution time per category x priority and weekly backlog
+    for one society"""
+    now = now or datetime.utcnow()
+    today = _day(now)
+    start = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+
+    # Backlog carried into the window, summed server-side
+    opening = list(db.request_rollups.aggregate([
+        {'$match': {'society_id': society_id, 'day': {'$lt': start}}},
+        {'$group': {'_id': None,
+                    'created': {'$sum': '$created'},
+                    'resolved': {'$sum': '$resolved'},
+                    'cancelled': {'$sum': '$cancelled'},
+                    'reopened': {'$sum': '$reopened'}}}
+    ]))
+    backlog = 0
+    if opening:
+        o = opening[0]
+        backlog = o['created'] - o['resolved'] - o['cancelled'] + o['reopened']
+
+    resolution = defaultdict(lambda: {'resolve_samples': 0, 'resolve_seconds': 0})
+    week_totals = defaultdict(lambda: defaultdict(int))
+    for doc in db.request_rollups.find(
+            {'society_id': society_id, 'day': {'$gte': start}}).sort('day', 1):
+        cell = resolution[(doc['category'], doc['priority'])]
+        cell['resolve_samples'] += doc.get('resolve_samples', 0)
+        cell['resolve_seconds'] += doc.get('resolve_seconds', 0)
+
+        week = doc['day'] - timedelta(days=doc['day'].weekday())
+        for field in COUNTER_FIELDS:
+            week_totals[week][field] += doc.get(field, 0)
+
+    weekly = []
+    for i in range(weeks):
+        week = start + timedelta(weeks=i)
+        counts = week_totals.get(week, {})
+        backlog += (counts.get('created', 0) - counts.get('resolved', 0) -
+                    counts.get('cancelled', 0) + counts.get('reopened', 0))
+        weekly.append({
+            'week': week,
+            'created': counts.get('created', 0),
+            'closed': counts.get('resolved', 0) + counts.get('cancelled', 0),
+            'backlog': backlog
+        })
+
+    averages = {}
+    for key, cell in resolution.items():
+        if cell['resolve_samples']:
+            averages[key] = {
+                'resolved': cell['resolve_samples'],
+                'avg_hours': cell['resolve_seconds'] / cell['resolve_samples'] / 3600
+            }
+
+    return {'start': start, 'weekly': weekly, 'averages': averages}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        sys.exit('usage: python analytics.py backfill')
+    from worker import get_database
+    print('Wrote %d rollup documents' % backfill_rollups(get_database()))
@@ -0,0 +1,311 @@
+"""JSON API for the mobile app, mounted at /api/v1.
+
+Authentication: POST /api/v1/auth/token with email and password returns a
+signed token carrying the user's id, society, role and name. Later calls
+send it as "Authorization: Bearer <token>" and are checked by signature
+alone, without reading the users collection. Tokens expire after
+API_SETTINGS['token_max_age_seconds'].
+
+Every GET sends an ETag derived from the society's change versions (see
+changes.py), so an unchanged poll with If-None-Match costs one indexed
+lookup and a 304. `since=` (ISO 8601, UTC) returns only what was added or
+changed after that time, oldest change first, plus the ids deleted since;
+each response carries `next_since` to use on the following poll. When more
+than `limit` items changed, the response has `has_more` and a cursor at its
+last item (`next_since` and `next_after`); the client sends both back until
+`has_more` is false.
+
+Backfill the change time of service requests created before it was stored:
+    python api.py backfill
+"""
+import hashlib
+import sys
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from bson import ObjectId
+from flask import Blueprint, current_app, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.exceptions import HTTPException, BadRequest, Unauthorized
+from werkzeug.security import check_password_hash
+
+from changes import versions, deletions_since
+from config import API_SETTINGS
+from notifications import get_counts
+from tenancy import DEFAULT_SOCIETY_ID, scoped, find_user_by_email
+from triage import queue as triage_queue
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+_mongo = None
+
+NOTICE_FIELDS = {'title': 1, 'content': 1, 'priority': 1, 'created_at': 1}
+REQUEST_FIELDS = {'title': 1, 'description': 1, 'category': 1, 'priority': 1,
+                  'status': 1, 'user_name': 1, 'apartment': 1, 'assigned_name': 1,
+                  'created_at': 1, 'status_changed_at': 1}
+MESSAGE_FIELDS = {'content': 1, 'user_id': 1, 'user_name': 1, 'is_secretary': 1,
+                  'created_at': 1}
+
+
+class ApiJSONProvider(DefaultJSONProvider):
+    """jsonify() that writes ObjectIds as strings and datetimes as ISO 8601"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            # Stored datetimes are naive UTC
+            return o.isoformat() + 'Z' if o.tzinfo is None else o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+
+def init_api(app, mongo):
+    """Register the blueprint and its JSON provider on app"""
+    global _mongo
+    _mongo = mongo
+    app.json = ApiJSONProvider(app)
+    app.register_blueprint(api)
+
+
+# Authentication
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='api-token')
+
+
+def issue_token(user):
+    return _serializer().dumps([str(user['_id']),
+                                user.get('society_id', DEFAULT_SOCIETY_ID),
+                                bool(user.get('is_secretary')),
+                                user.get('name')])
+
+
+def token_required(view):
+    """Verify the bearer token and put its identity in g.api_user"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            raise Unauthorized('Bearer token required.')
+        try:
+            user_id, society_id, is_secretary, name = _serializer().loads(
+                token, max_age=API_SETTINGS['token_max_age_seconds'])
+        except (BadSignature, ValueError):
+            raise Unauthorized('Invalid or expired token.')
+        g.api_user = {'_id': ObjectId(user_id), 'society_id': society_id,
+                      'is_secretary': is_secretary, 'name': name}
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@api.errorhandler(HTTPException)
+def http_error(exc):
+    return jsonify({'error': exc.description}), exc.code
+
+
+@api.route('/auth/token', methods=['POST'])
+def create_token():
+    """Exchange email and password for an API token"""
+    data = request.get_json(silent=True) or request.form
+    user = find_user_by_email(
+        _mongo.db, data.get('email'),
+        {'password': 1, 'name': 1, 'society_id': 1, 'is_secretary': 1})
+    if not user or not check_password_hash(user['password'], data.get('password') or ''):
+        raise Unauthorized('Invalid email or password.')
+    return jsonify({
+        'token': issue_token(user),
+        'expires_in': API_SETTINGS['token_max_age_seconds'],
+        'user': {'id': user['_id'], 'name': user.get('name'),
+                 'society_id': user.get('society_id', DEFAULT_SOCIETY_ID),
+                 'is_secretary': bool(user.get('is_secretary'))}
+    })
+
+
+# Conditional requests and deltas
+
+
+def _limit():
+    limit = request.args.get('limit', API_SETTINGS['page_size'], type=int)
+    return min(max(limit, 1), API_SETTINGS['max_page_size'])
+
+
+def _since():
+    value = request.args.get('since')
+    if not value:
+        return None
+    try:
+        since = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise BadRequest('since must be an ISO 8601 timestamp.')
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def _etag(kinds, *extra):
+    """ETag for this user's view of the request URL, from change versions only"""
+    user = g.api_user
+    key = repr((request.full_path, str(user['_id']), user['is_secretary'],
+                sorted(versions(_mongo.db, user['society_id'], kinds).items()), extra))
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def _not_modified(etag):
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+
+def _respond(payload, etag):
+    if 'next_since' not in payload:
+        payload['next_since'] = datetime.utcnow() - timedelta(
+            seconds=API_SETTINGS['since_overlap_seconds'])
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _changes(payload, collection, query, kind, field, projection):
+    """With since, one page of the items whose field is after the client's
+    cursor, oldest first, and the ids deleted since; None without since, or
+    when the tombstones do not reach back and the client must reload."""
+    since = _since()
+    if since is None:
+        return None
+    deleted = deletions_since(_mongo.db, g.api_user['society_id'], kind, since)
+    if deleted is None:
+        payload['reset'] = True
+        return None
+    payload['deleted'] = deleted
+
+    # (field, _id) is the cursor, so items sharing a timestamp across a page
+    # boundary are neither lost nor repeated forever
+    changed = {field: {'$gt': since}}
+    after = request.args.get('after')
+    if after:
+        if not ObjectId.is_valid(after):
+            raise BadRequest('after must be an id from next_after.')
+        changed = {'$or': [changed, {field: since, '_id': {'$gt': ObjectId(after)}}]}
+    limit = _limit()
+    items = list(collection.find({'$and': [query, changed]}, projection)
+                 .sort([(field, 1), ('_id', 1)]).limit(limit + 1))
+    payload['has_more'] = len(items) > limit
+    if payload['has_more']:
+        items = items[:limit]
+        payload['next_since'] = items[-1][field]
+        payload['next_after'] = items[-1]['_id']
+    return items
+
+
+# Resources
+
+
+@api.route('/notices')
+@token_required
+def notices():
+    """Newest notices first; with since, new ones oldest first"""
+    etag = _etag(['notices'])
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    payload = {}
+    query = scoped(g.api_user['society_id'])
+    notices = _changes(payload, _mongo.db.notices, query, 'notices', 'created_at', NOTICE_FIELDS)
+    if notices is None:
+        notices = list(_mongo.db.notices.find(query, NOTICE_FIELDS)
+                       .sort('created_at', -1).limit(_limit()))
+    payload['notices'] = notices
+    return _respond(payload, etag)
+
+
+@api.route('/service_requests')
+@token_required
+def service_requests():
+    """The resident's own requests, or the whole society's for a secretary.
+    With since, those created or moved to another status, oldest change first;
+    status_changed_at is set on creation too, so it alone orders both."""
+    user = g.api_user
+    etag = _etag(['service_requests'])
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    query = scoped(user['society_id'])
+    if not user['is_secretary']:
+        query['user_id'] = user['_id']
+    payload = {}
+    requests = _changes(payload, _mongo.db.service_requests, query, 'service_requests',
+                        'status_changed_at', REQUEST_FIELDS)
+    if requests is None:
+        requests = list(_mongo.db.service_requests.find(query, REQUEST_FIELDS)
+                        .sort('created_at', -1).limit(_limit()))
+    payload['service_requests'] = requests
+    return _respond(payload, etag)
+
+
+@api.route('/chat')
+@token_required
+def chat():
+    """The latest chat messages, oldest first; with since, only newer ones"""
+    etag = _etag(['messages'])
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    payload = {}
+    query = scoped(g.api_user['society_id'])
+    messages = _changes(payload, _mongo.db.messages, query, 'messages', 'created_at',
+                        MESSAGE_FIELDS)
+    if messages is None:
+        cursor = _mongo.db.messages.find(query, MESSAGE_FIELDS).sort('created_at', -1)
+        messages = list(cursor.limit(_limit()))[::-1]
+    payload['messages'] = messages
+    return _respond(payload, etag)
+
+
+@api.route('/dashboard')
+@token_required
+def dashboard():
+    """Everything the app's home screen shows, in one call"""
+    user = g.api_user
+    db = _mongo.db
+    counts = get_counts(db, user['_id'], user['society_id'])
+    etag = _etag(['notices', 'messages', 'service_requests'], counts['version'])
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    society = scoped(user['society_id'])
+    if user['is_secretary']:
+        requests = triage_queue(db, user['society_id'], limit=5)
+    else:
+        requests = list(db.service_requests.find(
+            dict(society, user_id=user['_id']), REQUEST_FIELDS).sort('created_at', -1).limit(3))
+    return _respond({
+        'notices': list(db.notices.find(society, NOTICE_FIELDS).sort('created_at', -1).limit(5)),
+        'service_requests': requests,
+        'messages': list(db.messages.find(society, MESSAGE_FIELDS).sort('created_at', -1).limit(5)),
+        'unread': {'notices': counts['notices'], 'requests': counts['requests']}
+    }, etag)
+
+
+def backfill_change_times(db):
+    """Give service requests from before status_changed_at was set on
+    creation their creation time; returns how many were updated"""
+    return db.service_requests.update_many(
+        {'status_changed_at': {'$exists': False}},
+        [{'$set': {'status_changed_at': '$created_at'}}]).modified_count
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        sys.exit('usage: python api.py backfill')
+    from worker import get_database
+    print('Updated %d service request(s)' % backfill_change_times(get_database()))
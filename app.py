@@ -1,10 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, g
 from flask_pymongo import PyMongo
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone
+from datetime import datetime
 import os
 from bson import ObjectId
 
+from config import (NOTIFICATION_SETTINGS, UPLOAD_SETTINGS, CHAT_SETTINGS, SEARCH_SETTINGS,
+                    PRESENCE_SETTINGS, TENANCY_SETTINGS, CATEGORIES, PRIORITY_LEVELS)
+from jobs import enqueue_job
+from attachments import (AttachmentError, validate_uploads, save_attachments,
+                         enqueue_thumbnails, open_attachment, stream_response,
+                         max_request_size)
+from analytics import record_created, record_transition, sla_report
+from notifications import (get_counts, notify_notice_posted, notify_request_updated,
+                           mark_seen, stream_counts)
+from tenancy import (DEFAULT_SOCIETY_ID, scoped, claim_email, release_email, find_user_by_email,
+                     invite_code, rotate_invite_code, society_for_invite)
+from read_routing import ReadRouter, start_causal_session, remember_writes
+from profanity import get_filter
+from presence import get_store as get_presence, stream_presence
+from profiling import RequestProfiler, process_memory
+from moderation import (ModerationError, parse_criteria, message_filter, preview, start_purge,
+                        purge_status)
+from changes import bump, record_deletions
+from api import init_api
+from offline import asset_version, page_etag, conditional_page
+from triage import triage_score, rescore, queue as triage_queue, queue_item, claim
+from rendering import (format_datetime, format_time_only, render_text,
+                       render_message, render_notice, ensure_rendered)
+from resident_import import (ResidentImportError, start_import, import_status, password_error,
+                             send_password_links, user_for_password_token,
+                             complete_password_setup)
+from search import (index_document, remove_document, notice_text, message_text,
+                    search as search_index, load_hits)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get(
     'SECRET_KEY') or 'your-secret-key-change-in-production'
@@ -13,6 +42,25 @@ app.secret_key = os.environ.get(
 app.config['MONGO_URI'] = os.environ.get(
     'MONGO_URI') or 'mongodb://localhost:27017/hyperlocal_community'
 mongo = PyMongo(app)
+read_router = ReadRouter(mongo.db)
+
+# Sampled cProfile/tracemalloc per request when PROFILE_REQUESTS is set
+profiler = RequestProfiler(app)
+
+# Token-authenticated JSON API for the mobile app under /api/v1
+init_api(app, mongo)
+
+# Changes with every deploy that touches templates or static files; part of
+# page ETags and of the service worker's cache names
+ASSET_VERSION = asset_version(app.root_path)
+
+# Upload limit for a whole request body; each file is also checked against
+# UPLOAD_SETTINGS['max_file_size'] in attachments.py
+app.config['MAX_CONTENT_LENGTH'] = max_request_size()
+
+# Compile the chat word list once at startup rather than on the first message
+if CHAT_SETTINGS['profanity_filter']:
+    get_filter()
 
 # Default Secretary Credentials
 SECRETARY_EMAIL = "secretary@community.com"
@@ -27,25 +75,86 @@ RESIDENT_PASSWORD = "resident123"
 
 def get_current_user():
     if 'user_id' in session:
-        return mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+        if user:
+            # Sessions from before tenancy carry no society yet
+            session['society_id'] = user.get('society_id', DEFAULT_SOCIETY_ID)
+        return user
     return None
 
 
+def db_session():
+    """This request's causally consistent MongoDB session"""
+    if 'db_session' not in g:
+        g.db_session = start_causal_session(mongo.cx, session)
+    return g.db_session
+
+
+def write_session():
+    """db_session() for a write the user should read back on later pages"""
+    g.db_wrote = True
+    return db_session()
+
+
+def read_db():
+    """Database handle with the current route's read preference"""
+    return read_router.database(request.endpoint)
+
+
+@app.after_request
+def save_causal_token(response):
+    if g.get('db_wrote'):
+        remember_writes(g.db_session, session)
+    return response
+
+
+@app.teardown_request
+def end_db_session(error):
+    db_session = g.pop('db_session', None)
+    if db_session is not None:
+        db_session.end_session()
+
+
+def current_society_id():
+    """Society of the logged-in user; all tenant data is scoped to it"""
+    return session.get('society_id') or DEFAULT_SOCIETY_ID
+
+
+def login_user(user):
+    session['user_id'] = str(user['_id'])
+    session['society_id'] = user.get('society_id', DEFAULT_SOCIETY_ID)
+
+
 # Context processor to make current_user available in all templates
 @app.context_processor
 def inject_current_user():
+    user = get_current_user()
     return {
-        'current_user': get_current_user(),
+        'current_user': user,
+        'unread_counts': get_counts(mongo.db, user['_id'], current_society_id()) if user else None,
         'format_datetime': format_datetime,
-        'format_time_only': format_time_only
+        'format_time_only': format_time_only,
+        'asset_version': ASSET_VERSION
     }
 
 
+@app.template_filter('filesize')
+def filesize_filter(size):
+    """Format a byte count as KB/MB for display"""
+    if size is None:
+        return 'n/a'
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '%.0f %s' % (size, unit) if unit == 'B' else '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GB' % size
+
+
 @app.template_filter('nl2br')
 def nl2br_filter(text):
-    """Convert newlines to <br> tags for HTML display"""
+    """Escape text and convert newlines to <br> tags for HTML display"""
     if text:
-        return text.replace('\n', '<br>')
+        return render_text(text)
     return text
 
 
@@ -54,27 +163,6 @@ def is_secretary():
     return user and user.get('is_secretary', False)
 
 
-def format_datetime(dt):
-    """Convert UTC datetime to local time and format it"""
-    if dt is None:
-        return 'Recently'
-
-    # Convert UTC to local time (assuming local timezone)
-    # For a production app, you might want to use pytz or zoneinfo for proper timezone handling
-    local_dt = dt.replace(tzinfo=timezone.utc).astimezone()
-    return local_dt.strftime('%B %d, %Y at %I:%M %p')
-
-
-def format_time_only(dt):
-    """Convert UTC datetime to local time and format time only"""
-    if dt is None:
-        return 'Recently'
-
-    # Convert UTC to local time
-    local_dt = dt.replace(tzinfo=timezone.utc).astimezone()
-    return local_dt.strftime('%I:%M %p')
-
-
 @app.route('/')
 def index():
     """Home page - redirects to appropriate area based on user type"""
@@ -98,53 +186,55 @@ def login():
         # Check if it's the secretary login
         if email == SECRETARY_EMAIL and password == SECRETARY_PASSWORD:
             # Check if secretary user exists in database, if not create it
-            secretary_user = mongo.db.users.find_one(
-                {'email': SECRETARY_EMAIL})
+            secretary_user = find_user_by_email(mongo.db, SECRETARY_EMAIL)
             if not secretary_user:
                 secretary_data = {
+                    '_id': ObjectId(),
                     'name': 'Society Secretary',
                     'email': SECRETARY_EMAIL,
                     'apartment': 'Office',
                     'password': generate_password_hash(SECRETARY_PASSWORD),
                     'is_secretary': True,
                     'is_admin': False,
+                    'society_id': DEFAULT_SOCIETY_ID,
                     'created_at': datetime.utcnow()
                 }
+                claim_email(mongo.db, SECRETARY_EMAIL, DEFAULT_SOCIETY_ID, secretary_data['_id'])
                 mongo.db.users.insert_one(secretary_data)
-                secretary_user = mongo.db.users.find_one(
-                    {'email': SECRETARY_EMAIL})
+                secretary_user = secretary_data
 
-            session['user_id'] = str(secretary_user['_id'])
+            login_user(secretary_user)
             flash('Successfully logged in as Secretary!', 'success')
             return redirect(url_for('secretary_dashboard'))
 
         # Check if it's the default resident login
         if email == RESIDENT_EMAIL and password == RESIDENT_PASSWORD:
             # Check if default resident user exists in database, if not create it
-            resident_user = mongo.db.users.find_one(
-                {'email': RESIDENT_EMAIL})
+            resident_user = find_user_by_email(mongo.db, RESIDENT_EMAIL)
             if not resident_user:
                 resident_data = {
+                    '_id': ObjectId(),
                     'name': 'Default Resident',
                     'email': RESIDENT_EMAIL,
                     'apartment': 'A-101',
                     'password': generate_password_hash(RESIDENT_PASSWORD),
                     'is_secretary': False,
                     'is_admin': False,
+                    'society_id': DEFAULT_SOCIETY_ID,
                     'created_at': datetime.utcnow()
                 }
+                claim_email(mongo.db, RESIDENT_EMAIL, DEFAULT_SOCIETY_ID, resident_data['_id'])
                 mongo.db.users.insert_one(resident_data)
-                resident_user = mongo.db.users.find_one(
-                    {'email': RESIDENT_EMAIL})
+                resident_user = resident_data
 
-            session['user_id'] = str(resident_user['_id'])
+            login_user(resident_user)
             flash('Successfully logged in as Resident!', 'success')
             return redirect(url_for('dashboard'))
 
         # Regular user login
-        user = mongo.db.users.find_one({'email': email})
+        user = find_user_by_email(mongo.db, email)
         if user and check_password_hash(user['password'], password):
-            session['user_id'] = str(user['_id'])
+            login_user(user)
             flash('Successfully logged in!', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -162,41 +252,102 @@ def register():
         apartment = request.form.get('apartment')
         password = request.form.get('password')
         confirm_password = request.form.get('confirm_password')
+        code = (request.form.get('invite_code') or '').strip()
+
+        # Residents join the society whose secretary gave them the code
+        if code:
+            society_id = society_for_invite(mongo.db, code)
+        elif TENANCY_SETTINGS['open_registration']:
+            society_id = DEFAULT_SOCIETY_ID
+        else:
+            society_id = None
 
         # Validation
         if password != confirm_password:
             flash('Passwords do not match.', 'error')
             return render_template('register.html')
 
-        if mongo.db.users.find_one({'email': email}):
+        if not society_id:
+            flash('Please enter the invite code from your society secretary.'
+                  if not code else 'That invite code is not valid.', 'error')
+            return render_template('register.html')
+
+        user_id = ObjectId()
+        if find_user_by_email(mongo.db, email, {'_id': 1}) or \
+                not claim_email(mongo.db, email, society_id, user_id):
             flash('Email already registered.', 'error')
             return render_template('register.html')
 
         # Create user (only residents can register)
         user_data = {
+            '_id': user_id,
             'name': name,
             'email': email,
             'apartment': apartment,
             'password': generate_password_hash(password),
             'is_secretary': False,
             'is_admin': False,
+            'society_id': society_id,
             'created_at': datetime.utcnow()
         }
 
-        mongo.db.users.insert_one(user_data)
+        mongo.db.users.insert_one(user_data, session=write_session())
         flash('Registration successful! Please login.', 'success')
         return redirect(url_for('login'))
 
     return render_template('register.html')
 
 
+@app.route('/set_password/<user_id>/<token>', methods=['GET', 'POST'])
+def set_password(user_id, token):
+    """One-time link emailed to residents imported without a password"""
+    user = user_for_password_token(mongo.db, user_id, token)
+    if not user:
+        flash('This link has expired or was already used. '
+              'Ask your society secretary to send a new one.', 'error')
+        return redirect(url_for('login'))
+
+    if request.method == 'POST':
+        password = request.form.get('password') or ''
+        if password != request.form.get('confirm_password'):
+            flash('Passwords do not match.', 'error')
+            return render_template('set_password.html', user=user)
+        error = password_error(password)
+        if error:
+            flash(error, 'error')
+            return render_template('set_password.html', user=user)
+
+        if not complete_password_setup(mongo.db, user, token, generate_password_hash(password)):
+            flash('This link was already used.', 'error')
+            return redirect(url_for('login'))
+        flash('Password set. Please login.', 'success')
+        return redirect(url_for('login'))
+
+    return render_template('set_password.html', user=user)
+
+
 @app.route('/logout')
 def logout():
     """Logout user"""
     session.pop('user_id', None)
+    session.pop('society_id', None)
     flash('Successfully logged out!', 'success')
     return redirect(url_for('index'))
 
+
+@app.route('/sw.js')
+def service_worker():
+    """The service worker, served from the root so it controls every page"""
+    response = app.send_static_file('sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/offline')
+def offline():
+    """App shell the service worker shows when a page is not cached"""
+    return render_template('offline.html')
+
 # User Dashboard Routes
 
 
@@ -213,17 +364,26 @@ def dashboard():
         return redirect(url_for('secretary_dashboard'))
 
     # Get user's recent activity for regular residents
-    notices = list(mongo.db.notices.find().sort('created_at', -1).limit(5))
-    requests = list(mongo.db.service_requests.find(
-        {'user_id': user['_id']}).sort('created_at', -1).limit(3))
-    messages = list(mongo.db.messages.find().sort('created_at', -1).limit(5))
-
-    return render_template('dashboard.html',
-                           user=user,
-                           notices=notices,
-                           requests=requests,
-                           messages=messages,
-                           now=datetime.utcnow())
+    society_id = current_society_id()
+    etag = page_etag(mongo.db, user, society_id, ASSET_VERSION,
+                     'notices', 'messages', 'service_requests')
+
+    def render():
+        db = read_db()
+        notices = list(db.notices.find(
+            scoped(society_id), session=db_session()).sort('created_at', -1).limit(5))
+        requests = list(db.service_requests.find(
+            scoped(society_id, {'user_id': user['_id']}),
+            session=db_session()).sort('created_at', -1).limit(3))
+        messages = list(db.messages.find(
+            scoped(society_id), session=db_session()).sort('created_at', -1).limit(5))
+        return render_template('dashboard.html',
+                               user=user,
+                               notices=notices,
+                               requests=requests,
+                               messages=messages,
+                               now=datetime.utcnow())
+    return conditional_page(etag, render)
 
 
 @app.route('/notices')
@@ -234,13 +394,20 @@ def notices():
         flash('Please login to view notices.', 'error')
         return redirect(url_for('login'))
 
-    notices = list(mongo.db.notices.find().sort('created_at', -1))
-
     # If user is secretary, redirect to secretary notices page
     if user.get('is_secretary'):
         return redirect(url_for('secretary_notices'))
 
-    return render_template('notices.html', notices=notices)
+    # Mark seen first so the ETag matches the badge the page will show
+    mark_seen(mongo.db, user['_id'], 'notices')
+    etag = page_etag(mongo.db, user, current_society_id(), ASSET_VERSION, 'notices')
+
+    def render():
+        notices = list(read_db().notices.find(
+            scoped(current_society_id()), session=db_session()).sort('created_at', -1))
+        ensure_rendered(mongo.db.notices, notices, render_notice)
+        return render_template('notices.html', notices=notices)
+    return conditional_page(etag, render)
 
 
 @app.route('/service_requests', methods=['GET', 'POST'])
@@ -261,7 +428,14 @@ def service_requests():
         category = request.form.get('category')
         priority = request.form.get('priority')
 
+        try:
+            files = validate_uploads(request.files.getlist('attachments'))
+        except AttachmentError as exc:
+            flash(str(exc), 'error')
+            return redirect(url_for('service_requests'))
+
         request_data = {
+            '_id': ObjectId(),
             'title': title,
             'description': description,
             'category': category,
@@ -270,16 +444,38 @@ def service_requests():
             'user_id': user['_id'],
             'user_name': user['name'],
             'apartment': user['apartment'],
+            'society_id': current_society_id(),
             'created_at': datetime.utcnow()
         }
-
-        mongo.db.service_requests.insert_one(request_data)
+        # The API's since= polls page through requests by this one field
+        request_data['status_changed_at'] = request_data['created_at']
+        request_data['triage_score'] = triage_score(request_data)
+
+        if files:
+            try:
+                request_data['attachments'] = save_attachments(
+                    mongo.db, files, request_data['_id'], user['_id'],
+                    request_data['society_id'])
+            except AttachmentError as exc:
+                flash(str(exc), 'error')
+                return redirect(url_for('service_requests'))
+
+        mongo.db.service_requests.insert_one(request_data, session=write_session())
+        bump(mongo.db, request_data['society_id'], 'service_requests')
+        record_created(mongo.db, request_data)
+        enqueue_thumbnails(mongo.db, request_data.get('attachments', []))
         flash('Service request submitted successfully!', 'success')
         return redirect(url_for('service_requests'))
 
-    requests = list(mongo.db.service_requests.find(
-        {'user_id': user['_id']}).sort('created_at', -1))
-    return render_template('service_requests.html', requests=requests)
+    mark_seen(mongo.db, user['_id'], 'requests')
+    etag = page_etag(mongo.db, user, current_society_id(), ASSET_VERSION, 'service_requests')
+
+    def render():
+        requests = list(read_db().service_requests.find(
+            scoped(current_society_id(), {'user_id': user['_id']}),
+            session=db_session()).sort('created_at', -1))
+        return render_template('service_requests.html', requests=requests)
+    return conditional_page(etag, render)
 
 
 @app.route('/chat', methods=['GET', 'POST'])
@@ -291,20 +487,132 @@ def chat():
         return redirect(url_for('login'))
 
     if request.method == 'POST':
-        message = request.form.get('message')
-        if message.strip():
+        message = request.form.get('message') or ''
+        if len(message) > CHAT_SETTINGS['max_message_length']:
+            flash('Messages can be at most %d characters.' %
+                  CHAT_SETTINGS['max_message_length'], 'error')
+        elif message.strip():
+            if CHAT_SETTINGS['profanity_filter']:
+                message = get_filter().censor(message)
             message_data = {
                 'content': message,
                 'user_id': user['_id'],
                 'user_name': user['name'],
                 'is_secretary': user.get('is_secretary', False),
+                'society_id': current_society_id(),
                 'created_at': datetime.utcnow()
             }
-            mongo.db.messages.insert_one(message_data)
+            message_data['rendered'] = render_message(message_data)
+            mongo.db.messages.insert_one(message_data, session=write_session())
+            index_document(mongo.db, message_data['society_id'], 'message',
+                           message_data, message_text(message_data))
+            bump(mongo.db, message_data['society_id'], 'messages')
+
+    get_presence().heartbeat(current_society_id(), str(user['_id']), user['name'],
+                             typing=False if request.method == 'POST' else None)
+    etag = None
+    if request.method == 'GET':
+        etag = page_etag(mongo.db, user, current_society_id(), ASSET_VERSION, 'messages')
+
+    def render():
+        messages = list(read_db().messages.find(
+            scoped(current_society_id()), session=db_session()).sort('created_at', -1).limit(50))
+        messages.reverse()  # Show oldest first
+        ensure_rendered(mongo.db.messages, messages, render_message)
+        return render_template('chat.html', messages=messages, presence=PRESENCE_SETTINGS)
+    return conditional_page(etag, render)
+
+
+@app.route('/chat/presence', methods=['POST'])
+def chat_presence():
+    """Heartbeat from an open chat page, optionally with a typing flag"""
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'Login required'}), 401
+
+    typing = request.form.get('typing')
+    get_presence().heartbeat(current_society_id(), str(user['_id']), user['name'],
+                             typing=None if typing is None else typing == '1')
+    return '', 204
+
+
+@app.route('/chat/presence/leave', methods=['POST'])
+def chat_presence_leave():
+    """Sent by the chat page as it closes, so the user drops off at once"""
+    if 'user_id' in session:
+        get_presence().leave(current_society_id(), session['user_id'])
+    return '', 204
+
+
+@app.route('/chat/presence/stream')
+def chat_presence_stream():
+    """Server-sent events with who is online and typing in the user's society"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+
+    events = stream_presence(get_presence(), current_society_id())
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/search')
+def search():
+    """Ranked search across notices and chat messages"""
+    user = get_current_user()
+    if not user:
+        flash('Please login to search.', 'error')
+        return redirect(url_for('login'))
+
+    query = (request.args.get('q') or '').strip()[:SEARCH_SETTINGS['max_query_length']]
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = SEARCH_SETTINGS['results_per_page']
+    hits, total = [], 0
+    if query:
+        db = read_db()
+        hits, total = search_index(db, current_society_id(), query, page=page)
+        hits = load_hits(db, hits)
+    pages = (total + per_page - 1) // per_page
+    return render_template('search.html', query=query, hits=hits, total=total,
+                           page=page, pages=pages)
+
+
+@app.route('/attachments/<file_id>')
+def download_attachment(file_id):
+    """Stream a service request attachment (or its thumbnail)"""
+    user = get_current_user()
+    if not user:
+        flash('Please login to view attachments.', 'error')
+        return redirect(url_for('login'))
+
+    grid_out = open_attachment(
+        mongo.db, ObjectId(file_id)) if ObjectId.is_valid(file_id) else None
+    if grid_out is None:
+        return jsonify({'error': 'Attachment not found'}), 404
+
+    # Residents can only see files attached to their own requests, and
+    # secretaries only those of their own society
+    metadata = grid_out.metadata or {}
+    if metadata.get('society_id', DEFAULT_SOCIETY_ID) != current_society_id():
+        return jsonify({'error': 'Attachment not found'}), 404
+    if not user.get('is_secretary') and metadata.get('user_id') != user['_id']:
+        return jsonify({'error': 'Access denied'}), 403
+
+    return stream_response(app.response_class, request.environ, grid_out,
+                           as_attachment=request.args.get('download') == '1')
 
-    messages = list(mongo.db.messages.find().sort('created_at', -1).limit(50))
-    messages.reverse()  # Show oldest first
-    return render_template('chat.html', messages=messages)
+
+@app.route('/notifications/stream')
+def notification_stream():
+    """Server-sent events carrying the current user's unread counts"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    last_version = int(last_event_id) if last_event_id.isdigit() else None
+    events = stream_counts(mongo.db, ObjectId(session['user_id']),
+                           current_society_id(), last_version)
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Profile Settings
 
@@ -334,10 +642,9 @@ def profile():
         if apartment and apartment != user.get('apartment'):
             updates['apartment'] = apartment
         if email and email != user.get('email'):
-            # Ensure email uniqueness
-            existing_user = mongo.db.users.find_one(
-                {'email': email, '_id': {'$ne': user['_id']}})
-            if existing_user:
+            # Ensure email uniqueness across all societies
+            existing_user = find_user_by_email(mongo.db, email, {'_id': 1})
+            if existing_user and existing_user['_id'] != user['_id']:
                 flash('This email is already in use by another account.', 'error')
                 return redirect(url_for('profile'))
             updates['email'] = email
@@ -356,8 +663,14 @@ def profile():
                 return redirect(url_for('profile'))
             updates['password'] = generate_password_hash(new_password)
 
+        if 'email' in updates and not claim_email(mongo.db, email, current_society_id(), user['_id']):
+            flash('This email is already in use by another account.', 'error')
+            return redirect(url_for('profile'))
+
         if updates:
             mongo.db.users.update_one({'_id': user['_id']}, {'$set': updates})
+            if 'email' in updates and user.get('email'):
+                release_email(mongo.db, user['email'], user['_id'])
             flash('Profile updated successfully!', 'success')
         else:
             flash('No changes to update.', 'info')
@@ -377,17 +690,22 @@ def secretary_dashboard():
         return redirect(url_for('login'))
 
     # Get statistics
-    total_users = mongo.db.users.count_documents({'is_secretary': False})
-    total_notices = mongo.db.notices.count_documents({})
-    pending_requests = mongo.db.service_requests.count_documents(
-        {'status': 'pending'})
-    total_messages = mongo.db.messages.count_documents({})
+    society_id = current_society_id()
+    db = read_db()
+    total_users = db.users.count_documents(
+        scoped(society_id, {'is_secretary': False}), session=db_session())
+    total_notices = db.notices.count_documents(
+        scoped(society_id), session=db_session())
+    pending_requests = db.service_requests.count_documents(
+        scoped(society_id, {'status': 'pending'}), session=db_session())
+    total_messages = db.messages.count_documents(
+        scoped(society_id), session=db_session())
 
     # Get recent activity
-    recent_requests = list(
-        mongo.db.service_requests.find().sort('created_at', -1).limit(5))
-    recent_notices = list(
-        mongo.db.notices.find().sort('created_at', -1).limit(3))
+    recent_requests = list(db.service_requests.find(
+        scoped(society_id), session=db_session()).sort('created_at', -1).limit(5))
+    recent_notices = list(db.notices.find(
+        scoped(society_id), session=db_session()).sort('created_at', -1).limit(3))
 
     return render_template('secretary_panel.html',
                            total_users=total_users,
@@ -414,10 +732,26 @@ def secretary_post_notice():
             'title': title,
             'content': content,
             'priority': priority,
+            'society_id': current_society_id(),
             'created_at': datetime.utcnow()
         }
+        notice_data['rendered'] = render_notice(notice_data)
+
+        notice_id = mongo.db.notices.insert_one(
+            notice_data, session=write_session()).inserted_id
+        index_document(mongo.db, notice_data['society_id'], 'notice',
+                       notice_data, notice_text(notice_data))
+        bump(mongo.db, notice_data['society_id'], 'notices')
+
+        # Email residents from the background worker, not this request
+        if NOTIFICATION_SETTINGS['email_notifications']:
+            enqueue_job(mongo.db, 'notice_fanout',
+                        {'notice_id': notice_id,
+                         'society_id': notice_data['society_id']},
+                        dedupe_key='notice_fanout:%s' % notice_id)
+        notify_notice_posted(mongo.db, notice_data['society_id'],
+                             ObjectId(session['user_id']))
 
-        mongo.db.notices.insert_one(notice_data)
         flash('Notice posted successfully!', 'success')
         return redirect(url_for('secretary_notices'))
 
@@ -431,7 +765,9 @@ def secretary_notices():
         flash('Access denied. Secretary privileges required.', 'error')
         return redirect(url_for('login'))
 
-    notices = list(mongo.db.notices.find().sort('created_at', -1))
+    notices = list(read_db().notices.find(
+        scoped(current_society_id()), session=db_session()).sort('created_at', -1))
+    ensure_rendered(mongo.db.notices, notices, render_notice)
     return render_template('secretary_notices.html', notices=notices)
 
 
@@ -442,8 +778,10 @@ def secretary_requests():
         flash('Access denied. Secretary privileges required.', 'error')
         return redirect(url_for('login'))
 
-    requests = list(mongo.db.service_requests.find().sort('created_at', -1))
-    return render_template('secretary_requests.html', requests=requests)
+    requests = list(read_db().service_requests.find(
+        scoped(current_society_id()), session=db_session()).sort('created_at', -1))
+    pending = triage_queue(read_db(), current_society_id(), session=db_session())
+    return render_template('secretary_requests.html', requests=requests, queue=pending)
 
 
 @app.route('/secretary/update_request_status', methods=['POST'])
@@ -455,14 +793,105 @@ def update_request_status():
     request_id = request.form.get('request_id')
     status = request.form.get('status')
 
-    mongo.db.service_requests.update_one(
-        {'_id': ObjectId(request_id)},
-        {'$set': {'status': status}}
+    # Only a real change is recorded; the returned document is the
+    # pre-update state, so its status is the one being left
+    now = datetime.utcnow()
+    update = {'$set': {'status': status, 'status_changed_at': now},
+              '$push': {'status_history': {'status': status, 'at': now}}}
+    if status == 'pending':
+        # Back in the queue, so nobody owns it any more
+        update['$unset'] = {'assigned_to': '', 'assigned_name': '', 'assigned_at': ''}
+    previous = mongo.db.service_requests.find_one_and_update(
+        scoped(current_society_id(),
+               {'_id': ObjectId(request_id), 'status': {'$ne': status}}),
+        update,
+        projection={'user_id': 1, 'society_id': 1, 'status': 1,
+                    'category': 1, 'priority': 1, 'created_at': 1},
+        session=write_session()
     )
+    if previous:
+        rescore(mongo.db, previous, status, now, session=write_session())
+        bump(mongo.db, previous['society_id'], 'service_requests')
+        record_transition(mongo.db, previous, previous.get('status'), status, now)
+        notify_request_updated(mongo.db, previous['society_id'], previous['user_id'])
 
     return jsonify({'success': True})
 
 
+@app.route('/secretary/queue')
+def secretary_queue():
+    """Top pending service requests by triage score"""
+    if not is_secretary():
+        return jsonify({'error': 'Access denied'}), 403
+
+    items = triage_queue(mongo.db, current_society_id(),
+                         limit=request.args.get('limit', type=int))
+    return jsonify({'requests': [queue_item(item) for item in items]})
+
+
+@app.route('/secretary/queue/claim', methods=['POST'])
+def secretary_claim_request():
+    """Take a pending request (or the top of the queue) for a secretary"""
+    user = get_current_user()
+    if not user or not user.get('is_secretary'):
+        return jsonify({'error': 'Access denied'}), 403
+
+    assignee = user
+    assignee_id = request.form.get('assignee_id')
+    if assignee_id and assignee_id != str(user['_id']):
+        assignee = mongo.db.users.find_one(
+            scoped(current_society_id(), {'_id': ObjectId(assignee_id), 'is_secretary': True}),
+            {'name': 1}) if ObjectId.is_valid(assignee_id) else None
+        if not assignee:
+            return jsonify({'error': 'Unknown assignee'}), 400
+
+    request_id = request.form.get('request_id')
+    if request_id and not ObjectId.is_valid(request_id):
+        return jsonify({'error': 'Request not found'}), 404
+    previous = claim(mongo.db, current_society_id(), assignee,
+                     ObjectId(request_id) if request_id else None,
+                     session=write_session())
+    if not previous:
+        return jsonify({'error': 'Already claimed or no longer pending'}), 409
+
+    bump(mongo.db, previous['society_id'], 'service_requests')
+    record_transition(mongo.db, previous, 'pending', 'in_progress', datetime.utcnow())
+    notify_request_updated(mongo.db, previous['society_id'], previous['user_id'])
+    return jsonify({'success': True, 'request': queue_item(
+        dict(previous, status='in_progress', assigned_to=assignee['_id'],
+             assigned_name=assignee['name']))})
+
+
+@app.route('/secretary/analytics')
+def secretary_analytics():
+    """Service request resolution times and backlog, read from daily rollups"""
+    if not is_secretary():
+        flash('Access denied. Secretary privileges required.', 'error')
+        return redirect(url_for('login'))
+
+    weeks = min(max(request.args.get('weeks', 12, type=int), 1), 52)
+    report = sla_report(read_db(), current_society_id(), weeks=weeks)
+    return render_template('secretary_analytics.html', report=report, weeks=weeks,
+                           categories=CATEGORIES, priorities=PRIORITY_LEVELS)
+
+
+@app.route('/secretary/diagnostics', methods=['GET', 'POST'])
+def secretary_diagnostics():
+    """Per-endpoint allocation peaks and hot functions from sampled requests"""
+    if not is_secretary():
+        flash('Access denied. Secretary privileges required.', 'error')
+        return redirect(url_for('login'))
+
+    if request.method == 'POST':
+        profiler.reset()
+        flash('Profiling samples cleared.', 'success')
+        return redirect(url_for('secretary_diagnostics'))
+
+    return render_template('secretary_diagnostics.html', report=profiler.report(),
+                           settings=profiler.settings, memory=process_memory(),
+                           pid=os.getpid())
+
+
 @app.route('/secretary/users')
 def secretary_users():
     """Secretary users management"""
@@ -470,9 +899,92 @@ def secretary_users():
         flash('Access denied. Secretary privileges required.', 'error')
         return redirect(url_for('login'))
 
-    users = list(mongo.db.users.find(
-        {'is_secretary': False}).sort('created_at', -1))
-    return render_template('secretary_users.html', users=users)
+    users = list(read_db().users.find(
+        scoped(current_society_id(), {'is_secretary': False}),
+        session=db_session()).sort('created_at', -1))
+    return render_template('secretary_users.html', users=users,
+                           invite_code=invite_code(mongo.db, current_society_id()))
+
+
+@app.route('/secretary/invite_code', methods=['POST'])
+def secretary_rotate_invite_code():
+    """Issue a new invite code; the old one stops admitting registrations"""
+    if not is_secretary():
+        flash('Access denied. Secretary privileges required.', 'error')
+        return redirect(url_for('login'))
+
+    rotate_invite_code(mongo.db, current_society_id())
+    flash('New invite code issued. The previous code no longer works.', 'success')
+    return redirect(url_for('secretary_users'))
+
+
+@app.route('/secretary/users/<user_id>/password_link', methods=['POST'])
+def secretary_resend_password_link(user_id):
+    """Email an imported resident a new set-password link"""
+    if not is_secretary():
+        flash('Access denied. Secretary privileges required.', 'error')
+        return redirect(url_for('login'))
+
+    resident = mongo.db.users.find_one(scoped(current_society_id(), {
+        '_id': ObjectId(user_id), 'password_setup': {'$exists': True}})) \
+        if ObjectId.is_valid(user_id) else None
+    if not resident:
+        flash('That resident has already set a password.', 'info')
+        return redirect(url_for('secretary_users'))
+
+    send_password_links(mongo.db, [resident['_id']])
+    flash('A new set-password link is on its way to %s.' % resident['email'], 'success')
+    return redirect(url_for('secretary_users'))
+
+
+@app.route('/secretary/import_residents', methods=['GET', 'POST'])
+def secretary_import_residents():
+    """Upload a CSV of residents; the worker imports it in the background"""
+    if not is_secretary():
+        flash('Access denied. Secretary privileges required.', 'error')
+        return redirect(url_for('login'))
+
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or not file.filename:
+            flash('Please choose a CSV file to import.', 'error')
+            return redirect(url_for('secretary_import_residents'))
+        try:
+            import_id = start_import(mongo.db, file, current_society_id(),
+                                     ObjectId(session['user_id']))
+        except ResidentImportError as exc:
+            flash(str(exc), 'error')
+            return redirect(url_for('secretary_import_residents'))
+        flash('Import queued. Progress is shown below.', 'success')
+        return redirect(url_for('secretary_import_residents', import_id=str(import_id)))
+
+    imports = list(mongo.db.resident_imports.find(
+        scoped(current_society_id()), {'errors': 0, 'file_id': 0}
+    ).sort('created_at', -1).limit(10))
+    return render_template('secretary_import_residents.html', imports=imports,
+                           import_id=request.args.get('import_id'))
+
+
+@app.route('/secretary/import_residents/<import_id>/status')
+def secretary_import_status(import_id):
+    """Progress and row errors of a resident import, polled by the import page"""
+    if not is_secretary():
+        return jsonify({'error': 'Access denied'}), 403
+
+    record = import_status(mongo.db, current_society_id(), ObjectId(import_id)) \
+        if ObjectId.is_valid(import_id) else None
+    if not record:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify({
+        'id': str(record['_id']),
+        'filename': record['filename'],
+        'status': record['status'],
+        'rows': record['rows'],
+        'inserted': record['inserted'],
+        'failed': record['failed'],
+        'errors': record['errors'],
+        'message': record.get('message')
+    })
 
 
 @app.route('/secretary/delete_notice/<notice_id>')
@@ -482,7 +994,12 @@ def delete_notice(notice_id):
         flash('Access denied. Secretary privileges required.', 'error')
         return redirect(url_for('login'))
 
-    mongo.db.notices.delete_one({'_id': ObjectId(notice_id)})
+    result = mongo.db.notices.delete_one(
+        scoped(current_society_id(), {'_id': ObjectId(notice_id)}),
+        session=write_session())
+    if result.deleted_count:
+        remove_document(mongo.db, current_society_id(), 'notice', ObjectId(notice_id))
+        record_deletions(mongo.db, current_society_id(), 'notices', [ObjectId(notice_id)])
     flash('Notice deleted successfully!', 'success')
     return redirect(url_for('secretary_notices'))
 
@@ -495,21 +1012,65 @@ def delete_message(message_id):
         flash('Please login to delete messages.', 'error')
         return redirect(url_for('login'))
 
-    # Get the message to check ownership
-    message = mongo.db.messages.find_one({'_id': ObjectId(message_id)})
-    if not message:
-        flash('Message not found.', 'error')
-        return redirect(url_for('chat'))
-
-    # Allow deletion if user is secretary or if user owns the message
-    if user.get('is_secretary') or str(message['user_id']) == str(user['_id']):
-        mongo.db.messages.delete_one({'_id': ObjectId(message_id)})
+    # Ownership is part of the delete itself, so there is no separate lookup
+    query = scoped(current_society_id(), {'_id': ObjectId(message_id)})
+    if not user.get('is_secretary'):
+        query['user_id'] = user['_id']
+    if mongo.db.messages.delete_one(query, session=write_session()).deleted_count:
+        remove_document(mongo.db, current_society_id(), 'message', query['_id'])
+        record_deletions(mongo.db, current_society_id(), 'messages', [query['_id']])
         flash('Message deleted successfully!', 'success')
     else:
-        flash('Access denied. You can only delete your own messages.', 'error')
+        flash('Message not found, or you can only delete your own messages.', 'error')
 
     return redirect(url_for('chat'))
 
+
+@app.route('/secretary/moderation/messages', methods=['POST'])
+def moderate_messages():
+    """Remove chat messages in bulk by author, time window and/or ids.
+    With dry_run=1 only reports what would be removed; otherwise the purge
+    is queued for the worker and its id returned."""
+    user = get_current_user()
+    if not user or not user.get('is_secretary'):
+        return jsonify({'error': 'Access denied'}), 403
+
+    society_id = current_society_id()
+    try:
+        criteria = parse_criteria(request.form)
+        query = message_filter(society_id, **criteria)
+    except ModerationError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    if request.form.get('dry_run') == '1':
+        return jsonify(dict(preview(mongo.db, query), dry_run=True))
+    purge_id = start_purge(mongo.db, society_id, criteria, user['_id'])
+    return jsonify({'dry_run': False, 'purge_id': str(purge_id),
+                    'status_url': url_for('moderation_status', purge_id=purge_id)}), 202
+
+
+@app.route('/secretary/moderation/purges/<purge_id>')
+def moderation_status(purge_id):
+    """Progress of a queued purge, polled by the chat page"""
+    user = get_current_user()
+    if not user or not user.get('is_secretary'):
+        return jsonify({'error': 'Access denied'}), 403
+
+    record = purge_status(mongo.db, current_society_id(), ObjectId(purge_id)) \
+        if ObjectId.is_valid(purge_id) else None
+    if not record:
+        return jsonify({'error': 'Purge not found'}), 404
+    # Converted here rather than left to the API blueprint's JSON provider
+    return jsonify({
+        'id': str(record['_id']),
+        'status': record.get('status'),
+        'deleted': record.get('deleted', 0),
+        'batches': record.get('batches', 0),
+        'at': record['at'].isoformat() + 'Z' if record.get('at') else None,
+        'finished_at': record['finished_at'].isoformat() + 'Z'
+        if record.get('finished_at') else None
+    })
+
 # Error handlers
 
 
@@ -518,6 +1079,15 @@ def not_found_error(error):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    flash('Uploads are limited to %d files of %d MB each.' % (
+        UPLOAD_SETTINGS['max_files_per_request'],
+        UPLOAD_SETTINGS['max_file_size'] // (1024 * 1024)), 'error')
+    referrer = request.referrer or ''
+    return redirect(referrer if referrer.startswith(request.host_url) else url_for('index'))
+
+
 @app.errorhandler(500)
 def internal_error(error):
     return render_template('500.html'), 500
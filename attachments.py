@@ -0,0 +1,206 @@
+import io
+import logging
+import mimetypes
+
+import gridfs
+from werkzeug.wsgi import wrap_file
+from werkzeug.utils import secure_filename
+
+from changes import bump
+from config import UPLOAD_SETTINGS
+from jobs import job_handler, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'attachments'
+COPY_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+class AttachmentError(ValueError):
+    """Raised when an uploaded file is rejected"""
+
+
+def get_bucket(db):
+    return gridfs.GridFSBucket(db, bucket_name=BUCKET_NAME)
+
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+
+def allowed_file(filename):
+    return file_extension(filename) in UPLOAD_SETTINGS['allowed_extensions']
+
+
+def max_request_size():
+    """Largest request body to accept: a full set of attachments at the
+    per-file limit, plus room for the other form fields"""
+    return (UPLOAD_SETTINGS['max_files_per_request'] * UPLOAD_SETTINGS['max_file_size'] +
+            UPLOAD_SETTINGS['form_overhead'])
+
+
+def _too_large(filename):
+    return AttachmentError('%s is larger than %d MB.' % (
+        filename, UPLOAD_SETTINGS['max_file_size'] // (1024 * 1024)))
+
+
+def upload_size(file):
+    """Size of an uploaded file, which Werkzeug has already spooled"""
+    stream = file.stream
+    position = stream.tell()
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def validate_uploads(files):
+    """Check count, extensions and sizes before anything is written to GridFS"""
+    files = [f for f in files if f and f.filename]
+    if len(files) > UPLOAD_SETTINGS['max_files_per_request']:
+        raise AttachmentError('You can attach at most %d files.' %
+                              UPLOAD_SETTINGS['max_files_per_request'])
+    for file in files:
+        if not allowed_file(file.filename):
+            raise AttachmentError('%s is not an allowed file type.' % file.filename)
+        if upload_size(file) > UPLOAD_SETTINGS['max_file_size']:
+            raise _too_large(file.filename)
+    return files
+
+
+def save_attachment(db, file, request_id, user_id, society_id):
+    """Stream one uploaded file into GridFS in fixed-size chunks.
+
+    Werkzeug spools large uploads to a temporary file, so neither this copy
+    nor the upload itself holds the whole file in memory.
+    """
+    filename = secure_filename(file.filename) or 'attachment'
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    max_size = UPLOAD_SETTINGS['max_file_size']
+
+    grid_in = get_bucket(db).open_upload_stream(
+        filename,
+        metadata={'request_id': request_id, 'user_id': user_id,
+                  'society_id': society_id, 'content_type': content_type})
+    size = 0
+    try:
+        while True:
+            chunk = file.stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise _too_large(filename)
+            grid_in.write(chunk)
+    except Exception:
+        grid_in.abort()
+        raise
+    grid_in.close()
+
+    return {
+        'file_id': grid_in._id,
+        'filename': filename,
+        'content_type': content_type,
+        'length': size
+    }
+
+
+def save_attachments(db, files, request_id, user_id, society_id):
+    """Store validated uploads; on failure remove whatever was already stored"""
+    saved = []
+    try:
+        for file in files:
+            saved.append(save_attachment(db, file, request_id, user_id,
+                                         society_id))
+    except Exception:
+        bucket = get_bucket(db)
+        for attachment in saved:
+            bucket.delete(attachment['file_id'])
+        raise
+    return saved
+
+
+def enqueue_thumbnails(db, attachments):
+    """Have the worker render previews for image attachments"""
+    for attachment in attachments:
+        if file_extension(attachment['filename']) in IMAGE_EXTENSIONS:
+            enqueue_job(db, 'attachment_thumbnail',
+                        {'file_id': attachment['file_id']},
+                        dedupe_key='thumbnail:%s' % attachment['file_id'])
+
+
+def open_attachment(db, file_id):
+    """Return a seekable GridOut for the file, or None if it does not exist"""
+    try:
+        return get_bucket(db).open_download_stream(file_id)
+    except gridfs.errors.NoFile:
+        return None
+
+
+def stream_response(response_class, environ, grid_out, as_attachment=False):
+    """Build a chunked, conditional and Range-capable response for a GridFS file.
+
+    The body is read from GridFS lazily, one block at a time, and Range
+    requests seek within the file instead of reading from the start.
+    """
+    metadata = grid_out.metadata or {}
+    response = response_class(
+        wrap_file(environ, grid_out, buffer_size=COPY_CHUNK_SIZE),
+        mimetype=metadata.get('content_type', 'application/octet-stream'),
+        direct_passthrough=True)
+    response.content_length = grid_out.length
+    response.last_modified = grid_out.upload_date
+    # GridFS files are immutable, so the id is a strong validator
+    response.set_etag(str(grid_out._id))
+    response.cache_control.private = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    disposition = 'attachment' if as_attachment else 'inline'
+    response.headers['Content-Disposition'] = '%s; filename="%s"' % (
+        disposition, grid_out.filename)
+    return response.make_conditional(environ, accept_ranges=True,
+                                     complete_length=grid_out.length)
+
+
+# Job handlers
+
+
+@job_handler('attachment_thumbnail')
+def generate_thumbnail(db, job):
+    """Render a small JPEG preview of an image attachment"""
+    from PIL import Image
+
+    file_id = job['payload']['file_id']
+    grid_out = open_attachment(db, file_id)
+    if grid_out is None:
+        return
+
+    buffer = io.BytesIO()
+    try:
+        image = Image.open(grid_out)
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(buffer, 'JPEG', quality=80)
+    except (Image.DecompressionBombError, OSError) as exc:
+        # Unreadable, truncated or oversized images (UnidentifiedImageError
+        # is an OSError) will not get better on retry
+        logger.warning('Attachment %s has no thumbnail: %s', file_id, exc)
+        db.service_requests.update_one(
+            {'attachments.file_id': file_id},
+            {'$set': {'attachments.$.thumbnail_id': None}})
+        return
+    buffer.seek(0)
+
+    metadata = dict(grid_out.metadata or {}, content_type='image/jpeg',
+                    thumbnail_of=file_id)
+    thumbnail_id = get_bucket(db).upload_from_stream(
+        'thumb_%s.jpg' % file_id, buffer, metadata=metadata)
+    db.service_requests.update_one(
+        {'attachments.file_id': file_id},
+        {'$set': {'attachments.$.thumbnail_id': thumbnail_id}})
+    if metadata.get('society_id'):
+        # Cached request pages and API clients should pick up the thumbnail
+        bump(db, metadata['society_id'], 'service_requests')
@@ -0,0 +1,57 @@
+"""Change tracking for cheap revalidation and delta sync.
+
+change_versions holds one counter per society and kind of content
+({'_id': 'society|notices', 'version': n, 'updated_at': dt}), bumped on
+every write. An ETag built from these counters can be checked with a single
+_id lookup, without re-reading the content it describes.
+
+deletions keeps a tombstone per removed notice or message for
+API_SETTINGS['tombstone_days'] (TTL index), so `since=` delta queries can
+report removals as well as additions.
+"""
+from datetime import datetime, timedelta
+
+from config import API_SETTINGS
+
+KINDS = ('notices', 'messages', 'service_requests')
+
+
+def _version_id(society_id, kind):
+    return '%s|%s' % (society_id, kind)
+
+
+def bump(db, society_id, *kinds):
+    """Record that content of these kinds changed in a society"""
+    for kind in kinds:
+        db.change_versions.update_one(
+            {'_id': _version_id(society_id, kind)},
+            {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}},
+            upsert=True)
+
+
+def versions(db, society_id, kinds=KINDS):
+    """Current version of each kind (0 if it never changed)"""
+    found = {doc['_id']: doc['version'] for doc in db.change_versions.find(
+        {'_id': {'$in': [_version_id(society_id, kind) for kind in kinds]}},
+        {'version': 1})}
+    return {kind: found.get(_version_id(society_id, kind), 0) for kind in kinds}
+
+
+def record_deletions(db, society_id, kind, doc_ids):
+    """Leave tombstones for removed documents and bump the kind's version"""
+    if not doc_ids:
+        return
+    now = datetime.utcnow()
+    db.deletions.insert_many([
+        {'society_id': society_id, 'kind': kind, 'doc_id': doc_id, 'at': now}
+        for doc_id in doc_ids], ordered=False)
+    bump(db, society_id, kind)
+
+
+def deletions_since(db, society_id, kind, since):
+    """Ids removed after since, or None if since is older than the
+    tombstones go back (the client must then reload everything)"""
+    if since < datetime.utcnow() - timedelta(days=API_SETTINGS['tombstone_days']):
+        return None
+    return [doc['doc_id'] for doc in db.deletions.find(
+        {'society_id': society_id, 'kind': kind, 'at': {'$gt': since}}, {'doc_id': 1})]
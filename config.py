@@ -21,13 +21,16 @@ class Config:
     UPLOAD_FOLDER = 'uploads'
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx'}
 
-    # Email Configuration (for future use)
+    # Email Configuration (used by the background worker)
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'true').lower() in [
         'true', 'on', '1']
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get(
+        'MAIL_DEFAULT_SENDER') or 'noreply@community.local'
+    MAIL_TIMEOUT = int(os.environ.get('MAIL_TIMEOUT') or 30)
 
     # Pagination
     NOTICES_PER_PAGE = 10
@@ -41,6 +44,8 @@ class Config:
     # Application Settings
     APP_NAME = 'Hyperlocal Community Platform'
     APP_VERSION = '1.0.0'
+    # Base of links in emails sent by the worker, which has no request to go by
+    APP_URL = os.environ.get('APP_URL') or 'http://localhost:5000'
     DEBUG = False
     TESTING = False
 
@@ -155,14 +160,19 @@ UPLOAD_SETTINGS = {
     'max_file_size': 16 * 1024 * 1024,  # 16MB
     'allowed_extensions': {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx'},
     'upload_folder': 'uploads',
-    'max_files_per_request': 5
+    'max_files_per_request': 5,
+    'form_overhead': 1024 * 1024  # the other fields of a form with uploads
 }
 
 # Notification settings
 NOTIFICATION_SETTINGS = {
     'email_notifications': True,
     'push_notifications': False,  # For future implementation
-    'notification_retention_days': 30
+    'notification_retention_days': 30,
+    'stream_poll_seconds': 2,
+    'stream_keepalive_seconds': 15,
+    'stream_max_seconds': 300,
+    'stream_retry_seconds': 5
 }
 
 # Chat settings
@@ -170,7 +180,10 @@ CHAT_SETTINGS = {
     'max_message_length': 1000,
     'message_retention_days': 90,
     'max_messages_per_user_per_minute': 10,
-    'profanity_filter': True
+    'profanity_filter': True,
+    'profanity_wordlist': os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'profanity_words.txt'),
+    'profanity_reload_seconds': 30
 }
 
 # Security settings
@@ -182,6 +195,121 @@ SECURITY_SETTINGS = {
     'lockout_duration_minutes': 15
 }
 
-# Default resident credentials
+# Default resident account
 DEFAULT_RESIDENT_EMAIL = "resident@example.com"
-DEFAULT_RESIDENT_PASSWORD = "Welcome@123"
\ No newline at end of file
+
+# Background job settings
+JOB_SETTINGS = {
+    'poll_interval_seconds': 2,
+    'lease_seconds': 300,
+    'reap_interval_seconds': 60,
+    'max_attempts': 5,
+    'backoff_base_seconds': 30,
+    'backoff_max_seconds': 3600,
+    'completed_retention_days': 7,
+    'email_batch_size': 50
+}
+
+# Multi-society tenancy settings
+TENANCY_SETTINGS = {
+    'default_society_id': os.environ.get('DEFAULT_SOCIETY_ID') or 'default',
+    'society_id_max_length': 40,
+    'invite_code_bytes': 4,
+    # Single-society deployments may let residents register without an
+    # invite code; they then join the default society
+    'open_registration': os.environ.get('OPEN_REGISTRATION', 'false').lower() in ['true', 'on', '1']
+}
+
+# Read preference routing: these endpoints read from secondaries
+READ_PREFERENCE_SETTINGS = {
+    'enabled': os.environ.get('READ_FROM_SECONDARIES', 'true').lower() in [
+        'true', 'on', '1'],
+    'max_staleness_seconds': 90,  # MongoDB's minimum allowed bound
+    'secondary_endpoints': {
+        'dashboard', 'notices', 'service_requests', 'chat',
+        'secretary_dashboard', 'secretary_notices', 'secretary_requests',
+        'secretary_users', 'secretary_analytics', 'search'
+    }
+}
+
+# Full-text search over notices and chat
+SEARCH_SETTINGS = {
+    'results_per_page': 20,
+    'max_query_terms': 8,
+    'max_query_length': 200,
+    # Candidates read per query term, highest impact first; bounds the work
+    # of a query on a very common word
+    'max_postings_per_term': 1000
+}
+
+# Render-on-write HTML and display times (see rendering.py); an IANA zone
+# name such as 'Asia/Kolkata'
+RENDER_SETTINGS = {
+    'timezone': os.environ.get('DISPLAY_TIMEZONE') or 'UTC'
+}
+
+# Bulk resident CSV import
+IMPORT_SETTINGS = {
+    'max_file_size': 5 * 1024 * 1024,  # 5MB, roughly 50,000 rows
+    'batch_size': 500,
+    'hash_processes': None,  # None = one per CPU
+    'max_reported_errors': 200,
+    # Residents imported without a password are emailed a one-time link
+    'password_link_hours': 72
+}
+
+# Chat presence (who is online / typing), kept in memory, never in MongoDB.
+# 'local' serves one web worker; 'redis' keeps several workers' copies in
+# step over Redis pub/sub
+PRESENCE_SETTINGS = {
+    'backend': os.environ.get('PRESENCE_BACKEND') or 'local',
+    'redis_url': os.environ.get('REDIS_URL') or 'redis://localhost:6379/0',
+    'heartbeat_seconds': 20,
+    'online_ttl_seconds': 50,  # a little over two missed heartbeats
+    'typing_ttl_seconds': 6,
+    'typing_throttle_seconds': 3,
+    'max_listed': 50,  # names sent to the browser; the online count is exact
+    'sweep_interval_seconds': 1,
+    'broadcast_interval_seconds': 0.5,
+    'stream_keepalive_seconds': 15,
+    'stream_max_seconds': 300,
+    'stream_retry_seconds': 5
+}
+
+# Sampled request profiling (cProfile + tracemalloc), off unless enabled
+PROFILING_SETTINGS = {
+    'enabled': os.environ.get('PROFILE_REQUESTS', 'false').lower() in ['true', 'on', '1'],
+    'sample_rate': float(os.environ.get('PROFILE_SAMPLE_RATE') or 0.01),
+    'tracemalloc': True,
+    # Deep enough to get from pymongo/bson back to the route that called them
+    'traceback_frames': 25,
+    'top_sites': 10,
+    'top_functions': 15,
+    'dump_dir': os.environ.get('PROFILE_DUMP_DIR')
+}
+
+# Service request triage score and queue
+TRIAGE_SETTINGS = {
+    'priority_weights': {'urgent': 1000, 'high': 300, 'medium': 100, 'low': 30},
+    'age_points_per_hour': 2,
+    'max_age_hours': 14 * 24,
+    'refresh_minutes': 15,
+    'queue_size': 10,
+    'max_queue_size': 50
+}
+
+# Bulk chat moderation
+MODERATION_SETTINGS = {
+    'batch_size': 500,
+    'batch_pause_seconds': 0.05,
+    'max_ids': 1000
+}
+
+# Mobile JSON API (/api/v1)
+API_SETTINGS = {
+    'token_max_age_seconds': 30 * 24 * 3600,
+    'page_size': 50,
+    'max_page_size': 200,
+    'since_overlap_seconds': 5,  # next_since lags a little so slow inserts are not missed
+    'tombstone_days': 30
+}
@@ -154,7 +154,8 @@ def validate_password_strength(form, field):
             'Password must contain both letters and numbers.')
 
 
-# Add custom validators to forms
-RegistrationForm.apartment.validators.append(validate_apartment_format)
-RegistrationForm.password.validators.append(validate_password_strength)
-ChangePasswordForm.new_password.validators.append(validate_password_strength)
+# Add custom validators to forms. Class attributes are still unbound
+# fields here, so extend the validators they will be bound with.
+RegistrationForm.apartment.kwargs['validators'].append(validate_apartment_format)
+RegistrationForm.password.kwargs['validators'].append(validate_password_strength)
+ChangePasswordForm.new_password.kwargs['validators'].append(validate_password_strength)
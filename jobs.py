@@ -0,0 +1,186 @@
+import logging
+import os
+import random
+import socket
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from config import JOB_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Registry of job kind -> handler(db, job)
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register a function as the handler for a job kind"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def _new_job(kind, payload, run_at=None, max_attempts=None, dedupe_key=None):
+    now = datetime.utcnow()
+    job = {
+        'kind': kind,
+        'payload': payload,
+        'status': 'queued',
+        'attempts': 0,
+        'max_attempts': max_attempts or JOB_SETTINGS['max_attempts'],
+        'run_at': run_at or now,
+        'locked_by': None,
+        'locked_until': None,
+        'last_error': None,
+        'created_at': now
+    }
+    if dedupe_key:
+        job['dedupe_key'] = dedupe_key
+    return job
+
+
+def enqueue_job(db, kind, payload, run_at=None, max_attempts=None, dedupe_key=None):
+    """Add a job to the queue. Returns the job id, or None if a job with the
+    same dedupe_key is already queued or recently finished."""
+    job = _new_job(kind, payload, run_at, max_attempts, dedupe_key)
+    try:
+        return db.jobs.insert_one(job).inserted_id
+    except DuplicateKeyError:
+        return None
+
+
+def enqueue_jobs(db, kind, payloads, dedupe_keys=None):
+    """Add many jobs of one kind in a single unordered insert_many"""
+    if not payloads:
+        return 0
+    keys = dedupe_keys or [None] * len(payloads)
+    jobs = [_new_job(kind, payload, dedupe_key=key)
+            for payload, key in zip(payloads, keys)]
+    try:
+        return len(db.jobs.insert_many(jobs, ordered=False).inserted_ids)
+    except BulkWriteError as exc:
+        # Duplicates are jobs already enqueued by an earlier attempt
+        return exc.details.get('nInserted', 0)
+
+
+def claim_job(db, worker_id, kinds=None):
+    """Atomically lease the next due job for this worker"""
+    now = datetime.utcnow()
+    query = {'status': 'queued', 'run_at': {'$lte': now}}
+    if kinds:
+        query['kind'] = {'$in': list(kinds)}
+
+    return db.jobs.find_one_and_update(
+        query,
+        {'$set': {
+            'status': 'running',
+            'locked_by': worker_id,
+            'locked_until': now + timedelta(seconds=JOB_SETTINGS['lease_seconds']),
+            'started_at': now
+        },
+            '$inc': {'attempts': 1}},
+        sort=[('run_at', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def complete_job(db, job):
+    """Mark a leased job as done; finished jobs expire via a TTL index"""
+    db.jobs.update_one(
+        {'_id': job['_id'], 'locked_by': job['locked_by']},
+        {'$set': {
+            'status': 'done',
+            'locked_by': None,
+            'locked_until': None,
+            'finished_at': datetime.utcnow()
+        }}
+    )
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at backoff_max_seconds"""
+    delay = JOB_SETTINGS['backoff_base_seconds'] * (2 ** (attempts - 1))
+    delay = min(delay, JOB_SETTINGS['backoff_max_seconds'])
+    return delay * random.uniform(0.8, 1.2)
+
+
+def fail_job(db, job, error):
+    """Reschedule a failed job, or move it to dead_jobs once out of attempts"""
+    now = datetime.utcnow()
+    if job['attempts'] >= job['max_attempts']:
+        dead = dict(job, status='dead', last_error=error, failed_at=now,
+                    locked_by=None, locked_until=None)
+        db.dead_jobs.replace_one({'_id': job['_id']}, dead, upsert=True)
+        db.jobs.delete_one({'_id': job['_id'], 'locked_by': job['locked_by']})
+        logger.error('Job %s (%s) moved to dead_jobs: %s',
+                     job['_id'], job['kind'], error)
+        return
+
+    db.jobs.update_one(
+        {'_id': job['_id'], 'locked_by': job['locked_by']},
+        {'$set': {
+            'status': 'queued',
+            'locked_by': None,
+            'locked_until': None,
+            'last_error': error,
+            'run_at': now + timedelta(seconds=retry_delay(job['attempts']))
+        }}
+    )
+
+
+def requeue_expired(db):
+    """Return jobs whose worker died mid-run (lease expired) to the queue"""
+    result = db.jobs.update_many(
+        {'status': 'running', 'locked_until': {'$lt': datetime.utcnow()}},
+        {'$set': {'status': 'queued', 'locked_by': None, 'locked_until': None,
+                  'last_error': 'lease expired'}}
+    )
+    return result.modified_count
+
+
+def run_job(db, job):
+    """Dispatch a claimed job to its handler and record the outcome"""
+    handler = HANDLERS.get(job['kind'])
+    if handler is None:
+        job['attempts'] = job['max_attempts']
+        fail_job(db, job, 'no handler for job kind %r' % job['kind'])
+        return False
+
+    if job['attempts'] > job['max_attempts']:
+        # Only reachable when earlier runs died without reporting (lease expiry)
+        fail_job(db, job, job.get('last_error') or 'too many attempts')
+        return False
+
+    try:
+        handler(db, job)
+    except Exception as exc:
+        logger.exception('Job %s (%s) failed', job['_id'], job['kind'])
+        fail_job(db, job, '%s: %s' % (type(exc).__name__, exc))
+        return False
+
+    complete_job(db, job)
+    return True
+
+
+def run_worker(db, worker_id=None, kinds=None, once=False):
+    """Claim and run jobs until interrupted (or until the queue is empty if once=True)"""
+    worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+    logger.info('Worker %s started', worker_id)
+    last_reap = 0
+
+    while True:
+        if time.monotonic() - last_reap > JOB_SETTINGS['reap_interval_seconds']:
+            requeue_expired(db)
+            last_reap = time.monotonic()
+
+        job = claim_job(db, worker_id, kinds)
+        if job is None:
+            if once:
+                return
+            time.sleep(JOB_SETTINGS['poll_interval_seconds'])
+            continue
+        run_job(db, job)
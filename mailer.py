@@ -0,0 +1,103 @@
+import logging
+import smtplib
+from email.message import EmailMessage
+
+from config import get_config, JOB_SETTINGS, PRIORITY_LEVELS
+from jobs import job_handler, enqueue_jobs
+from tenancy import scoped
+
+logger = logging.getLogger(__name__)
+
+
+def send_batch(messages, settings=None):
+    """Send a batch of messages over a single SMTP session.
+
+    Returns the list of recipient addresses the server refused. If the
+    session breaks part-way through, the raised exception carries a ``sent``
+    attribute with the number of messages already handed to the server.
+    """
+    settings = settings or get_config()
+    refused = []
+    sent = 0
+    try:
+        with smtplib.SMTP(settings.MAIL_SERVER, settings.MAIL_PORT,
+                          timeout=settings.MAIL_TIMEOUT) as smtp:
+            if settings.MAIL_USE_TLS:
+                smtp.starttls()
+            if settings.MAIL_USERNAME:
+                smtp.login(settings.MAIL_USERNAME, settings.MAIL_PASSWORD)
+            for message in messages:
+                try:
+                    smtp.send_message(message)
+                except smtplib.SMTPRecipientsRefused as exc:
+                    refused.extend(exc.recipients)
+                sent += 1
+    except (smtplib.SMTPException, OSError) as exc:
+        exc.sent = sent
+        raise
+    return refused
+
+
+def build_notice_email(notice, recipient, sender):
+    """Build the plain-text email announcing a notice"""
+    priority = PRIORITY_LEVELS.get(notice.get('priority'), {})
+    label = priority.get('label', 'Notice')
+
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = recipient
+    message['Subject'] = '[%s] %s' % (label, notice.get('title') or 'New notice')
+    message.set_content('%s\n\n%s\n\n-- \nSociety Secretary' % (
+        notice.get('title') or '', notice.get('content') or ''))
+    return message
+
+
+# Job handlers
+
+
+@job_handler('notice_fanout')
+def fan_out_notice(db, job):
+    """Split the society's resident list into email batches, one job per batch"""
+    notice_id = job['payload']['notice_id']
+    users = db.users.find(
+        scoped(job['payload']['society_id'],
+               {'is_secretary': False, 'email': {'$nin': [None, '']}}),
+        {'email': 1}).sort('_id', 1)
+    emails = [user['email'] for user in users]
+
+    size = JOB_SETTINGS['email_batch_size']
+    batches = [emails[i:i + size] for i in range(0, len(emails), size)]
+    payloads = [{'notice_id': notice_id, 'recipients': batch}
+                for batch in batches]
+    keys = ['notice_email:%s:%d' % (notice_id, i) for i in range(len(batches))]
+    enqueue_jobs(db, 'notice_email_batch', payloads, dedupe_keys=keys)
+
+
+@job_handler('notice_email_batch')
+def send_notice_batch(db, job):
+    """Email one batch of residents about a notice over a single connection"""
+    payload = job['payload']
+    notice = db.notices.find_one({'_id': payload['notice_id']})
+    if not notice:
+        # Notice was deleted before delivery
+        return
+
+    settings = get_config()
+    recipients = payload['recipients']
+    messages = [build_notice_email(notice, recipient, settings.MAIL_DEFAULT_SENDER)
+                for recipient in recipients]
+    try:
+        refused = send_batch(messages, settings)
+    except (smtplib.SMTPException, OSError) as exc:
+        remaining = recipients[getattr(exc, 'sent', 0):]
+        if not remaining:
+            # Everything was delivered; only the closing QUIT failed
+            return
+        # Retry only the recipients that were not reached yet
+        db.jobs.update_one({'_id': job['_id']},
+                           {'$set': {'payload.recipients': remaining}})
+        raise
+
+    if refused:
+        logger.warning('Notice %s: server refused %d recipient(s): %s',
+                       payload['notice_id'], len(refused), ', '.join(refused))
@@ -1,15 +1,22 @@
 from datetime import datetime
 from bson import ObjectId
 
+from analytics import create_rollup_indexes
+from search import create_search_indexes
+from config import JOB_SETTINGS, API_SETTINGS
+from tenancy import DEFAULT_SOCIETY_ID
+
 
 class User:
-    def __init__(self, name, email, apartment, password, is_secretary=False, is_admin=False):
+    def __init__(self, name, email, apartment, password, is_secretary=False, is_admin=False,
+                 society_id=DEFAULT_SOCIETY_ID):
         self.name = name
         self.email = email
         self.apartment = apartment
         self.password = password
         self.is_secretary = is_secretary
         self.is_admin = is_admin
+        self.society_id = society_id
         self.created_at = datetime.utcnow()
 
     def to_dict(self):
@@ -20,15 +27,17 @@ class User:
             'password': self.password,
             'is_secretary': self.is_secretary,
             'is_admin': self.is_admin,
+            'society_id': self.society_id,
             'created_at': self.created_at
         }
 
 
 class Notice:
-    def __init__(self, title, content, priority):
+    def __init__(self, title, content, priority, society_id=DEFAULT_SOCIETY_ID):
         self.title = title
         self.content = content
         self.priority = priority  # urgent, high, medium, low
+        self.society_id = society_id
         self.created_at = datetime.utcnow()
 
     def to_dict(self):
@@ -36,12 +45,14 @@ class Notice:
             'title': self.title,
             'content': self.content,
             'priority': self.priority,
+            'society_id': self.society_id,
             'created_at': self.created_at
         }
 
 
 class ServiceRequest:
-    def __init__(self, title, description, category, priority, user_id, user_name, apartment):
+    def __init__(self, title, description, category, priority, user_id, user_name, apartment,
+                 society_id=DEFAULT_SOCIETY_ID):
         self.title = title
         self.description = description
         self.category = category  # plumbing, electrical, carpentry, cleaning, security, other
@@ -50,6 +61,7 @@ class ServiceRequest:
         self.user_id = user_id
         self.user_name = user_name
         self.apartment = apartment
+        self.society_id = society_id
         self.created_at = datetime.utcnow()
 
     def to_dict(self):
@@ -62,15 +74,17 @@ class ServiceRequest:
             'user_id': self.user_id,
             'user_name': self.user_name,
             'apartment': self.apartment,
+            'society_id': self.society_id,
             'created_at': self.created_at
         }
 
 
 class ChatMessage:
-    def __init__(self, content, user_id, user_name):
+    def __init__(self, content, user_id, user_name, society_id=DEFAULT_SOCIETY_ID):
         self.content = content
         self.user_id = user_id
         self.user_name = user_name
+        self.society_id = society_id
         self.created_at = datetime.utcnow()
 
     def to_dict(self):
@@ -78,6 +92,7 @@ class ChatMessage:
             'content': self.content,
             'user_id': self.user_id,
             'user_name': self.user_name,
+            'society_id': self.society_id,
             'created_at': self.created_at
         }
 
@@ -86,23 +101,63 @@ class ChatMessage:
 
 def create_indexes(db):
     """Create database indexes for better performance"""
-    # Users collection indexes
-    db.users.create_index('email', unique=True)
-    db.users.create_index('apartment')
+    # Every tenant collection is prefixed by society_id; the
+    # (society_id, _id) index is the shard key candidate for each of them.
+    for name in ('users', 'notices', 'service_requests', 'messages'):
+        db[name].create_index([('society_id', 1), ('_id', 1)])
+
+    # Users collection indexes. Email is unique across societies too, but a
+    # sharded users collection cannot enforce that; tenancy.claim_email does,
+    # through user_emails (keyed by the address)
+    db.users.create_index([('society_id', 1), ('email', 1)], unique=True)
+    db.societies.create_index('invite_code', unique=True)
+    db.users.create_index([('society_id', 1), ('is_secretary', 1), ('created_at', -1)])
+    db.users.create_index([('society_id', 1), ('apartment', 1)])
 
     # Notices collection indexes
-    db.notices.create_index('created_at')
-    db.notices.create_index('priority')
+    db.notices.create_index([('society_id', 1), ('created_at', -1)])
 
     # Service requests collection indexes
-    db.service_requests.create_index('user_id')
-    db.service_requests.create_index('status')
-    db.service_requests.create_index('created_at')
-    db.service_requests.create_index('category')
+    db.service_requests.create_index([('society_id', 1), ('user_id', 1), ('created_at', -1)])
+    # Triage queue: top pending requests by score in one range scan
+    db.service_requests.create_index([('society_id', 1), ('status', 1), ('triage_score', -1)])
+    db.service_requests.create_index([('society_id', 1), ('created_at', -1)])
+    # API polls with since= page by change time
+    db.service_requests.create_index([('society_id', 1), ('status_changed_at', 1), ('_id', 1)])
+    db.service_requests.create_index(
+        [('society_id', 1), ('user_id', 1), ('status_changed_at', 1), ('_id', 1)])
+    db.service_requests.create_index('attachments.file_id', sparse=True)
 
     # Messages collection indexes
-    db.messages.create_index('created_at')
-    db.messages.create_index('user_id')
+    db.messages.create_index([('society_id', 1), ('created_at', -1)])
+    db.messages.create_index([('society_id', 1), ('user_id', 1)])
+
+    create_rollup_indexes(db.request_rollups)
+
+    # Unread counter indexes (the event stream polls by updated_at)
+    db.user_counters.create_index('updated_at')
+    db.user_counters.create_index('society_id')
+
+    # Resident CSV imports are listed per society, newest first
+    db.resident_imports.create_index([('society_id', 1), ('created_at', -1)])
+
+    # Background job queue indexes
+    db.jobs.create_index([('status', 1), ('run_at', 1)])
+    db.jobs.create_index([('status', 1), ('locked_until', 1)])
+    db.jobs.create_index('dedupe_key', unique=True,
+                         partialFilterExpression={'dedupe_key': {'$type': 'string'}})
+    db.jobs.create_index('finished_at', expireAfterSeconds=JOB_SETTINGS[
+        'completed_retention_days'] * 24 * 3600)
+    db.dead_jobs.create_index('failed_at')
+
+    # Deletion tombstones for API delta queries, expired after tombstone_days
+    db.deletions.create_index([('society_id', 1), ('kind', 1), ('at', 1)])
+    db.deletions.create_index('at', expireAfterSeconds=API_SETTINGS['tombstone_days'] * 24 * 3600)
+
+    # Moderation audit trail, newest first per society
+    db.moderation_log.create_index([('society_id', 1), ('at', -1)])
+
+    create_search_indexes(db.search_postings)
 
 
 def get_priority_color(priority):
@@ -0,0 +1,170 @@
+"""Bulk chat moderation.
+
+A secretary can remove a society's messages by author, by time window, by
+an explicit list of ids, or any combination. Matching messages are deleted
+in batches of at most batch_size ids, with a short pause in between, so a
+large purge never holds one long delete on the collection. Each batch also
+drops its messages from the search index and leaves deletion tombstones
+for API clients. A dry run only counts what would go and answers within
+the request; a real purge is recorded in moderation_log and run by the
+'moderation_purge' job in worker.py, which keeps the entry's status and
+counts current for the secretary's page to poll.
+"""
+import logging
+import time
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from changes import record_deletions
+from config import MODERATION_SETTINGS
+from jobs import job_handler, enqueue_job
+from search import remove_documents
+from tenancy import scoped
+
+logger = logging.getLogger(__name__)
+
+
+class ModerationError(ValueError):
+    """Raised when a moderation request has no or invalid criteria"""
+
+
+def parse_ids(text):
+    """ObjectIds from a comma or whitespace separated list"""
+    try:
+        return [ObjectId(part) for part in (text or '').replace(',', ' ').split()]
+    except InvalidId as exc:
+        raise ModerationError('Invalid id: %s' % exc)
+
+
+def parse_local_datetime(text):
+    """A datetime-local form value (server local time, as the chat shows it)
+    as naive UTC, the way created_at is stored"""
+    if not text:
+        return None
+    try:
+        local = datetime.fromisoformat(text)
+    except ValueError:
+        raise ModerationError('Invalid date and time: %s' % text)
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def parse_criteria(form):
+    """Moderation criteria from a submitted form"""
+    author_ids = parse_ids(form.get('author_id'))
+    return {
+        'author_id': author_ids[0] if author_ids else None,
+        'since': parse_local_datetime(form.get('since')),
+        'until': parse_local_datetime(form.get('until')),
+        'message_ids': parse_ids(form.get('message_ids'))
+    }
+
+
+def message_filter(society_id, author_id=None, since=None, until=None, message_ids=None):
+    """Query for the society's messages matching every given criterion"""
+    query = {}
+    if author_id is not None:
+        query['user_id'] = author_id
+    if since is not None or until is not None:
+        query['created_at'] = {}
+        if since is not None:
+            query['created_at']['$gte'] = since
+        if until is not None:
+            query['created_at']['$lt'] = until
+    if message_ids:
+        if len(message_ids) > MODERATION_SETTINGS['max_ids']:
+            raise ModerationError('At most %d message ids at a time.' %
+                                  MODERATION_SETTINGS['max_ids'])
+        query['_id'] = {'$in': message_ids}
+    if not query:
+        # Never let an empty form mean "every message"
+        raise ModerationError('Choose an author, a time window or message ids.')
+    return scoped(society_id, query)
+
+
+def preview(db, query, sample_size=5):
+    """How many messages a purge would remove, by author, with a few examples"""
+    authors = list(db.messages.aggregate([
+        {'$match': query},
+        {'$group': {'_id': '$user_name', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}]))
+    sample = list(db.messages.find(query, {'user_name': 1, 'content': 1, 'created_at': 1})
+                  .sort('created_at', -1).limit(sample_size))
+    return {
+        'matched': sum(author['count'] for author in authors),
+        'authors': [{'name': author['_id'] or 'Unknown', 'count': author['count']}
+                    for author in authors[:10]],
+        'sample': [{'id': str(m['_id']), 'author': m.get('user_name'),
+                    'content': (m.get('content') or '')[:120],
+                    'created_at': m['created_at'].isoformat() + 'Z' if m.get('created_at') else None}
+                   for m in sample]
+    }
+
+
+def purge(db, society_id, query, batch_size=None, log_id=None):
+    """Delete matching messages in bounded batches; returns counts.
+
+    With log_id, each batch adds its counts to that moderation_log entry.
+    """
+    batch_size = batch_size or MODERATION_SETTINGS['batch_size']
+    deleted = 0
+    batches = 0
+    while True:
+        ids = [m['_id'] for m in db.messages.find(query, {'_id': 1}).limit(batch_size)]
+        if not ids:
+            break
+        result = db.messages.delete_many(scoped(society_id, {'_id': {'$in': ids}}))
+        remove_documents(db, society_id, 'message', ids)
+        record_deletions(db, society_id, 'messages', ids)
+        deleted += result.deleted_count
+        batches += 1
+        if log_id is not None:
+            db.moderation_log.update_one(
+                {'_id': log_id},
+                {'$inc': {'deleted': result.deleted_count, 'batches': 1}})
+        if len(ids) < batch_size:
+            break
+        time.sleep(MODERATION_SETTINGS['batch_pause_seconds'])
+    return {'deleted': deleted, 'batches': batches}
+
+
+def start_purge(db, society_id, criteria, moderator_id):
+    """Record a purge in moderation_log and queue it; returns the entry's id"""
+    purge_id = db.moderation_log.insert_one({
+        'society_id': society_id,
+        'moderator_id': moderator_id,
+        'criteria': criteria,
+        'status': 'queued',
+        'deleted': 0,
+        'batches': 0,
+        'at': datetime.utcnow()
+    }).inserted_id
+    enqueue_job(db, 'moderation_purge', {'purge_id': purge_id},
+                dedupe_key='moderation_purge:%s' % purge_id)
+    return purge_id
+
+
+def purge_status(db, society_id, purge_id):
+    """The progress of one of the society's purges, or None"""
+    return db.moderation_log.find_one(
+        {'_id': purge_id, 'society_id': society_id},
+        {'status': 1, 'deleted': 1, 'batches': 1, 'at': 1, 'finished_at': 1})
+
+
+# Job handlers
+
+
+@job_handler('moderation_purge')
+def run_purge(db, job):
+    """Carry out a queued purge; a retry deletes whatever still matches"""
+    record = db.moderation_log.find_one({'_id': job['payload']['purge_id']})
+    if not record or record.get('status') == 'done':
+        return
+    db.moderation_log.update_one({'_id': record['_id']},
+                                 {'$set': {'status': 'running', 'started_at': datetime.utcnow()}})
+    query = message_filter(record['society_id'], **record['criteria'])
+    result = purge(db, record['society_id'], query, log_id=record['_id'])
+    db.moderation_log.update_one({'_id': record['_id']},
+                                 {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}})
+    logger.info('Purge %s removed %d message(s)', record['_id'], result['deleted'])
@@ -0,0 +1,182 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import NOTIFICATION_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Unread counters kept per user in the user_counters collection:
+#   {'_id': user_id, 'society_id', 'notices': n, 'requests': n, 'version': n,
+#    'notices_seen_at': dt, 'requests_seen_at': dt, 'updated_at': dt}
+# version only ever increases, so streams can tell new counts from stale ones.
+
+
+def get_counts(db, user_id, society_id):
+    """Return a user's unread counts and the counter version"""
+    doc = db.user_counters.find_one(
+        {'_id': user_id}, {'notices': 1, 'requests': 1, 'version': 1})
+    if doc is None:
+        # Create the counter so later update_many fan-outs include this user
+        db.user_counters.update_one(
+            {'_id': user_id},
+            {'$setOnInsert': {'society_id': society_id, 'notices': 0,
+                              'requests': 0, 'version': 0},
+             '$currentDate': {'updated_at': True}},
+            upsert=True)
+        doc = {}
+    return {
+        'notices': doc.get('notices', 0),
+        'requests': doc.get('requests', 0),
+        'version': doc.get('version', 0)
+    }
+
+
+def notify_notice_posted(db, society_id, author_id):
+    """Bump the unread notice count of every user in the society except the author"""
+    db.user_counters.update_many(
+        {'society_id': society_id, '_id': {'$ne': author_id}},
+        {'$inc': {'notices': 1, 'version': 1},
+         '$currentDate': {'updated_at': True}})
+
+
+def notify_request_updated(db, society_id, user_id):
+    """Bump the unread request count of the resident who owns a request"""
+    db.user_counters.update_one(
+        {'_id': user_id},
+        {'$inc': {'requests': 1, 'version': 1},
+         '$setOnInsert': {'society_id': society_id},
+         '$currentDate': {'updated_at': True}},
+        upsert=True)
+
+
+def mark_seen(db, user_id, field):
+    """Clear one unread counter and record when the user caught up.
+
+    Only writes when there was something unread, so ordinary page views
+    stay read-only.
+    """
+    db.user_counters.update_one(
+        {'_id': user_id, field: {'$gt': 0}},
+        {'$set': {field: 0, field + '_seen_at': datetime.utcnow()},
+         '$inc': {'version': 1},
+         '$currentDate': {'updated_at': True}})
+
+
+class CounterWatcher:
+    """Watch user_counters for changes with one query per interval per process.
+
+    Open event streams wait on a shared condition instead of each querying
+    MongoDB, so the database load does not grow with the number of
+    connected residents. Counts are kept only for users with an open
+    stream and dropped when their last stream closes.
+    """
+
+    def __init__(self, db, interval):
+        self.db = db
+        self.interval = interval
+        self.counts = {}
+        self.subscribers = {}  # user_id -> number of open streams
+        self.condition = threading.Condition()
+        self.since = datetime.utcnow() - timedelta(seconds=interval)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._poll()
+            except Exception:
+                logger.exception('Polling user_counters failed')
+            time.sleep(self.interval)
+
+    def _poll(self):
+        changed = list(self.db.user_counters.find(
+            {'updated_at': {'$gte': self.since}},
+            {'notices': 1, 'requests': 1, 'version': 1, 'updated_at': 1}))
+        if not changed:
+            return
+        self.since = max(doc['updated_at'] for doc in changed)
+        with self.condition:
+            for doc in changed:
+                if doc['_id'] not in self.subscribers:
+                    continue
+                self.counts[doc['_id']] = {
+                    'notices': doc.get('notices', 0),
+                    'requests': doc.get('requests', 0),
+                    'version': doc.get('version', 0)
+                }
+            self.condition.notify_all()
+
+    def subscribe(self, user_id):
+        with self.condition:
+            self.subscribers[user_id] = self.subscribers.get(user_id, 0) + 1
+
+    def unsubscribe(self, user_id):
+        with self.condition:
+            remaining = self.subscribers.get(user_id, 0) - 1
+            if remaining > 0:
+                self.subscribers[user_id] = remaining
+            else:
+                self.subscribers.pop(user_id, None)
+                self.counts.pop(user_id, None)
+
+    def wait(self, user_id, version, timeout):
+        """Block until the user's counters move past version, or timeout.
+        Returns the new counts, or None on timeout."""
+        def changed():
+            counts = self.counts.get(user_id)
+            return counts if counts and counts['version'] > version else None
+
+        with self.condition:
+            return self.condition.wait_for(changed, timeout)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher(db):
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = CounterWatcher(
+                db, NOTIFICATION_SETTINGS['stream_poll_seconds'])
+    return _watcher
+
+
+def stream_counts(db, user_id, society_id, last_version=None):
+    """Server-sent events generator pushing count updates for one user.
+
+    The stream closes after stream_max_seconds; EventSource reconnects on
+    its own and sends Last-Event-ID so no update is missed.
+    """
+    watcher = get_watcher(db)
+    deadline = time.monotonic() + NOTIFICATION_SETTINGS['stream_max_seconds']
+    keepalive = NOTIFICATION_SETTINGS['stream_keepalive_seconds']
+
+    # Subscribe before reading the counts so no change falls in between
+    watcher.subscribe(user_id)
+    try:
+        counts = get_counts(db, user_id, society_id)
+        yield 'retry: %d\n\n' % (NOTIFICATION_SETTINGS['stream_retry_seconds'] * 1000)
+        if counts['version'] != last_version:
+            yield 'id: %d\nevent: counts\ndata: %s\n\n' % (
+                counts['version'], json.dumps(counts))
+        version = counts['version']
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            counts = watcher.wait(user_id, version, min(keepalive, remaining))
+            if counts is None:
+                yield ': keepalive\n\n'
+                continue
+            version = counts['version']
+            yield 'id: %d\nevent: counts\ndata: %s\n\n' % (version, json.dumps(counts))
+    finally:
+        # Runs on timeout and when the client disconnects (generator closed)
+        watcher.unsubscribe(user_id)
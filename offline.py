@@ -0,0 +1,57 @@
+"""Server side of the installable, offline-capable web app.
+
+static/sw.js serves the dashboard, notices, service requests and chat
+pages stale-while-revalidate: the cached copy is shown at once and
+refreshed in the background with If-None-Match. These pages get an ETag
+built from the asset version, the user, their unread-counter version and
+the society's change versions (changes.py), so that refresh usually costs
+a few _id lookups and a bodyless 304 instead of queries and rendering.
+"""
+import hashlib
+import os
+
+from flask import current_app, make_response, request, session
+
+from changes import versions
+from notifications import get_counts
+
+
+def asset_version(root, folders=('templates', 'static')):
+    """Hash of the templates and static files. A deploy that changes any of
+    them changes every page ETag and the service worker's cache names."""
+    digest = hashlib.sha1()
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, root).encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def page_etag(db, user, society_id, version, *kinds):
+    """ETag of a page that shows only this user, their unread counts and
+    society content of these kinds. None while the page would show flashed
+    messages, which must be neither cached nor skipped."""
+    if session.get('_flashes'):
+        return None
+    key = repr((request.endpoint, version, str(user['_id']), user.get('name'),
+                user.get('apartment'), user.get('is_secretary'),
+                get_counts(db, user['_id'], society_id)['version'],
+                sorted(versions(db, society_id, kinds).items())))
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def conditional_page(etag, render):
+    """304 if the client already holds etag, otherwise render() the page"""
+    if etag and etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    if etag:
+        response.set_etag(etag)
+        # Always revalidate; the 304 is what keeps that cheap
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,345 @@
+"""Chat presence: who is online and who is typing.
+
+Browsers on the chat page send a heartbeat every heartbeat_seconds (and a
+typing flag while the user types); entries expire after online_ttl_seconds
+/ typing_ttl_seconds. Heartbeats that do not change what others see (an
+online user staying online) only refresh a timestamp, so only joins, leaves
+and typing changes bump the society's version and wake the open event
+streams, which then share one cached JSON snapshot per version.
+
+PRESENCE_SETTINGS['backend'] picks the store:
+    local  process memory, shared by the greenlets/threads of one web
+           worker. Only correct with a single web worker.
+    redis  the same in-memory store in every worker, kept in step by
+           publishing heartbeats and leaves over Redis pub/sub.
+Neither backend writes presence to MongoDB.
+
+Benchmark: python presence.py benchmark [users] [seconds]
+"""
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+
+from config import PRESENCE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+class LocalPresenceStore:
+    """In-memory presence with TTL expiry for the threads of one process"""
+
+    def __init__(self, online_ttl, typing_ttl, max_listed=50, clock=time.monotonic):
+        self.online_ttl = online_ttl
+        self.typing_ttl = typing_ttl
+        self.max_listed = max_listed
+        self.clock = clock
+        self.condition = threading.Condition()
+        # society_id -> {'users': {user_id: entry}, 'version': n, 'cache': (version, json)}
+        self.societies = {}
+
+    def _society(self, society_id):
+        society = self.societies.get(society_id)
+        if society is None:
+            society = self.societies[society_id] = {
+                'users': {}, 'version': 0, 'cache': (None, None)}
+        return society
+
+    def _bump(self, society):
+        society['version'] += 1
+        self.condition.notify_all()
+
+    def heartbeat(self, society_id, user_id, name, typing=None):
+        """Mark a user online (and typing or not, when given).
+
+        Returns True if the change is visible to others.
+        """
+        now = self.clock()
+        with self.condition:
+            society = self._society(society_id)
+            entry = society['users'].get(user_id)
+            changed = entry is None
+            if changed:
+                entry = society['users'][user_id] = {'name': name, 'typing_until': 0}
+            entry['seen'] = now
+            if typing is not None:
+                was_typing = entry['typing_until'] > now
+                entry['typing_until'] = now + self.typing_ttl if typing else 0
+                changed = changed or was_typing != typing
+            if changed:
+                self._bump(society)
+        return changed
+
+    def leave(self, society_id, user_id):
+        with self.condition:
+            society = self._society(society_id)
+            if society['users'].pop(user_id, None) is not None:
+                self._bump(society)
+
+    def sweep(self):
+        """Drop users whose heartbeats stopped and clear lapsed typing flags"""
+        now = self.clock()
+        with self.condition:
+            for society in self.societies.values():
+                changed = False
+                users = society['users']
+                for user_id, entry in list(users.items()):
+                    if entry['seen'] + self.online_ttl < now:
+                        del users[user_id]
+                        changed = True
+                    elif 0 < entry['typing_until'] <= now:
+                        entry['typing_until'] = 0
+                        changed = True
+                if changed:
+                    self._bump(society)
+
+    def snapshot(self, society_id):
+        """(version, JSON) of who is online and typing, serialized once per version"""
+        with self.condition:
+            society = self._society(society_id)
+            version = society['version']
+            cached_version, data = society['cache']
+            if cached_version != version:
+                now = self.clock()
+                users = society['users']
+                online = sorted((entry['name'] for entry in users.values()),
+                                key=str.lower)
+                data = json.dumps({
+                    'version': version,
+                    'count': len(online),
+                    # Large societies list only the first names; the count is exact
+                    'online': online[:self.max_listed],
+                    'typing': [{'id': user_id, 'name': entry['name']}
+                               for user_id, entry in users.items()
+                               if entry['typing_until'] > now]
+                }, separators=(',', ':'))
+                society['cache'] = (version, data)
+            return version, data
+
+    def wait(self, society_id, version, timeout):
+        """Block until the society's version moves past version, or timeout.
+        Returns the new (version, JSON) snapshot, or None on timeout."""
+        with self.condition:
+            society = self._society(society_id)
+            if not self.condition.wait_for(lambda: society['version'] != version, timeout):
+                return None
+        return self.snapshot(society_id)
+
+
+class RedisPresenceStore:
+    """Presence shared by all web workers over Redis pub/sub.
+
+    Each process keeps its own LocalPresenceStore and publishes every
+    heartbeat and leave on one channel. Every process applies what the
+    others publish to its copy, so all copies see the same users and expire
+    them by the same TTLs; reads never leave the process. Nothing is stored
+    in Redis or MongoDB. A process that starts late learns about a user from
+    the user's next heartbeat, within heartbeat_seconds.
+    """
+
+    channel = 'presence'
+
+    def __init__(self, client, local):
+        self.client = client
+        self.local = local
+        self.origin = uuid.uuid4().hex  # to skip our own messages
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.channel)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._listen, daemon=True)
+        self.thread.start()
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            try:
+                message = self.pubsub.get_message(timeout=1.0)
+            except Exception:
+                logger.exception('Reading the presence channel failed')
+                self.stopped.wait(1)
+                continue
+            if message and message['type'] == 'message':
+                self._apply(json.loads(message['data']))
+
+    def _apply(self, event):
+        if event['origin'] == self.origin:
+            return
+        if event['op'] == 'leave':
+            self.local.leave(event['society_id'], event['user_id'])
+        else:
+            self.local.heartbeat(event['society_id'], event['user_id'], event['name'],
+                                 event['typing'])
+
+    def _publish(self, **event):
+        event['origin'] = self.origin
+        try:
+            self.client.publish(self.channel, json.dumps(event, separators=(',', ':')))
+        except Exception:
+            # Other workers miss this one; the next heartbeat catches them up
+            logger.exception('Publishing presence failed')
+
+    def heartbeat(self, society_id, user_id, name, typing=None):
+        """Mark a user online (and typing or not, when given).
+
+        Returns True if the change is visible to others.
+        """
+        self._publish(op='heartbeat', society_id=society_id, user_id=user_id,
+                      name=name, typing=typing)
+        return self.local.heartbeat(society_id, user_id, name, typing)
+
+    def leave(self, society_id, user_id):
+        self._publish(op='leave', society_id=society_id, user_id=user_id)
+        self.local.leave(society_id, user_id)
+
+    def sweep(self):
+        self.local.sweep()
+
+    def snapshot(self, society_id):
+        return self.local.snapshot(society_id)
+
+    def wait(self, society_id, version, timeout):
+        return self.local.wait(society_id, version, timeout)
+
+    def close(self):
+        """Stop listening and release the subscription"""
+        self.stopped.set()
+        self.thread.join()
+        self.pubsub.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _sweep_forever(store, interval):
+    while True:
+        time.sleep(interval)
+        store.sweep()
+
+
+def get_store():
+    """The process-wide presence store, with its expiry thread"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            store = LocalPresenceStore(PRESENCE_SETTINGS['online_ttl_seconds'],
+                                       PRESENCE_SETTINGS['typing_ttl_seconds'],
+                                       PRESENCE_SETTINGS['max_listed'])
+            if PRESENCE_SETTINGS['backend'] == 'redis':
+                import redis  # only needed by deployments with several web workers
+                store = RedisPresenceStore(redis.Redis.from_url(PRESENCE_SETTINGS['redis_url']),
+                                           store)
+            threading.Thread(target=_sweep_forever,
+                             args=(store, PRESENCE_SETTINGS['sweep_interval_seconds']),
+                             daemon=True).start()
+            _store = store
+    return _store
+
+
+def stream_presence(store, society_id):
+    """Server-sent events generator pushing presence snapshots for a society.
+
+    Changes arriving within broadcast_interval_seconds of each other go out
+    as a single event. Like the notification stream, it closes after
+    stream_max_seconds and EventSource reconnects on its own.
+    """
+    deadline = time.monotonic() + PRESENCE_SETTINGS['stream_max_seconds']
+    keepalive = PRESENCE_SETTINGS['stream_keepalive_seconds']
+    interval = PRESENCE_SETTINGS['broadcast_interval_seconds']
+
+    version, data = store.snapshot(society_id)
+    yield 'retry: %d\n\nevent: presence\ndata: %s\n\n' % (
+        PRESENCE_SETTINGS['stream_retry_seconds'] * 1000, data)
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if store.wait(society_id, version, min(keepalive, remaining)) is None:
+            yield ': keepalive\n\n'
+            continue
+        time.sleep(interval)  # let a burst of changes settle into one event
+        version, data = store.snapshot(society_id)
+        yield 'event: presence\ndata: %s\n\n' % data
+
+
+def benchmark(users=2000, seconds=10, viewers=200, threads=8, seed=3):
+    """Heartbeat users from threads (first at the configured rate, then flat
+    out) while viewers wait on snapshots the way stream_presence does."""
+    store = LocalPresenceStore(PRESENCE_SETTINGS['online_ttl_seconds'],
+                               PRESENCE_SETTINGS['typing_ttl_seconds'],
+                               PRESENCE_SETTINGS['max_listed'])
+    interval = PRESENCE_SETTINGS['broadcast_interval_seconds']
+    for user in range(users):
+        store.heartbeat('benchmark', 'u%d' % user, 'User %d' % user)
+
+    def run(paced):
+        stop = threading.Event()
+        delivered = [0] * viewers
+        latencies = [[] for _ in range(threads)]
+        first_version = store.snapshot('benchmark')[0]
+
+        def viewer(index):
+            version = first_version
+            while not stop.is_set():
+                if store.wait('benchmark', version, 0.5) is not None:
+                    time.sleep(interval)
+                    version = store.snapshot('benchmark')[0]
+                    delivered[index] += 1
+
+        def sender(index):
+            rng = random.Random(seed + index)
+            mine = range(index, users, threads)
+            # Each user heartbeats once per interval; some are typing
+            period = PRESENCE_SETTINGS['heartbeat_seconds'] / len(mine) if paced else 0
+            next_at = time.perf_counter()
+            while not stop.is_set():
+                for user in mine:
+                    typing = rng.random() < 0.1 if rng.random() < 0.3 else None
+                    started = time.perf_counter()
+                    store.heartbeat('benchmark', 'u%d' % user, 'User %d' % user, typing)
+                    latencies[index].append(time.perf_counter() - started)
+                    if period:
+                        next_at += period
+                        delay = next_at - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    if stop.is_set():
+                        return
+
+        def sweeper():
+            while not stop.wait(PRESENCE_SETTINGS['sweep_interval_seconds']):
+                store.sweep()
+
+        workers = [threading.Thread(target=viewer, args=(i,)) for i in range(viewers)]
+        workers += [threading.Thread(target=sender, args=(i,)) for i in range(threads)]
+        workers.append(threading.Thread(target=sweeper))
+        for worker in workers:
+            worker.start()
+        time.sleep(seconds)
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+        samples = sorted(l for thread in latencies for l in thread)
+        version, data = store.snapshot('benchmark')
+        print('%s: %d users, %d viewers, %ds: %d heartbeats (%.0f/s), 0 database writes' % (
+            'paced' if paced else 'flat out', users, viewers, seconds,
+            len(samples), len(samples) / seconds))
+        print('  heartbeat latency: p50 %.1fus, p99 %.1fus, max %.1fus' % (
+            samples[len(samples) // 2] * 1e6, samples[int(len(samples) * 0.99)] * 1e6,
+            samples[-1] * 1e6))
+        print('  %d visible changes, %d broadcasts per viewer, %d online, %d bytes each' % (
+            version - first_version, sum(delivered) // viewers,
+            json.loads(data)['count'], len(data)))
+
+    run(paced=True)
+    run(paced=False)
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:] or sys.argv[1] != 'benchmark':
+        sys.exit('usage: python presence.py benchmark [users] [seconds]')
+    benchmark(*[int(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,221 @@
+"""Chat profanity filter.
+
+The word list is compiled once into an Aho-Corasick automaton, so checking
+a message is a single linear pass over its text however many terms the list
+has. Text is normalized first (NFKD with accents dropped, case folding,
+leetspeak digits and common Unicode look-alikes) and matches are masked in
+the original message. A match must include at least one real letter, so a
+plain number such as '455' is never masked. The list file is re-read
+automatically when it changes on disk.
+
+Benchmark: python profanity.py benchmark [messages] [terms]
+"""
+import os
+import random
+import string
+import sys
+import threading
+import time
+import unicodedata
+from collections import deque
+
+from config import CHAT_SETTINGS
+
+# Characters commonly swapped in to dodge filters, mapped to what they imitate
+CONFUSABLES = {
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b',
+    '@': 'a', '$': 's',
+    # Cyrillic and Greek look-alikes
+    'а': 'a', 'е': 'e', 'о': 'o', 'р': 'p', 'с': 'c',
+    'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's',
+    'α': 'a', 'ο': 'o', 'ι': 'i', 'κ': 'k', 'ν': 'v',
+    'ρ': 'p', 'τ': 't', 'υ': 'u',
+}
+IGNORED_CATEGORIES = {'Mn', 'Me', 'Cf'}  # combining marks, zero-width chars
+
+
+_fold_cache = {}
+
+
+def _fold(char):
+    """Normalized form of one character (possibly empty or several chars)"""
+    folded = _fold_cache.get(char)
+    if folded is None:
+        if char.isspace():
+            folded = ' '
+        else:
+            folded = ''.join(
+                CONFUSABLES.get(c, c)
+                for c in unicodedata.normalize('NFKD', char).casefold()
+                if unicodedata.category(c) not in IGNORED_CATEGORIES)
+        _fold_cache[char] = folded
+    return folded
+
+
+def normalize(text):
+    """Return (normalized, positions) where positions[i] is the index in text
+    of the character that produced normalized[i]. Runs of whitespace
+    collapse to a single space."""
+    chars = []
+    positions = []
+    for index, char in enumerate(text):
+        folded = _fold(char)
+        if folded == ' ' and chars and chars[-1] == ' ':
+            continue
+        for c in folded:
+            chars.append(c)
+            positions.append(index)
+    return ''.join(chars), positions
+
+
+def _is_word_char(char):
+    return char.isalpha()
+
+
+class ProfanityFilter:
+    """Aho-Corasick automaton over a normalized word list"""
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]  # lengths of the terms ending at each state
+        for word in words:
+            term = normalize(word.strip())[0]
+            if term:
+                self._add(term)
+        self._link()
+
+    def _add(self, term):
+        state = 0
+        for char in term:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = next_state
+        if len(term) not in self.output[state]:
+            self.output[state] += (len(term),)
+
+    def _link(self):
+        """Breadth-first pass filling in failure links and merged outputs"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.output[child] += self.output[self.fail[child]]
+
+    def find(self, text):
+        """Yield (start, end) spans of whole-word matches in the original text"""
+        normalized, positions = normalize(text)
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for end, char in enumerate(normalized):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in output[state]:
+                start = end - length + 1
+                # Whole words only, so 'class' does not trip on 'ass'
+                if start > 0 and _is_word_char(normalized[start - 1]):
+                    continue
+                if end + 1 < len(normalized) and _is_word_char(normalized[end + 1]):
+                    continue
+                span = positions[start], positions[end] + 1
+                # Leetspeak needs a letter to disguise; '455 points' is a number
+                if not any(c.isalpha() for c in text[span[0]:span[1]]):
+                    continue
+                yield span
+
+    def contains(self, text):
+        return next(self.find(text), None) is not None
+
+    def censor(self, text, mask='*'):
+        """Replace every matched term with mask characters"""
+        spans = list(self.find(text))
+        if not spans:
+            return text
+        chars = list(text)
+        for start, end in spans:
+            for index in range(start, end):
+                if not chars[index].isspace():
+                    chars[index] = mask
+        return ''.join(chars)
+
+
+def load_words(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+_filter = None
+_filter_mtime = None
+_checked_at = 0
+_filter_lock = threading.Lock()
+
+
+def get_filter():
+    """The compiled filter, rebuilt when the word list file changes"""
+    global _filter, _filter_mtime, _checked_at
+    now = time.monotonic()
+    if _filter is not None and now - _checked_at < CHAT_SETTINGS['profanity_reload_seconds']:
+        return _filter
+
+    with _filter_lock:
+        _checked_at = now
+        path = CHAT_SETTINGS['profanity_wordlist']
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if _filter is None or mtime != _filter_mtime:
+            words = load_words(path) if mtime is not None else []
+            _filter = ProfanityFilter(words)
+            _filter_mtime = mtime
+    return _filter
+
+
+def benchmark(message_count=10000, term_count=5000, seed=42):
+    """Time compiling term_count terms and filtering message_count messages"""
+    rng = random.Random(seed)
+    terms = {''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+             for _ in range(term_count)}
+    vocabulary = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+                  for _ in range(2000)] + list(terms)[:50]
+    messages = []
+    for _ in range(message_count):
+        words = []
+        while sum(len(w) + 1 for w in words) < CHAT_SETTINGS['max_message_length'] - 10:
+            words.append(rng.choice(vocabulary))
+        messages.append(' '.join(words))
+
+    started = time.perf_counter()
+    profanity_filter = ProfanityFilter(terms)
+    compiled = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for message in messages:
+        profanity_filter.censor(message)
+    elapsed = time.perf_counter() - started
+
+    characters = sum(len(m) for m in messages)
+    print('compiled %d terms into %d states in %.3fs' %
+          (len(terms), len(profanity_filter.goto), compiled))
+    print('filtered %d messages (%d chars) in %.3fs: %.0f msg/s, %.2f MB/s' %
+          (len(messages), characters, elapsed, len(messages) / elapsed,
+           characters / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:] or sys.argv[1] != 'benchmark':
+        sys.exit('usage: python profanity.py benchmark [messages] [terms]')
+    benchmark(*[int(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,284 @@
+"""Opt-in, sampled request profiling.
+
+With PROFILE_REQUESTS=true a fraction (PROFILE_SAMPLE_RATE) of requests is
+run under cProfile and tracemalloc. For each endpoint we keep the number of
+samples, the average and worst Python allocation peak and duration, and the
+top allocation sites and functions of the worst sample. Results are shown
+on /secretary/diagnostics and, when PROFILE_DUMP_DIR is set, written there
+as .prof (open with pstats or snakeviz) and .json files.
+
+Allocations are traced with traceback_frames frames and each site is the
+innermost line of the project's own code on the stack, so an allocation
+made inside pymongo or bson is charged to the route line that asked for it.
+
+Requests that are not sampled only pay for one random() call. tracemalloc
+is process-wide, so at most one request is sampled at a time and its peak
+includes whatever other threads allocated meanwhile. cProfile follows one
+OS thread; under the gevent worker in the Procfile every request is a
+greenlet on the same thread, so a sample's functions and duration also
+include the requests that ran while it waited on I/O. A route has to stand
+out over several samples before it is a real suspect.
+
+Measure the overhead:  python profiling.py benchmark [requests]
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from flask import g, request
+
+from config import PROFILING_SETTINGS
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _in_project(filename):
+    return (filename.startswith(PROJECT_DIR) and 'site-packages' not in filename
+            and filename != __file__)
+
+
+def _short_path(filename):
+    """Project files relative to the project, library files by their tail"""
+    if filename.startswith(PROJECT_DIR):
+        return os.path.relpath(filename, PROJECT_DIR)
+    parts = filename.replace('\\', '/').split('/')
+    return '/'.join(parts[-2:])
+
+
+class RequestProfiler:
+    """Samples requests and aggregates their profiles per endpoint"""
+
+    def __init__(self, app=None, settings=PROFILING_SETTINGS):
+        self.settings = settings
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.sample_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['request_profiler'] = self
+        if not self.settings['enabled']:
+            return
+        app.before_request(self._start)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start(self):
+        if random.random() >= self.settings['sample_rate']:
+            return
+        if request.endpoint in (None, 'static'):
+            return
+        if not self.sample_lock.acquire(blocking=False):
+            return  # another request is being sampled
+
+        tracing = self.settings['tracemalloc'] and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(self.settings['traceback_frames'])
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler (a debugger, say) is already active
+            profiler = None
+        g.request_profile = {'profiler': profiler, 'tracing': tracing,
+                             'started': time.perf_counter()}
+
+    def _after_request(self, response):
+        # Stop before a streamed body is sent, so an open event stream
+        # is not profiled for minutes
+        self._finish()
+        return response
+
+    def _teardown_request(self, error):
+        self._finish()
+
+    def _finish(self):
+        sample = g.pop('request_profile', None)
+        if sample is None:
+            return
+        try:
+            duration = time.perf_counter() - sample['started']
+            if sample['profiler'] is not None:
+                sample['profiler'].disable()
+            peak, sites = 0, []
+            if sample['tracing']:
+                peak = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                sites = self._top_sites(snapshot)
+        finally:
+            self.sample_lock.release()
+
+        record = {
+            'endpoint': request.endpoint,
+            'rule': request.url_rule.rule if request.url_rule else request.path,
+            'method': request.method,
+            'at': datetime.utcnow(),
+            'duration': duration,
+            'peak': peak,
+            'sites': sites,
+            'functions': self._top_functions(sample['profiler'])
+        }
+        self._record(record)
+        if self.settings['dump_dir']:
+            self._dump(record, sample['profiler'])
+
+    def _top_sites(self, snapshot):
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')))
+        sites = {}
+        for stat in snapshot.statistics('traceback'):
+            frames = list(stat.traceback)  # oldest first
+            innermost = frames[-1]
+            owner = next((frame for frame in reversed(frames)
+                          if _in_project(frame.filename)), innermost)
+            where = '%s:%d' % (_short_path(owner.filename), owner.lineno)
+            site = sites.setdefault(where, {'where': where, 'via': None, 'size': 0,
+                                            'count': 0, 'largest': 0})
+            site['size'] += stat.size
+            site['count'] += stat.count
+            if owner is not innermost and stat.size > site['largest']:
+                # The library line that did most of this site's allocating
+                site['via'] = '%s:%d' % (_short_path(innermost.filename), innermost.lineno)
+                site['largest'] = stat.size
+        ranked = sorted(sites.values(), key=lambda site: site['size'], reverse=True)
+        for site in ranked:
+            del site['largest']
+        return ranked[:self.settings['top_sites']]
+
+    def _top_functions(self, profiler):
+        if profiler is None:
+            return []
+        stats = pstats.Stats(profiler).stats
+        ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [{
+            'function': '%s (%s:%d)' % (name, _short_path(filename), line),
+            'calls': calls,
+            'own': own_time,
+            'cumulative': cumulative
+        } for (filename, line, name), (_, calls, own_time, cumulative, _)
+            in ranked[:self.settings['top_functions']]]
+
+    def _record(self, record):
+        with self.lock:
+            stats = self.endpoints.setdefault(record['endpoint'], {
+                'endpoint': record['endpoint'],
+                'rule': record['rule'],
+                'samples': 0,
+                'total_duration': 0.0,
+                'max_duration': 0.0,
+                'total_peak': 0,
+                'max_peak': 0,
+                'worst': None
+            })
+            stats['samples'] += 1
+            stats['total_duration'] += record['duration']
+            stats['max_duration'] = max(stats['max_duration'], record['duration'])
+            stats['total_peak'] += record['peak']
+            if stats['worst'] is None or record['peak'] >= stats['max_peak']:
+                stats['max_peak'] = record['peak']
+                stats['worst'] = record
+
+    def _dump(self, record, profiler):
+        os.makedirs(self.settings['dump_dir'], exist_ok=True)
+        base = os.path.join(self.settings['dump_dir'], '%s-%s-%d' % (
+            record['at'].strftime('%Y%m%dT%H%M%S'), record['endpoint'], os.getpid()))
+        if profiler is not None:
+            profiler.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump(dict(record, at=record['at'].isoformat()), f, indent=2)
+
+    def report(self):
+        """Per-endpoint summaries, worst allocation peak first"""
+        with self.lock:
+            rows = [dict(stats,
+                         avg_duration=stats['total_duration'] / stats['samples'],
+                         avg_peak=stats['total_peak'] // stats['samples'])
+                    for stats in self.endpoints.values()]
+        return sorted(rows, key=lambda row: row['max_peak'], reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+def process_memory():
+    """Resident set size of this process in bytes (current and peak), if known"""
+    current = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        try:
+            import resource
+            # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != 'darwin':
+                peak *= 1024
+        except ImportError:
+            pass
+    return {'rss': current, 'peak_rss': peak}
+
+
+def benchmark(requests=2000, seed=5):
+    """Time a small JSON route without the profiler, with it installed but
+    not sampling, and sampling every request"""
+    from flask import Flask, jsonify
+
+    rng = random.Random(seed)
+    rows = [{'title': 'Notice %d' % i, 'content': 'x' * rng.randint(50, 500)}
+            for i in range(50)]
+
+    def run(settings):
+        app = Flask(__name__)
+
+        @app.route('/notices')
+        def notices():
+            return jsonify([dict(row, words=len(row['content'].split())) for row in rows])
+
+        if settings is not None:
+            RequestProfiler(app, settings)
+        client = app.test_client()
+        for _ in range(50):
+            client.get('/notices')
+        best = None
+        for _ in range(3):  # best of three, to keep scheduler noise out
+            started = time.perf_counter()
+            for _ in range(requests):
+                client.get('/notices')
+            took = (time.perf_counter() - started) / requests * 1e6
+            best = took if best is None else min(best, took)
+        return best
+
+    base = dict(PROFILING_SETTINGS, enabled=True, dump_dir=None)
+    baseline = run(None)
+    print('%d requests per case, best of 3' % requests)
+    print('  %-32s %8.1fus per request' % ('profiler off:', baseline))
+    for label, settings in (
+            ('installed, not sampling:', dict(base, sample_rate=0.0)),
+            ('every request, 1 frame:', dict(base, sample_rate=1.0, traceback_frames=1)),
+            ('every request, %d frames:' % base['traceback_frames'], dict(base, sample_rate=1.0))):
+        took = run(settings)
+        print('  %-32s %8.1fus per request (%+.0f%%)' % (
+            label, took, (took - baseline) / baseline * 100))
+    print('At sample_rate %.2f the expected cost is %.1fus per request' % (
+        base['sample_rate'], base['sample_rate'] * (took - baseline)))
+
+if __name__ == '__main__':
+    if not sys.argv[1:] or sys.argv[1] != 'benchmark':
+        sys.exit('usage: python profiling.py benchmark [requests]')
+    benchmark(*[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,52 @@
+"""Per-route read preference with read-your-writes across requests.
+
+List and dashboard views read from secondaries (within a staleness bound);
+authentication and writes stay on the primary. Each request runs its
+MongoDB operations in a causally consistent session, and after a write the
+session's cluster/operation time is kept in the Flask session. The next
+request advances its MongoDB session to that point, so a secondary read
+waits until it has caught up with the user's own write.
+"""
+from bson import json_util
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from config import READ_PREFERENCE_SETTINGS
+
+TOKEN_KEY = 'causal_token'
+
+
+class ReadRouter:
+    """Hand out database handles with the read preference of an endpoint"""
+
+    def __init__(self, db, settings=READ_PREFERENCE_SETTINGS):
+        self.settings = settings
+        self.primary = db.with_options(read_preference=Primary())
+        self.secondary = db.with_options(read_preference=SecondaryPreferred(
+            max_staleness=settings['max_staleness_seconds']))
+
+    def database(self, endpoint):
+        if (self.settings['enabled'] and
+                endpoint in self.settings['secondary_endpoints']):
+            return self.secondary
+        return self.primary
+
+
+def start_causal_session(client, flask_session):
+    """Start a causally consistent session resumed from the user's last write"""
+    db_session = client.start_session(causal_consistency=True)
+    token = flask_session.get(TOKEN_KEY)
+    if token:
+        cluster_time, operation_time = json_util.loads(token)
+        if cluster_time:
+            db_session.advance_cluster_time(cluster_time)
+        if operation_time:
+            db_session.advance_operation_time(operation_time)
+    return db_session
+
+
+def remember_writes(db_session, flask_session):
+    """Store the session's causal position so the next request can resume it"""
+    if db_session.operation_time is None:
+        return
+    flask_session[TOKEN_KEY] = json_util.dumps(
+        [db_session.cluster_time, db_session.operation_time])
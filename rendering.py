@@ -0,0 +1,85 @@
+"""Render-on-write for chat messages and notices.
+
+Content never changes after it is posted, so the escaped HTML and the
+display timestamp are computed once at write time and stored in a
+``rendered`` sub-document; templates emit the stored strings as-is.
+Bump RENDER_VERSION when the markup changes: documents with an older
+version are re-rendered (and written back) the next time they are read.
+
+Times are shown in RENDER_SETTINGS['timezone'] (DISPLAY_TIMEZONE, UTC by
+default), never the server's local zone, so the stored strings do not
+depend on which machine rendered them.
+"""
+from datetime import timezone
+
+from markupsafe import escape
+from pymongo import UpdateOne
+
+from config import RENDER_SETTINGS
+
+# 2: times in the configured timezone instead of the server's local one
+RENDER_VERSION = 2
+
+
+def display_timezone():
+    name = RENDER_SETTINGS['timezone']
+    if name == 'UTC':
+        return timezone.utc
+    from zoneinfo import ZoneInfo  # Python 3.9+
+    return ZoneInfo(name)
+
+
+def _display_time(dt):
+    """Stored datetimes are naive UTC"""
+    return dt.replace(tzinfo=timezone.utc).astimezone(display_timezone())
+
+
+def format_datetime(dt):
+    """Convert UTC datetime to the display timezone and format it"""
+    if dt is None:
+        return 'Recently'
+    return _display_time(dt).strftime('%B %d, %Y at %I:%M %p')
+
+
+def format_time_only(dt):
+    """Convert UTC datetime to the display timezone and format time only"""
+    if dt is None:
+        return 'Recently'
+    return _display_time(dt).strftime('%I:%M %p')
+
+
+def render_text(text):
+    """Escape user text and turn newlines into <br> tags"""
+    return str(escape(text or '')).replace('\n', '<br>')
+
+
+def render_message(message):
+    return {
+        'v': RENDER_VERSION,
+        'html': render_text(message.get('content')),
+        'time': format_time_only(message.get('created_at'))
+    }
+
+
+def render_notice(notice):
+    return {
+        'v': RENDER_VERSION,
+        'html': render_text(notice.get('content')),
+        'posted_at': format_datetime(notice.get('created_at'))
+    }
+
+
+def ensure_rendered(collection, docs, renderer):
+    """Fill in missing or outdated ``rendered`` fields on docs in place and
+    store them, so each document is re-rendered at most once per version"""
+    updates = []
+    for doc in docs:
+        if (doc.get('rendered') or {}).get('v') == RENDER_VERSION:
+            continue
+        doc['rendered'] = renderer(doc)
+        updates.append(UpdateOne(
+            {'_id': doc['_id'], 'rendered.v': {'$ne': RENDER_VERSION}},
+            {'$set': {'rendered': doc['rendered']}}))
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+    return docs
@@ -0,0 +1,397 @@
+"""Bulk resident import from a CSV file.
+
+The web request only streams the upload into GridFS and queues a
+'resident_import' job; the worker parses the file row by row, validates
+each row with the registration validators from forms.py, hashes passwords
+across a process pool and writes users with unordered insert_many batches.
+Progress and per-row errors are kept on a resident_imports document that
+the secretary's page polls.
+
+CSV columns: name, email, apartment and optionally password. A row without
+a password gets the hash of a random secret nobody knows, so the account
+cannot be logged into yet, and the resident is emailed a one-time link
+(/set_password/<user_id>/<token>) to choose their own password.
+"""
+import csv
+import hashlib
+import hmac
+import io
+import logging
+import multiprocessing
+import os
+import re
+import secrets
+import smtplib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import gridfs
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+from wtforms.validators import ValidationError
+
+from config import IMPORT_SETTINGS, JOB_SETTINGS, get_config
+from forms import validate_apartment_format, validate_password_strength
+from jobs import job_handler, enqueue_job, enqueue_jobs
+from mailer import send_batch
+from tenancy import claim_emails, release_email
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'imports'
+COPY_CHUNK_SIZE = 64 * 1024
+REQUIRED_COLUMNS = ('name', 'email', 'apartment')
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+class ResidentImportError(ValueError):
+    """Raised when an uploaded import file is rejected"""
+
+
+class _Field:
+    """Just enough of a WTForms field to run the forms.py validators"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def get_bucket(db):
+    return gridfs.GridFSBucket(db, bucket_name=BUCKET_NAME)
+
+
+def start_import(db, file, society_id, user_id):
+    """Stream an uploaded CSV into GridFS and queue the import job.
+
+    Returns the id of the resident_imports status document.
+    """
+    filename = secure_filename(file.filename or '') or 'residents.csv'
+    if not filename.lower().endswith('.csv'):
+        raise ResidentImportError('Please upload a .csv file.')
+    max_size = IMPORT_SETTINGS['max_file_size']
+
+    grid_in = get_bucket(db).open_upload_stream(
+        filename, metadata={'society_id': society_id, 'user_id': user_id})
+    size = 0
+    try:
+        while True:
+            chunk = file.stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise ResidentImportError('%s is larger than %d MB.' %
+                                          (filename, max_size // (1024 * 1024)))
+            grid_in.write(chunk)
+    except Exception:
+        grid_in.abort()
+        raise
+    grid_in.close()
+
+    import_id = db.resident_imports.insert_one({
+        'society_id': society_id,
+        'created_by': user_id,
+        'file_id': grid_in._id,
+        'filename': filename,
+        'status': 'queued',
+        'rows': 0,
+        'inserted': 0,
+        'failed': 0,
+        'errors': [],
+        'next_row': 0,
+        'created_at': datetime.utcnow()
+    }).inserted_id
+    enqueue_job(db, 'resident_import', {'import_id': import_id},
+                dedupe_key='resident_import:%s' % import_id)
+    return import_id
+
+
+def import_status(db, society_id, import_id):
+    """The public fields of an import, or None if it is not this society's"""
+    return db.resident_imports.find_one(
+        {'_id': import_id, 'society_id': society_id},
+        {'file_id': 0, 'created_by': 0})
+
+
+def validate_row(row):
+    """Return (cleaned row, None) or (None, error message) for one CSV row"""
+    name = (row.get('name') or '').strip()
+    email = (row.get('email') or '').strip()
+    apartment = (row.get('apartment') or '').strip()
+    password = (row.get('password') or '').strip()
+
+    if not 2 <= len(name) <= 50:
+        return None, 'Name must be between 2 and 50 characters.'
+    if not EMAIL_PATTERN.match(email):
+        return None, 'Invalid email address.'
+    if len(apartment) > 20:
+        return None, 'Apartment number is too long.'
+    try:
+        validate_apartment_format(None, _Field(apartment))
+    except ValidationError as exc:
+        return None, str(exc)
+    if password and password_error(password):
+        return None, password_error(password)
+
+    return {'name': name, 'email': email, 'apartment': apartment,
+            'password': password}, None
+
+
+def password_error(password):
+    """The registration password rules as an error message, or None"""
+    try:
+        validate_password_strength(None, _Field(password))
+    except ValidationError as exc:
+        return str(exc)
+    return None
+
+
+_pool = None
+_pool_size = 1
+
+
+def get_hash_pool():
+    """Process pool for password hashing, created once per worker process.
+
+    Spawned rather than forked so the children do not inherit the parent's
+    MongoClient threads and sockets.
+    """
+    global _pool, _pool_size
+    if _pool is None:
+        _pool_size = IMPORT_SETTINGS['hash_processes'] or os.cpu_count() or 1
+        _pool = ProcessPoolExecutor(
+            max_workers=_pool_size,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def hash_passwords(passwords):
+    pool = get_hash_pool()
+    chunksize = max(1, len(passwords) // (_pool_size * 4))
+    return list(pool.map(generate_password_hash, passwords, chunksize=chunksize))
+
+
+def import_batch(db, record, batch, seen_emails):
+    """Validate, hash and insert one batch of (line number, row) pairs.
+
+    Returns (inserted count, list of row errors).
+    """
+    errors = []
+    valid = []
+    for line, row in batch:
+        cleaned, error = validate_row(row)
+        if cleaned and cleaned['email'] in seen_emails:
+            error = 'Email appears more than once in the file.'
+        if error:
+            errors.append({'row': line, 'email': (row.get('email') or '').strip(),
+                           'error': error})
+            continue
+        seen_emails.add(cleaned['email'])
+        valid.append((line, cleaned))
+
+    # Email is unique across all societies, as in register(): reserve the
+    # addresses in the directory first, then write the users
+    user_ids = {cleaned['email']: ObjectId() for _, cleaned in valid}
+    existing = {user['email'] for user in db.users.find(
+        {'email': {'$in': list(user_ids)}, '_id': {'$nin': list(user_ids.values())}},
+        {'email': 1})}
+    existing |= claim_emails(db, record['society_id'], [
+        (email, user_id) for email, user_id in user_ids.items() if email not in existing])
+    rows = []
+    for line, cleaned in valid:
+        if cleaned['email'] in existing:
+            errors.append({'row': line, 'email': cleaned['email'],
+                           'error': 'Email already registered.'})
+        else:
+            rows.append((line, cleaned))
+    if not rows:
+        return 0, errors
+
+    now = datetime.utcnow()
+    # Rows without a password get an unusable one until the resident sets theirs
+    hashes = hash_passwords([cleaned['password'] or secrets.token_urlsafe(32)
+                             for _, cleaned in rows])
+    users = []
+    for (_, cleaned), password_hash in zip(rows, hashes):
+        user = {
+            '_id': user_ids[cleaned['email']],
+            'name': cleaned['name'],
+            'email': cleaned['email'],
+            'apartment': cleaned['apartment'],
+            'password': password_hash,
+            'is_secretary': False,
+            'is_admin': False,
+            'society_id': record['society_id'],
+            'created_at': now
+        }
+        if not cleaned['password']:
+            user['password_setup'] = {'requested_at': now}
+        users.append(user)
+
+    failed = set()
+    try:
+        inserted = len(db.users.insert_many(users, ordered=False).inserted_ids)
+    except BulkWriteError as exc:
+        # Rows that lost a race with a concurrent registration
+        inserted = exc.details.get('nInserted', 0)
+        for write_error in exc.details.get('writeErrors', []):
+            failed.add(write_error['index'])
+            line, cleaned = rows[write_error['index']]
+            release_email(db, cleaned['email'], user_ids[cleaned['email']])
+            errors.append({'row': line, 'email': cleaned['email'],
+                           'error': 'Email already registered.'})
+    send_password_links(db, [user['_id'] for index, user in enumerate(users)
+                             if 'password_setup' in user and index not in failed],
+                        dedupe_prefix='password_link:%s' % record['_id'])
+    return inserted, errors
+
+
+# One-time set-password links
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def send_password_links(db, user_ids, dedupe_prefix=None):
+    """Queue set-password emails for these users, one job per email batch"""
+    size = JOB_SETTINGS['email_batch_size']
+    batches = [[str(user_id) for user_id in user_ids[i:i + size]]
+               for i in range(0, len(user_ids), size)]
+    keys = None
+    if dedupe_prefix:
+        # A retried import batch must not email the same residents twice
+        keys = ['%s:%s' % (dedupe_prefix, batch[0]) for batch in batches]
+    enqueue_jobs(db, 'password_link_batch', [{'user_ids': batch} for batch in batches],
+                 dedupe_keys=keys)
+
+
+def issue_password_token(db, user_id):
+    """Start a new set-password link for the user, replacing any earlier one"""
+    token = secrets.token_urlsafe(32)
+    db.users.update_one(
+        {'_id': user_id, 'password_setup': {'$exists': True}},
+        {'$set': {'password_setup.token_hash': _token_hash(token),
+                  'password_setup.expires_at': datetime.utcnow() + timedelta(
+                      hours=IMPORT_SETTINGS['password_link_hours'])}})
+    return token
+
+
+def user_for_password_token(db, user_id, token):
+    """The user a set-password link belongs to, or None if it is not valid"""
+    if not ObjectId.is_valid(user_id):
+        return None
+    user = db.users.find_one({'_id': ObjectId(user_id)})
+    setup = (user or {}).get('password_setup') or {}
+    if not setup.get('token_hash') or setup['expires_at'] < datetime.utcnow():
+        return None
+    if not hmac.compare_digest(setup['token_hash'], _token_hash(token)):
+        return None
+    return user
+
+
+def complete_password_setup(db, user, token, password_hash):
+    """Set the password and spend the link; False if it was already used"""
+    return db.users.update_one(
+        {'_id': user['_id'], 'password_setup.token_hash': _token_hash(token)},
+        {'$set': {'password': password_hash},
+         '$unset': {'password_setup': ''}}).modified_count == 1
+
+
+def build_password_email(user, link, sender):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = user['email']
+    message['Subject'] = 'Set your community portal password'
+    message.set_content(
+        'Hello %s,\n\nYour society secretary has added you to the community portal. '
+        'Choose your password here (the link works once and expires in %d hours):\n\n'
+        '%s\n\n-- \nSociety Secretary' % (
+            user.get('name') or '', IMPORT_SETTINGS['password_link_hours'], link))
+    return message
+
+
+def _record_progress(db, record, next_row, rows, inserted, errors):
+    db.resident_imports.update_one(
+        {'_id': record['_id']},
+        {'$set': {'next_row': next_row, 'updated_at': datetime.utcnow()},
+         '$inc': {'rows': rows, 'inserted': inserted, 'failed': len(errors)},
+         '$push': {'errors': {'$each': errors,
+                              '$slice': IMPORT_SETTINGS['max_reported_errors']}}})
+
+
+# Job handlers
+
+
+@job_handler('password_link_batch')
+def send_password_link_batch(db, job):
+    """Email a batch of imported residents their set-password links"""
+    settings = get_config()
+    user_ids = job['payload']['user_ids']
+    users = [user for user in db.users.find(
+        {'_id': {'$in': [ObjectId(user_id) for user_id in user_ids]},
+         'password_setup': {'$exists': True}}, {'name': 1, 'email': 1})]
+    # A fresh token per attempt; only the last email's link works
+    messages = [build_password_email(user, '%s/set_password/%s/%s' % (
+        settings.APP_URL.rstrip('/'), user['_id'], issue_password_token(db, user['_id'])),
+        settings.MAIL_DEFAULT_SENDER) for user in users]
+    try:
+        refused = send_batch(messages, settings)
+    except (smtplib.SMTPException, OSError) as exc:
+        remaining = [str(user['_id']) for user in users[getattr(exc, 'sent', 0):]]
+        if not remaining:
+            return
+        db.jobs.update_one({'_id': job['_id']},
+                           {'$set': {'payload.user_ids': remaining}})
+        raise
+    if refused:
+        logger.warning('Set-password links: server refused %d recipient(s): %s',
+                       len(refused), ', '.join(refused))
+
+
+
+@job_handler('resident_import')
+def run_resident_import(db, job):
+    """Import one uploaded CSV, resuming after the last finished batch on retry"""
+    record = db.resident_imports.find_one({'_id': job['payload']['import_id']})
+    if not record or record['status'] in ('done', 'failed'):
+        return
+    db.resident_imports.update_one(
+        {'_id': record['_id']},
+        {'$set': {'status': 'running', 'started_at': datetime.utcnow()}})
+
+    bucket = get_bucket(db)
+    grid_out = bucket.open_download_stream(record['file_id'])
+    reader = csv.DictReader(io.TextIOWrapper(grid_out, encoding='utf-8-sig', newline=''))
+    header = [column.strip().lower() for column in reader.fieldnames or []]
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        db.resident_imports.update_one(
+            {'_id': record['_id']},
+            {'$set': {'status': 'failed', 'finished_at': datetime.utcnow(),
+                      'message': 'Missing column(s): %s' % ', '.join(missing)}})
+        bucket.delete(record['file_id'])
+        return
+    reader.fieldnames = header
+
+    seen_emails = set()
+    batch = []
+    for row in reader:
+        if reader.line_num <= record['next_row']:
+            continue  # imported by an earlier attempt
+        batch.append((reader.line_num, row))
+        if len(batch) >= IMPORT_SETTINGS['batch_size']:
+            inserted, errors = import_batch(db, record, batch, seen_emails)
+            _record_progress(db, record, reader.line_num, len(batch), inserted, errors)
+            batch = []
+    if batch:
+        inserted, errors = import_batch(db, record, batch, seen_emails)
+        _record_progress(db, record, reader.line_num, len(batch), inserted, errors)
+
+    db.resident_imports.update_one(
+        {'_id': record['_id']},
+        {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}})
+    bucket.delete(record['file_id'])
+    logger.info('Resident import %s finished', record['_id'])
@@ -0,0 +1,345 @@
+"""Full-text search over notices and chat messages.
+
+An inverted index is kept in MongoDB and updated as content is written:
+    search_postings  {'society_id', 'term', 'kind', 'doc_id', 'tf', 'dl', 'impact',
+                      'created_at'}
+    search_terms     {'_id': 'society|term', 'df'}          document frequency
+    search_stats     {'_id': society_id, 'docs', 'total_len'}
+Each posting stores its impact, the term's BM25 weight in that document
+without idf, and postings are indexed by (society_id, term, impact desc).
+A query reads only the highest-impact SEARCH_SETTINGS['max_postings_per_term']
+postings of each term, however common the term is, and ranks those
+candidates with BM25.
+
+The index is rebuilt in scratch collections that are then swapped in, so
+searches keep working while it runs.
+
+Rebuild the whole index:      python search.py rebuild
+Measure query latency:        python search.py benchmark [documents]
+"""
+import math
+import random
+import re
+import sys
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from config import SEARCH_SETTINGS
+
+TOKEN_PATTERN = re.compile(r'\w+')
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have in is it its of on or our
+please so that the their this to was we will with you your
+""".split())
+BM25_K1 = 1.2
+BM25_B = 0.75
+INDEX_COLLECTIONS = ('search_postings', 'search_terms', 'search_stats')
+REBUILD_SUFFIX = '_rebuild'
+
+
+def tokenize(text):
+    """Lower-case, accent-stripped word tokens without stopwords"""
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [token for token in TOKEN_PATTERN.findall(text)
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+def notice_text(notice):
+    return '%s\n%s' % (notice.get('title') or '', notice.get('content') or '')
+
+
+def message_text(message):
+    return message.get('content') or ''
+
+
+def create_search_indexes(postings):
+    # Postings are read by term, highest impact first, and removed by document
+    postings.create_index([('society_id', 1), ('term', 1), ('impact', -1)])
+    postings.create_index([('society_id', 1), ('kind', 1), ('doc_id', 1)])
+
+
+def _term_id(society_id, term):
+    return '%s|%s' % (society_id, term)
+
+
+def _average_length(stats):
+    docs = stats.get('docs', 0)
+    return (stats.get('total_len', 0) / docs if docs > 0 else 0) or 1
+
+
+def _weight(tf, dl, average_length):
+    """BM25 weight of a term in one document, before idf"""
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * dl / average_length)
+    return tf * (BM25_K1 + 1) / (tf + norm)
+
+
+def _postings(society_id, kind, doc, text, average_length=None):
+    terms = Counter(tokenize(text))
+    length = sum(terms.values())
+    # Against the society's average length at indexing time; only used to
+    # pick candidates, which are then scored with the current average
+    average_length = average_length or length or 1
+    return [{
+        'society_id': society_id,
+        'term': term,
+        'kind': kind,
+        'doc_id': doc['_id'],
+        'tf': tf,
+        'dl': length,
+        'impact': _weight(tf, length, average_length),
+        'created_at': doc.get('created_at')
+    } for term, tf in terms.items()], length
+
+
+def index_document(db, society_id, kind, doc, text):
+    """Add one notice or message to the index"""
+    stats = db.search_stats.find_one({'_id': society_id}) or {}
+    postings, length = _postings(society_id, kind, doc, text, _average_length(stats))
+    if not postings:
+        return
+    db.search_postings.insert_many(postings, ordered=False)
+    db.search_terms.bulk_write([
+        UpdateOne({'_id': _term_id(society_id, p['term'])},
+                  {'$inc': {'df': 1}}, upsert=True)
+        for p in postings], ordered=False)
+    db.search_stats.update_one(
+        {'_id': society_id},
+        {'$inc': {'docs': 1, 'total_len': length}}, upsert=True)
+
+
+def remove_document(db, society_id, kind, doc_id):
+    """Drop one notice or message from the index"""
+    remove_documents(db, society_id, kind, [doc_id])
+
+
+def remove_documents(db, society_id, kind, doc_ids):
+    """Drop several notices or messages from the index in a few round trips"""
+    query = {'society_id': society_id, 'kind': kind, 'doc_id': {'$in': list(doc_ids)}}
+    postings = list(db.search_postings.find(query, {'term': 1, 'doc_id': 1, 'dl': 1}))
+    if not postings:
+        return
+    db.search_postings.delete_many(query)
+
+    frequencies = Counter(p['term'] for p in postings)
+    lengths = {p['doc_id']: p['dl'] for p in postings}
+    db.search_terms.bulk_write([
+        UpdateOne({'_id': _term_id(society_id, term)}, {'$inc': {'df': -df}})
+        for term, df in frequencies.items()], ordered=False)
+    db.search_stats.update_one(
+        {'_id': society_id},
+        {'$inc': {'docs': -len(lengths), 'total_len': -sum(lengths.values())}})
+
+
+def search(db, society_id, query, page=1, per_page=None):
+    """Rank notices and messages for query with BM25.
+
+    Returns (hits, total) where hits are dicts with kind, doc_id, score and
+    created_at for the requested page. Only the top-impact postings of each
+    term are candidates, so total counts at most max_postings_per_term
+    documents per query term.
+    """
+    per_page = per_page or SEARCH_SETTINGS['results_per_page']
+    terms = list(dict.fromkeys(tokenize(query)))[:SEARCH_SETTINGS['max_query_terms']]
+    if not terms:
+        return [], 0
+
+    stats = db.search_stats.find_one({'_id': society_id}) or {}
+    docs = stats.get('docs', 0)
+    if docs <= 0:
+        return [], 0
+    average_length = _average_length(stats)
+
+    frequencies = {doc['_id'].split('|', 1)[1]: doc['df'] for doc in db.search_terms.find(
+        {'_id': {'$in': [_term_id(society_id, term) for term in terms]}})}
+    idf = {term: math.log(1 + (docs - df + 0.5) / (df + 0.5))
+           for term, df in frequencies.items() if df > 0}
+    if not idf:
+        return [], 0
+
+    scores = defaultdict(float)
+    created = {}
+    for term in idf:
+        postings = db.search_postings.find(
+            {'society_id': society_id, 'term': term},
+            {'_id': 0, 'kind': 1, 'doc_id': 1, 'tf': 1, 'dl': 1, 'created_at': 1}
+        ).sort('impact', -1).limit(SEARCH_SETTINGS['max_postings_per_term'])
+        for posting in postings:
+            key = (posting['kind'], posting['doc_id'])
+            scores[key] += idf[term] * _weight(posting['tf'], posting['dl'], average_length)
+            created[key] = posting.get('created_at')
+
+    # Best score first; newer content wins ties
+    ranked = sorted(scores.items(), key=lambda item: (
+        -item[1], -(created[item[0]].timestamp() if created[item[0]] else 0)))
+    start = (max(page, 1) - 1) * per_page
+    hits = [{'kind': kind, 'doc_id': doc_id, 'score': score,
+             'created_at': created[(kind, doc_id)]}
+            for (kind, doc_id), score in ranked[start:start + per_page]]
+    return hits, len(ranked)
+
+
+def load_hits(db, hits):
+    """Attach the notice or message document to each hit (two queries)"""
+    ids = defaultdict(list)
+    for hit in hits:
+        ids[hit['kind']].append(hit['doc_id'])
+    found = {}
+    if ids['notice']:
+        for doc in db.notices.find({'_id': {'$in': ids['notice']}},
+                                   {'title': 1, 'content': 1, 'priority': 1, 'created_at': 1}):
+            found[('notice', doc['_id'])] = doc
+    if ids['message']:
+        for doc in db.messages.find({'_id': {'$in': ids['message']}},
+                                    {'content': 1, 'user_name': 1, 'created_at': 1}):
+            found[('message', doc['_id'])] = doc
+    for hit in hits:
+        hit['doc'] = found.get((hit['kind'], hit['doc_id']))
+    return [hit for hit in hits if hit['doc']]
+
+
+def _sources(db):
+    return (('notice', db.notices, notice_text,
+             {'title': 1, 'content': 1, 'society_id': 1, 'created_at': 1}),
+            ('message', db.messages, message_text,
+             {'content': 1, 'society_id': 1, 'created_at': 1}))
+
+
+def rebuild_index(db, batch_size=5000):
+    """Recreate the whole index from the notices and messages collections.
+
+    The index is built in scratch collections and swapped in with
+    renameCollection, so searches use the old index until then. Notices and
+    messages added or removed during the rebuild were applied to the old
+    index, so they are applied again to the new one after the swap. Writes
+    within a few milliseconds of the swap itself can still be missed.
+    """
+    as_of = datetime.utcnow()
+    scratch = {name: db[name + REBUILD_SUFFIX] for name in INDEX_COLLECTIONS}
+    for collection in scratch.values():
+        collection.drop()
+    create_search_indexes(scratch['search_postings'])
+
+    frequencies = Counter()
+    stats = defaultdict(lambda: {'docs': 0, 'total_len': 0})
+    batch = []
+    indexed = 0
+    before = {'created_at': {'$not': {'$gte': as_of}}}
+
+    # First pass: document lengths, which the impact of every posting needs
+    for kind, collection, text_of, projection in _sources(db):
+        for doc in collection.find(before, projection).batch_size(batch_size):
+            length = len(tokenize(text_of(doc)))
+            if length:
+                stats[doc.get('society_id')]['docs'] += 1
+                stats[doc.get('society_id')]['total_len'] += length
+    averages = {society_id: _average_length(values) for society_id, values in stats.items()}
+
+    for kind, collection, text_of, projection in _sources(db):
+        for doc in collection.find(before, projection).batch_size(batch_size):
+            society_id = doc.get('society_id')
+            postings, length = _postings(society_id, kind, doc, text_of(doc),
+                                         averages.get(society_id))
+            if not postings:
+                continue
+            batch.extend(postings)
+            frequencies.update(_term_id(society_id, p['term']) for p in postings)
+            indexed += 1
+            if len(batch) >= batch_size:
+                scratch['search_postings'].insert_many(batch, ordered=False)
+                batch = []
+    if batch:
+        scratch['search_postings'].insert_many(batch, ordered=False)
+
+    terms = [{'_id': term_id, 'df': df} for term_id, df in frequencies.items()]
+    for start in range(0, len(terms), batch_size):
+        scratch['search_terms'].insert_many(terms[start:start + batch_size], ordered=False)
+    if stats:
+        scratch['search_stats'].insert_many(
+            [dict(values, _id=society_id) for society_id, values in stats.items()])
+
+    for name, collection in scratch.items():
+        collection.rename(name, dropTarget=True)
+    swapped_at = datetime.utcnow()
+
+    during = {'$gte': as_of, '$lt': swapped_at}
+    for kind, collection, text_of, projection in _sources(db):
+        for doc in collection.find({'created_at': during}, projection):
+            index_document(db, doc.get('society_id'), kind, doc, text_of(doc))
+            indexed += 1
+    removed = defaultdict(list)
+    for doc in db.deletions.find({'kind': {'$in': ['notices', 'messages']}, 'at': during},
+                                 {'society_id': 1, 'kind': 1, 'doc_id': 1}):
+        removed[(doc['society_id'], doc['kind'][:-1])].append(doc['doc_id'])
+    for (society_id, kind), doc_ids in removed.items():
+        remove_documents(db, society_id, kind, doc_ids)
+    return indexed
+
+
+def benchmark(db, documents=1000000, queries=200, seed=7):
+    """Index synthetic chat messages into db and time ranked queries"""
+    from datetime import datetime, timedelta
+    from models import create_indexes
+
+    rng = random.Random(seed)
+    vocabulary = ['w%d' % i for i in range(50000)] + [
+        'water', 'tank', 'cleaning', 'lift', 'parking', 'leak', 'meeting',
+        'generator', 'security', 'gate', 'garbage', 'painting']
+    # Zipf-like word choice so a few terms are very common, as in real chat
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    rng.shuffle(weights)
+
+    db.messages.drop()
+    create_indexes(db)
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    for offset in range(0, documents, 10000):
+        count = min(10000, documents - offset)
+        db.messages.insert_many([{
+            'society_id': 'benchmark',
+            'content': ' '.join(rng.choices(vocabulary, weights, k=rng.randint(5, 40))),
+            'created_at': now - timedelta(seconds=offset + i)
+        } for i in range(count)], ordered=False)
+    print('inserted %d messages in %.1fs' % (documents, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    rebuild_index(db)
+    print('built index in %.1fs' % (time.perf_counter() - started))
+
+    samples = [' '.join(rng.choices(vocabulary[-12:] + vocabulary[:2000], k=rng.randint(1, 3)))
+               for _ in range(queries)]
+    latencies = []
+    matching = read = 0
+    for query in samples:
+        started = time.perf_counter()
+        hits, _ = search(db, 'benchmark', query)
+        load_hits(db, hits)
+        latencies.append((time.perf_counter() - started) * 1000)
+        for term in set(tokenize(query)):
+            df = (db.search_terms.find_one({'_id': _term_id('benchmark', term)}) or {}).get('df', 0)
+            matching += df
+            read += min(df, SEARCH_SETTINGS['max_postings_per_term'])
+    latencies.sort()
+    print('%d queries: p50 %.1fms, p95 %.1fms, max %.1fms' % (
+        len(latencies), latencies[len(latencies) // 2],
+        latencies[int(len(latencies) * 0.95)], latencies[-1]))
+    print('postings read per query: %.0f of %.0f matching' % (
+        read / len(samples), matching / len(samples)))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if sys.argv[1:] else None
+    if command not in ('rebuild', 'benchmark'):
+        sys.exit('usage: python search.py rebuild | benchmark [documents]')
+    from worker import get_database
+    database = get_database()
+    if command == 'rebuild':
+        print('Indexed %d documents' % rebuild_index(database))
+    else:
+        # Never benchmark against live data
+        scratch = database.client[database.name + '_search_benchmark']
+        benchmark(scratch, *[int(arg) for arg in sys.argv[2:3]])
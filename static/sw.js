@@ -0,0 +1,265 @@
+// Service worker for the installable community app.
+//
+// - The offline shell (/offline, styles, manifest, icon) is precached.
+// - Dashboard, notices, service requests and chat are served from cache at
+//   once and refreshed in the background with If-None-Match; the server
+//   answers 304 while nothing changed (see offline.py).
+// - Service request and chat posts made offline are kept in IndexedDB and
+//   sent on background sync, or when a page reports it is back online.
+//   Each post records the user who made it. Pages tell the worker who is
+//   logged in; posts are only sent while that same user is, and another
+//   user's posts are dropped as soon as a page reports a different login.
+//
+// base.html registers /sw.js?v=<asset version>. The version names the
+// caches, so a deploy that changes templates or static files replaces them.
+'use strict';
+
+const VERSION = new URL(self.location).searchParams.get('v') || 'dev';
+const SHELL_CACHE = 'shell-' + VERSION;
+const PAGE_CACHE = 'pages-' + VERSION;
+const SHELL_URLS = ['/offline', '/static/style.css', '/static/manifest.json', '/static/icon.svg'];
+const PAGES = ['/dashboard', '/notices', '/service_requests', '/chat'];
+const OUTBOX_URLS = ['/service_requests', '/chat'];
+const OUTBOX_DB = 'community-outbox';
+const OUTBOX_DB_VERSION = 2;
+
+let flushing = null;
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => Promise.all(SHELL_URLS.map(url =>
+        // Without cookies, so the shell carries no user's data or flashed messages
+        fetch(url, {credentials: 'omit'}).then(response => {
+            if (!response.ok) {
+                throw new Error('Could not precache ' + url);
+            }
+            return cache.put(url, response);
+        })
+    ))).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys().then(keys => Promise.all(keys
+        .filter(key => key !== SHELL_CACHE && key !== PAGE_CACHE)
+        .map(key => caches.delete(key))
+    )).then(() => self.clients.claim()).then(() => flushOutbox().catch(() => {})));
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        return;
+    }
+
+    // Someone else may use the device next: drop the cached pages, and on
+    // logout also whatever this user had not sent yet
+    if (url.pathname === '/logout') {
+        event.waitUntil(forgetUser(true));
+        return;
+    }
+    if (url.pathname === '/login' && request.method === 'POST') {
+        // Nothing is sent until a page says who logged in
+        event.waitUntil(forgetUser(false));
+        return;
+    }
+
+    if (request.method === 'POST' && OUTBOX_URLS.includes(url.pathname)) {
+        event.respondWith(postOrQueue(event, url.pathname));
+        return;
+    }
+    if (request.method !== 'GET') {
+        return;
+    }
+    if (url.pathname.startsWith('/static/')) {
+        event.respondWith(caches.match(request, {ignoreSearch: true})
+            .then(cached => cached || fetch(request)));
+    } else if (request.mode === 'navigate' && PAGES.includes(url.pathname)) {
+        event.respondWith(staleWhileRevalidate(event, url.pathname));
+    } else if (request.mode === 'navigate') {
+        event.respondWith(fetch(request).catch(offlinePage));
+    }
+});
+
+self.addEventListener('sync', event => {
+    if (event.tag === 'outbox') {
+        // A rejection makes the browser retry the sync later
+        event.waitUntil(flushOutbox());
+    }
+});
+
+self.addEventListener('message', event => {
+    if (event.data && event.data.type === 'flush-outbox') {
+        const known = event.data.user ? setUser(event.data.user) : Promise.resolve();
+        event.waitUntil(known.then(flushOutbox).catch(() => {}));
+    }
+});
+
+// Pages
+
+function offlinePage() {
+    return caches.match('/offline');
+}
+
+function cacheable(response) {
+    // Redirects (to login, say) and pages showing flashed messages carry no ETag
+    return response.ok && response.type === 'basic' && !response.redirected &&
+        response.headers.has('ETag');
+}
+
+function staleWhileRevalidate(event, path) {
+    return caches.open(PAGE_CACHE).then(cache => cache.match(path).then(cached => {
+        if (cached) {
+            event.waitUntil(revalidate(cache, path, cached));
+            return cached;
+        }
+        return fetch(event.request).then(response => {
+            if (cacheable(response)) {
+                event.waitUntil(cache.put(path, response.clone()));
+            }
+            return response;
+        }).catch(offlinePage);
+    }));
+}
+
+function revalidate(cache, path, cached) {
+    const etag = cached && cached.headers.get('ETag');
+    return fetch(path, {
+        credentials: 'same-origin',
+        cache: 'no-store',
+        headers: etag ? {'If-None-Match': etag} : {}
+    }).then(response => {
+        if (response.status === 304) {
+            return;
+        }
+        if (response.redirected) {
+            return cache.delete(path);  // logged out
+        }
+        if (cacheable(response)) {
+            return cache.put(path, response).then(() => notifyUpdated(path));
+        }
+    }).catch(() => {});
+}
+
+function refresh(path) {
+    return caches.open(PAGE_CACHE).then(cache => cache.match(path)
+        .then(cached => revalidate(cache, path, cached)));
+}
+
+function notifyUpdated(path) {
+    return self.clients.matchAll({type: 'window'}).then(clients => clients.forEach(client => {
+        client.postMessage({type: 'page-updated', path: path});
+    }));
+}
+
+function forgetUser(clearOutbox) {
+    const work = [caches.delete(PAGE_CACHE), outbox('readwrite', store => store.delete('user'), 'session')];
+    if (clearOutbox) {
+        work.push(outbox('readwrite', store => store.clear()));
+    }
+    return Promise.all(work);
+}
+
+function currentUser() {
+    return outbox('readonly', store => store.get('user'), 'session');
+}
+
+function setUser(user) {
+    // Posts someone else queued on this device must never go out as this user
+    return outbox('readwrite', store => store.put(user, 'user'), 'session')
+        .then(() => outbox('readwrite', store => {
+            const request = store.openCursor();
+            request.onsuccess = () => {
+                const cursor = request.result;
+                if (cursor) {
+                    if (cursor.value.user !== user) {
+                        cursor.delete();
+                    }
+                    cursor.continue();
+                }
+            };
+            return request;
+        }));
+}
+
+// Outbox
+
+function openOutbox() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(OUTBOX_DB, OUTBOX_DB_VERSION);
+        open.onupgradeneeded = event => {
+            if (event.oldVersion < 1) {
+                open.result.createObjectStore('posts', {keyPath: 'id', autoIncrement: true});
+            } else {
+                // Posts from version 1 do not say whose they are
+                open.transaction.objectStore('posts').clear();
+            }
+            open.result.createObjectStore('session');
+        };
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+function outbox(mode, work, storeName) {
+    storeName = storeName || 'posts';
+    return openOutbox().then(db => new Promise((resolve, reject) => {
+        const transaction = db.transaction(storeName, mode);
+        const pending = work(transaction.objectStore(storeName));
+        transaction.oncomplete = () => {
+            db.close();
+            resolve(pending.result);
+        };
+        transaction.onerror = () => {
+            db.close();
+            reject(transaction.error);
+        };
+    }));
+}
+
+function postOrQueue(event, path) {
+    // Read the form before the network attempt consumes the body
+    const form = event.request.clone().formData();
+    return fetch(event.request).then(response => {
+        event.waitUntil(refresh(path));
+        return response;
+    }).catch(() => Promise.all([form, currentUser()]).then(([data, user]) => {
+        if (!user) {
+            return offlinePage();  // no page has said who is logged in
+        }
+        const fields = [];
+        data.forEach((value, name) => fields.push([name, value]));  // files included
+        return outbox('readwrite', store => store.add({
+            url: path, fields: fields, user: user, queued_at: Date.now()
+        })).then(() => {
+            if (self.registration.sync) {
+                return self.registration.sync.register('outbox').catch(() => {});
+            }
+        }).then(() => Response.redirect(path + '?queued=1', 303));
+    }));
+}
+
+function flushOutbox() {
+    if (!flushing) {
+        flushing = Promise.all([currentUser(), outbox('readonly', store => store.getAll())])
+            .then(([user, posts]) => posts
+                .filter(post => user && post.user === user)  // others wait for their own login
+                .reduce((chain, post) => chain.then(() => send(post)), Promise.resolve()))
+            .finally(() => {
+                flushing = null;
+            });
+    }
+    return flushing;
+}
+
+function send(post) {
+    const body = new FormData();
+    post.fields.forEach(([name, value]) => body.append(name, value));
+    return fetch(post.url, {method: 'POST', body: body, credentials: 'same-origin'}).then(response => {
+        // Keep the post while the session has expired or the server is failing;
+        // anything else (sent, or rejected by validation) leaves the outbox
+        if (response.status >= 500 || new URL(response.url).pathname === '/login') {
+            throw new Error('Outbox post to ' + post.url + ' not accepted yet');
+        }
+        return outbox('readwrite', store => store.delete(post.id)).then(() => refresh(post.url));
+    });
+}
@@ -0,0 +1,286 @@
+"""Multi-society tenancy.
+
+Every tenant-owned document (users, notices, service_requests, messages and
+the per-user/per-society derived collections) carries a ``society_id``.
+Queries are scoped with ``scoped()`` and indexes are prefixed by
+``society_id`` so the collections can later be sharded on it.
+
+Residents join a society with its invite code, which the society's
+secretary hands out and can rotate; new societies are created by an
+operator with their first secretary:
+    python tenancy.py create-society <society_id> <secretary email> [name]
+
+Tag documents created before tenancy with the default society and build
+the email directory:
+    python tenancy.py migrate
+
+Check that per-society query latency stays flat as societies are added:
+    python tenancy.py loadtest [societies...]
+"""
+import getpass
+import random
+import re
+import secrets
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from werkzeug.security import generate_password_hash
+
+from config import TENANCY_SETTINGS
+
+DEFAULT_SOCIETY_ID = TENANCY_SETTINGS['default_society_id']
+TENANT_COLLECTIONS = ('users', 'notices', 'service_requests', 'messages',
+                      'user_counters')
+SOCIETY_ID_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+
+def scoped(society_id, query=None):
+    """Return a copy of query restricted to one society"""
+    scoped_query = dict(query or {})
+    scoped_query['society_id'] = society_id
+    return scoped_query
+
+
+def normalize_society_id(value):
+    """Lower-case a society code, or return None if it is not valid"""
+    value = (value or '').strip().lower()
+    if (not value or len(value) > TENANCY_SETTINGS['society_id_max_length']
+            or not SOCIETY_ID_PATTERN.match(value)):
+        return None
+    return value
+
+
+# Email directory
+#
+# Login is by email alone, so an address must be unique across societies.
+# A sharded collection can only enforce unique indexes that start with its
+# shard key, so users only has a (society_id, email) unique index and the
+# global rule is kept in user_emails, keyed by the address itself.
+
+
+def claim_email(db, email, society_id, user_id, session=None):
+    """Reserve an address for a user; False if another account has it"""
+    try:
+        db.user_emails.insert_one(
+            {'_id': email, 'society_id': society_id, 'user_id': user_id,
+             'claimed_at': datetime.utcnow()}, session=session)
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def claim_emails(db, society_id, claims):
+    """Reserve many (email, user_id) pairs at once; returns the emails that
+    another account already has. A claim whose user was never written (the
+    importer died in between) is taken over once it is a minute old."""
+    if not claims:
+        return set()
+    now = datetime.utcnow()
+    try:
+        db.user_emails.insert_many([
+            {'_id': email, 'society_id': society_id, 'user_id': user_id, 'claimed_at': now}
+            for email, user_id in claims], ordered=False)
+        return set()
+    except BulkWriteError as exc:
+        taken = {claims[error['index']][0] for error in exc.details.get('writeErrors', [])}
+
+    user_ids = dict(claims)
+    entries = list(db.user_emails.find(
+        {'_id': {'$in': list(taken)}, 'claimed_at': {'$lt': now - timedelta(minutes=1)}}))
+    written = {user['_id'] for user in db.users.find(
+        {'_id': {'$in': [entry['user_id'] for entry in entries]}}, {'_id': 1})}
+    for entry in entries:
+        if entry['user_id'] in written:
+            continue
+        result = db.user_emails.update_one(
+            {'_id': entry['_id'], 'user_id': entry['user_id']},
+            {'$set': {'society_id': society_id, 'user_id': user_ids[entry['_id']],
+                      'claimed_at': now}})
+        if result.modified_count:
+            taken.discard(entry['_id'])
+    return taken
+
+
+def release_email(db, email, user_id, session=None):
+    db.user_emails.delete_one({'_id': email, 'user_id': user_id}, session=session)
+
+
+def find_user_by_email(db, email, projection=None):
+    """The account an address belongs to, read with a society-targeted query.
+    Only accounts in the user_emails directory are found; `tenancy.py
+    migrate` adds the ones created before it existed."""
+    entry = db.user_emails.find_one({'_id': email})
+    if entry is None:
+        return None
+    return db.users.find_one(
+        {'society_id': entry['society_id'], '_id': entry['user_id']}, projection)
+
+
+def build_email_directory(db):
+    """Add every existing account to user_emails; returns how many were added"""
+    added = 0
+    for user in db.users.find({'email': {'$nin': [None, '']}},
+                              {'email': 1, 'society_id': 1}):
+        if claim_email(db, user['email'], user.get('society_id', DEFAULT_SOCIETY_ID),
+                       user['_id']):
+            added += 1
+    return added
+
+
+# Societies and invite codes
+
+
+def new_invite_code():
+    return secrets.token_hex(TENANCY_SETTINGS['invite_code_bytes']).upper()
+
+
+def invite_code(db, society_id):
+    """The society's current invite code, created on first use"""
+    society = db.societies.find_one_and_update(
+        {'_id': society_id},
+        {'$setOnInsert': {'invite_code': new_invite_code(),
+                          'created_at': datetime.utcnow()}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return society['invite_code']
+
+
+def rotate_invite_code(db, society_id):
+    """Replace the invite code; the old one stops working at once"""
+    code = new_invite_code()
+    db.societies.update_one(
+        {'_id': society_id},
+        {'$set': {'invite_code': code, 'invite_rotated_at': datetime.utcnow()}},
+        upsert=True)
+    return code
+
+
+def society_for_invite(db, code):
+    """Society id an invite code admits to, or None"""
+    code = (code or '').strip().upper()
+    if not code:
+        return None
+    society = db.societies.find_one({'invite_code': code}, {'_id': 1})
+    return society['_id'] if society else None
+
+
+def create_society(db, society_id, secretary_email, password, name=None):
+    """Create a society with its first secretary; returns the invite code"""
+    if db.societies.find_one({'_id': society_id}):
+        raise ValueError('Society %r already exists' % society_id)
+    user_id = ObjectId()
+    if not claim_email(db, secretary_email, society_id, user_id):
+        raise ValueError('%s is already registered' % secretary_email)
+    db.users.insert_one({
+        '_id': user_id,
+        'name': 'Society Secretary',
+        'email': secretary_email,
+        'apartment': 'Office',
+        'password': generate_password_hash(password),
+        'is_secretary': True,
+        'is_admin': False,
+        'society_id': society_id,
+        'created_at': datetime.utcnow()
+    })
+    code = new_invite_code()
+    db.societies.insert_one({'_id': society_id, 'name': name or society_id,
+                             'invite_code': code, 'created_at': datetime.utcnow()})
+    return code
+
+
+def migrate_default_society(db):
+    """Assign the default society to documents that predate tenancy"""
+    updated = {}
+    for name in TENANT_COLLECTIONS:
+        result = db[name].update_many(
+            {'society_id': {'$exists': False}},
+            {'$set': {'society_id': DEFAULT_SOCIETY_ID}})
+        updated[name] = result.modified_count
+    return updated
+
+
+def load_test(db, society_counts=(1, 10, 100, 1000), docs_per_society=200,
+              queries=2000, seed=7):
+    """Time the dashboard's society-scoped queries as societies are added.
+
+    Runs in a scratch database next to db. For each society count, the
+    societies are filled up to that count and random societies are queried;
+    with society_id-prefixed indexes, latency and documents examined per
+    query should stay flat however many societies share the collections.
+    """
+    from models import create_indexes
+
+    scratch = db.client[db.name + '_tenancy_loadtest']
+    db.client.drop_database(scratch.name)
+    create_indexes(scratch)
+    rng = random.Random(seed)
+    base = datetime.utcnow() - timedelta(days=90)
+    filled = 0
+
+    print('%9s %10s %10s %10s %14s' % ('societies', 'p50 ms', 'p95 ms', 'max ms', 'docs examined'))
+    for count in society_counts:
+        for number in range(filled, count):
+            society_id = 'society-%d' % number
+            user_ids = [ObjectId() for _ in range(20)]
+            times = [base + timedelta(minutes=rng.randrange(90 * 24 * 60))
+                     for _ in range(docs_per_society)]
+            scratch.notices.insert_many([
+                {'society_id': society_id, 'title': 'Notice', 'content': 'x' * 200,
+                 'priority': 'medium', 'created_at': at} for at in times[:20]])
+            scratch.service_requests.insert_many([
+                {'society_id': society_id, 'user_id': rng.choice(user_ids), 'title': 'Leak',
+                 'status': 'pending', 'created_at': at} for at in times[:50]])
+            scratch.messages.insert_many([
+                {'society_id': society_id, 'user_id': rng.choice(user_ids), 'content': 'hi',
+                 'created_at': at} for at in times])
+        filled = count
+
+        samples = []
+        for _ in range(queries):
+            society_id = 'society-%d' % rng.randrange(count)
+            started = time.perf_counter()
+            list(scratch.notices.find({'society_id': society_id}).sort('created_at', -1).limit(5))
+            list(scratch.service_requests.find(
+                {'society_id': society_id, 'user_id': ObjectId()}).sort('created_at', -1).limit(3))
+            list(scratch.messages.find({'society_id': society_id}).sort('created_at', -1).limit(50))
+            samples.append(time.perf_counter() - started)
+        plan = scratch.messages.find({'society_id': 'society-0'}).sort(
+            'created_at', -1).limit(50).explain()
+        examined = plan.get('executionStats', {}).get('totalDocsExamined', 'n/a')
+        samples.sort()
+        print('%9d %10.2f %10.2f %10.2f %14s' % (
+            count, samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.95)] * 1000,
+            samples[-1] * 1000, examined))
+    db.client.drop_database(scratch.name)
+
+
+if __name__ == '__main__':
+    from worker import get_database
+    command = sys.argv[1] if sys.argv[1:] else None
+    if command == 'migrate':
+        from analytics import backfill_rollups
+        db = get_database()
+        for name, count in migrate_default_society(db).items():
+            print('%s: %d document(s) moved to society %r' % (name, count, DEFAULT_SOCIETY_ID))
+        print('Added %d account(s) to the email directory' % build_email_directory(db))
+        if 'email_1' in db.users.index_information():
+            # Replaced by (society_id, email) and user_emails; blocks sharding
+            db.users.drop_index('email_1')
+        # Rollup ids include the society, so rebuild them
+        print('Rebuilt %d rollup documents' % backfill_rollups(db))
+    elif command == 'create-society' and len(sys.argv) in (4, 5):
+        society_id = normalize_society_id(sys.argv[2])
+        if not society_id:
+            sys.exit('Society ids may only contain letters, digits and hyphens.')
+        password = getpass.getpass('Password for %s: ' % sys.argv[3])
+        code = create_society(get_database(), society_id, sys.argv[3], password,
+                              sys.argv[4] if len(sys.argv) == 5 else None)
+        print('Created %s. Residents register with invite code %s' % (society_id, code))
+    elif command == 'loadtest':
+        load_test(get_database(), *([[int(arg) for arg in sys.argv[2:]]] if sys.argv[2:] else []))
+    else:
+        sys.exit('usage: python tenancy.py migrate | create-society <society_id> '
+                 '<secretary email> [name] | loadtest [societies...]')
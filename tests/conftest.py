@@ -0,0 +1,86 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().hyperlocal_community_test
+
+
+class CausalSession:
+    """Stands in for pymongo's ClientSession, which mongomock lacks. It
+    records where it was advanced to and, like a real session after a
+    write, reports an operation time of its own."""
+
+    def __init__(self, client):
+        self.client = client
+        self.advanced_to = None
+        self.cluster_time = None
+        self.operation_time = None
+
+    def advance_cluster_time(self, cluster_time):
+        self.cluster_time = cluster_time
+
+    def advance_operation_time(self, operation_time):
+        self.advanced_to = operation_time
+
+    def end_session(self):
+        pass
+
+
+class SessionClient:
+    def __init__(self):
+        self.sessions = []
+
+    def start_session(self, causal_consistency=False):
+        from bson.timestamp import Timestamp
+        session = CausalSession(self)
+        session.cluster_time = {'clusterTime': Timestamp(len(self.sessions) + 1, 1)}
+        session.operation_time = Timestamp(len(self.sessions) + 1, 1)
+        self.sessions.append(session)
+        return session
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    """Flask test client for app.py running against the mongomock db"""
+    import app as app_module
+    from read_routing import ReadRouter
+
+    monkeypatch.setattr(app_module.mongo, 'db', db)
+    monkeypatch.setattr(app_module.mongo, 'cx', SessionClient())
+    monkeypatch.setattr(app_module, 'read_router', ReadRouter(db))
+    app_module.app.config['TESTING'] = True
+    # Operations run with session=...; mongomock runs them without one
+    mongomock.ignore_feature('session')
+    yield app_module.app.test_client()
+    mongomock.warn_on_feature('session')
+
+
+
+def _login(client, db, **fields):
+    user = dict({'name': 'Asha', 'email': 'asha@example.com', 'apartment': 'B-2',
+                 'password': '', 'is_secretary': False, 'society_id': 'default'}, **fields)
+    user['_id'] = db.users.insert_one(user).inserted_id
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = str(user['_id'])
+        flask_session['society_id'] = user['society_id']
+    return user
+
+
+@pytest.fixture
+def resident(client, db):
+    """A resident of the default society, logged in on client"""
+    return _login(client, db)
+
+
+@pytest.fixture
+def secretary(client, db):
+    """The default society's secretary, logged in on client"""
+    return _login(client, db, name='Society Secretary', email='secretary@example.com',
+                  apartment='Office', is_secretary=True)
@@ -0,0 +1,58 @@
+import time
+from datetime import datetime, timedelta
+
+import analytics
+from analytics import backfill_rollups, record_created, record_transition
+
+
+def add_request(db, created_at, history=(), category='plumbing', priority='urgent'):
+    request_doc = {'society_id': 'default', 'category': category, 'priority': priority,
+                   'status': history[-1]['status'] if history else 'pending',
+                   'created_at': created_at, 'status_history': list(history)}
+    request_doc['_id'] = db.service_requests.insert_one(request_doc).inserted_id
+    return request_doc
+
+
+def totals(db):
+    fields = ('created', 'resolved', 'resolve_samples')
+    return {field: sum(doc.get(field, 0) for doc in db.request_rollups.find())
+            for field in fields}
+
+
+def test_backfill_rebuilds_from_history(db):
+    created = datetime.utcnow() - timedelta(days=3)
+    add_request(db, created, [{'status': 'resolved', 'at': created + timedelta(hours=5)}])
+    add_request(db, created)
+    db.request_rollups.insert_one({'_id': 'stale', 'society_id': 'default', 'created': 99})
+
+    backfill_rollups(db)
+    assert totals(db) == {'created': 2, 'resolved': 1, 'resolve_samples': 1}
+    assert db.request_rollups.find_one({'_id': 'stale'}) is None
+    assert analytics.REBUILD_COLLECTION not in db.list_collection_names()
+
+
+def test_live_updates_during_backfill_are_kept(db, monkeypatch):
+    earlier = datetime.utcnow() - timedelta(days=1)
+    old = add_request(db, earlier)
+    scan = analytics._tally
+    live = []
+
+    def tally_then_write_live(db_, query, start=None, end=None, batch_size=1000):
+        result = scan(db_, query, start, end, batch_size)
+        if not live:
+            # A request and a resolution arrive after the scan, before the swap
+            now = datetime.utcnow()
+            live.append(add_request(db, now))
+            record_created(db, live[0])
+            db.service_requests.update_one(
+                {'_id': old['_id']},
+                {'$set': {'status': 'resolved'},
+                 '$push': {'status_history': {'status': 'resolved', 'at': now}}})
+            record_transition(db, old, 'pending', 'resolved', now)
+            # Keep the swap out of the live write's millisecond (see backfill_rollups)
+            time.sleep(0.005)
+        return result
+
+    monkeypatch.setattr(analytics, '_tally', tally_then_write_live)
+    backfill_rollups(db)
+    assert totals(db) == {'created': 2, 'resolved': 1, 'resolve_samples': 1}
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as app_module
+from api import backfill_change_times, issue_token
+
+
+@pytest.fixture
+def auth(client, resident):
+    with app_module.app.test_request_context():
+        return {'Authorization': 'Bearer %s' % issue_token(resident)}
+
+
+def poll(client, auth, path, since, limit):
+    """Follow the since cursor until has_more is false; returns every page"""
+    pages = []
+    params = {'since': since.isoformat() + 'Z', 'limit': limit}
+    while True:
+        page = client.get(path, query_string=params, headers=auth).get_json()
+        pages.append(page)
+        if not page['has_more']:
+            return pages
+        params = {'since': page['next_since'], 'after': page['next_after'], 'limit': limit}
+
+
+def test_since_pages_through_more_than_limit(client, db, auth):
+    since = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    # Three share a timestamp, so a page boundary falls inside the tie
+    times = [since + timedelta(minutes=m) for m in (1, 2, 3, 3, 3, 4, 5)]
+    ids = db.notices.insert_many([{'society_id': 'default', 'title': 'N%d' % i,
+                                   'created_at': at} for i, at in enumerate(times)]).inserted_ids
+
+    pages = poll(client, auth, '/api/v1/notices', since, limit=2)
+    seen = [notice['_id'] for page in pages for notice in page['notices']]
+    assert seen == [str(notice_id) for notice_id in ids]
+    assert len(pages) == 4
+    assert [page['has_more'] for page in pages] == [True, True, True, False]
+
+
+def test_service_request_changes_follow_status_changes(client, db, auth, resident):
+    since = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    old = db.service_requests.insert_one({
+        'society_id': 'default', 'user_id': resident['_id'], 'title': 'Old',
+        'status': 'resolved', 'created_at': since - timedelta(days=3),
+        'status_changed_at': since + timedelta(minutes=30)}).inserted_id
+    new = db.service_requests.insert_many([{
+        'society_id': 'default', 'user_id': resident['_id'], 'title': 'New %d' % i,
+        'status': 'pending', 'created_at': since + timedelta(minutes=i),
+        'status_changed_at': since + timedelta(minutes=i)} for i in range(1, 4)]).inserted_ids
+    db.service_requests.insert_one({
+        'society_id': 'default', 'user_id': resident['_id'], 'title': 'Unchanged',
+        'status': 'pending', 'created_at': since - timedelta(days=1),
+        'status_changed_at': since - timedelta(days=1)})
+
+    pages = poll(client, auth, '/api/v1/service_requests', since, limit=2)
+    seen = [item['_id'] for page in pages for item in page['service_requests']]
+    assert seen == [str(i) for i in new] + [str(old)]
+
+
+def test_next_since_without_more_pages_is_now(client, db, auth):
+    since = datetime.utcnow() - timedelta(minutes=5)
+    page = client.get('/api/v1/chat', query_string={'since': since.isoformat() + 'Z'},
+                      headers=auth).get_json()
+    assert page['has_more'] is False and 'next_after' not in page
+    assert page['next_since'] > since.isoformat()
+
+
+def test_bad_after_is_rejected(client, auth):
+    since = (datetime.utcnow() - timedelta(minutes=5)).isoformat() + 'Z'
+    response = client.get('/api/v1/notices', query_string={'since': since, 'after': 'x'},
+                          headers=auth)
+    assert response.status_code == 400
+
+
+def test_backfill_change_times(db):
+    created = datetime(2026, 1, 1)
+    db.service_requests.insert_many([
+        {'created_at': created},
+        {'created_at': created, 'status_changed_at': created + timedelta(days=1)}])
+    assert backfill_change_times(db) == 1
+    assert db.service_requests.count_documents({'status_changed_at': created}) == 1
@@ -0,0 +1,196 @@
+import io
+from datetime import datetime
+
+import gridfs
+import pytest
+from bson import ObjectId
+from PIL import Image
+
+import app as app_module
+import attachments
+from config import UPLOAD_SETTINGS
+from jobs import claim_job, run_job
+
+
+class StoredFile(io.BytesIO):
+    """What GridFSBucket.open_download_stream returns: a seekable file
+    with the GridFS fields"""
+
+    def __init__(self, file_id, filename, data, metadata):
+        super().__init__(data)
+        self._id = file_id
+        self.filename = filename
+        self.length = len(data)
+        self.metadata = metadata
+        self.upload_date = datetime(2026, 1, 1, 9, 0)
+
+
+class Upload(io.BytesIO):
+    def __init__(self, bucket, filename, metadata):
+        super().__init__()
+        self.bucket = bucket
+        self._id = ObjectId()
+        self.filename = filename
+        self.metadata = metadata
+
+    def abort(self):
+        pass
+
+    def close(self):
+        self.bucket.files[self._id] = (self.filename, self.getvalue(), self.metadata)
+
+
+class MemoryBucket:
+    """Stands in for GridFSBucket, which mongomock does not support"""
+
+    def __init__(self):
+        self.files = {}
+
+    def open_upload_stream(self, filename, metadata=None):
+        return Upload(self, filename, metadata)
+
+    def upload_from_stream(self, filename, source, metadata=None):
+        upload = self.open_upload_stream(filename, metadata)
+        upload.write(source.read())
+        upload.close()
+        return upload._id
+
+    def open_download_stream(self, file_id):
+        if file_id not in self.files:
+            raise gridfs.errors.NoFile(file_id)
+        return StoredFile(file_id, *self.files[file_id])
+
+    def delete(self, file_id):
+        del self.files[file_id]
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = MemoryBucket()
+    monkeypatch.setattr(attachments, 'get_bucket', lambda db: bucket)
+    return bucket
+
+
+def image_bytes(size=(800, 600), mode='RGB'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, 'teal').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def submit(client, *files):
+    return client.post('/service_requests', data={
+        'title': 'Leak', 'description': 'Kitchen tap', 'category': 'plumbing',
+        'priority': 'high', 'attachments': [(io.BytesIO(data), name) for name, data in files]
+    }, content_type='multipart/form-data')
+
+
+def test_upload_is_stored_and_queues_a_thumbnail(client, db, resident, bucket):
+    submit(client, ('tap.png', image_bytes()), ('quote.pdf', b'%PDF-1.4'))
+    stored = db.service_requests.find_one()
+    assert [a['filename'] for a in stored['attachments']] == ['tap.png', 'quote.pdf']
+    assert len(bucket.files) == 2
+    assert [job['kind'] for job in db.jobs.find()] == ['attachment_thumbnail']
+
+
+@pytest.mark.parametrize('files, message', [
+    ([('run.exe', b'MZ')], b'run.exe is not an allowed file type.'),
+    ([('photo%d.png' % i, b'x') for i in range(6)], b'You can attach at most 5 files.'),
+])
+def test_rejected_uploads_store_nothing(client, db, resident, bucket, files, message):
+    response = submit(client, *files)
+    assert message in client.get(response.location).data
+    assert db.service_requests.count_documents({}) == 0
+    assert bucket.files == {}
+
+
+def test_each_file_is_held_to_the_per_file_limit(client, db, resident, bucket, monkeypatch):
+    monkeypatch.setitem(UPLOAD_SETTINGS, 'max_file_size', 1024 * 1024)
+    response = submit(client, ('small.pdf', b'x' * 1000), ('big.pdf', b'x' * (1024 * 1024 + 1)))
+    assert b'big.pdf is larger than 1 MB.' in client.get(response.location).data
+    assert db.service_requests.count_documents({}) == 0
+    assert bucket.files == {}
+
+
+def test_request_body_limit_allows_a_full_set_of_files():
+    assert app_module.app.config['MAX_CONTENT_LENGTH'] >= (
+        UPLOAD_SETTINGS['max_files_per_request'] * UPLOAD_SETTINGS['max_file_size'])
+
+
+def test_oversized_request_body_is_flashed_and_redirected(client, resident, bucket, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_CONTENT_LENGTH', 1000)
+    response = client.post('/service_requests', data={
+        'title': 'Leak', 'attachments': (io.BytesIO(b'x' * 5000), 'big.pdf')
+    }, content_type='multipart/form-data',
+        headers={'Referer': 'http://localhost/service_requests'})
+    assert response.status_code == 302
+    assert response.location.endswith('/service_requests')
+    assert b'Uploads are limited to 5 files' in client.get('/dashboard').data
+
+
+@pytest.fixture
+def stored(db, resident, bucket):
+    file_id = bucket.upload_from_stream('report.pdf', io.BytesIO(bytes(range(256)) * 4), {
+        'user_id': resident['_id'], 'society_id': 'default',
+        'content_type': 'application/pdf'})
+    return file_id
+
+
+def test_download_supports_ranges(client, stored):
+    response = client.get('/attachments/%s' % stored, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/1024'
+    assert response.data == bytes(range(10, 20))
+
+
+def test_download_revalidates_with_etag(client, stored):
+    response = client.get('/attachments/%s' % stored)
+    assert response.status_code == 200
+    assert len(response.data) == 1024
+    etag = response.headers['ETag']
+
+    response = client.get('/attachments/%s' % stored, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_download_is_limited_to_the_owner(client, db, bucket, stored):
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = str(db.users.insert_one({
+            'name': 'Ravi', 'society_id': 'default', 'is_secretary': False}).inserted_id)
+    assert client.get('/attachments/%s' % stored).status_code == 403
+    assert client.get('/attachments/not-an-id').status_code == 404
+
+
+def attach(db, bucket, data, filename='photo.png'):
+    file_id = bucket.upload_from_stream(filename, io.BytesIO(data), {'society_id': 'default'})
+    db.service_requests.insert_one({'society_id': 'default', 'attachments': [
+        {'file_id': file_id, 'filename': filename}]})
+    attachments.enqueue_thumbnails(db, [{'file_id': file_id, 'filename': filename}])
+    return file_id
+
+
+def test_thumbnail_is_generated(db, bucket):
+    attach(db, bucket, image_bytes(mode='RGBA'))
+    assert run_job(db, claim_job(db, 'test'))
+
+    thumbnail_id = db.service_requests.find_one()['attachments'][0]['thumbnail_id']
+    thumbnail = Image.open(bucket.open_download_stream(thumbnail_id))
+    assert thumbnail.format == 'JPEG'
+    assert thumbnail.size == (320, 240)
+
+
+@pytest.mark.parametrize('data', [image_bytes()[:200], b'not an image at all'],
+                         ids=['truncated', 'not-an-image'])
+def test_unreadable_images_complete_without_a_thumbnail(db, bucket, data):
+    attach(db, bucket, data)
+    assert run_job(db, claim_job(db, 'test'))
+    assert db.service_requests.find_one()['attachments'][0]['thumbnail_id'] is None
+    assert db.jobs.find_one()['status'] == 'done'
+    assert db.dead_jobs.count_documents({}) == 0
+
+
+def test_decompression_bombs_complete_without_a_thumbnail(db, bucket, monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    attach(db, bucket, image_bytes())
+    assert run_job(db, claim_job(db, 'test'))
+    assert db.service_requests.find_one()['attachments'][0]['thumbnail_id'] is None
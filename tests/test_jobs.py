@@ -0,0 +1,106 @@
+"""Notice email delivery through the job queue against a local SMTP server"""
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import jobs
+import mailer
+from config import JOB_SETTINGS
+from jobs import claim_job, enqueue_job, run_job, run_worker
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 OK'
+
+
+class MailSettings:
+    MAIL_SERVER = '127.0.0.1'
+    MAIL_USE_TLS = False
+    MAIL_USERNAME = None
+    MAIL_PASSWORD = None
+    MAIL_DEFAULT_SENDER = 'noreply@community.test'
+    MAIL_TIMEOUT = 5
+
+    def __init__(self, port):
+        self.MAIL_PORT = port
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+
+def add_notice(db, residents):
+    db.users.insert_many([
+        {'name': 'Resident %d' % i, 'email': 'r%d@example.com' % i,
+         'is_secretary': False, 'society_id': 'default'} for i in range(residents)])
+    return db.notices.insert_one({'title': 'Water cut', 'content': 'Tank cleaning',
+                                  'priority': 'high', 'society_id': 'default'}).inserted_id
+
+
+def test_notice_is_fanned_out_sent_and_acked(db, smtp_server, monkeypatch):
+    controller, handler = smtp_server
+    monkeypatch.setattr(mailer, 'get_config', lambda: MailSettings(controller.port))
+    monkeypatch.setitem(JOB_SETTINGS, 'email_batch_size', 2)
+    notice_id = add_notice(db, residents=5)
+
+    enqueue_job(db, 'notice_fanout', {'notice_id': notice_id, 'society_id': 'default'})
+    run_worker(db, worker_id='test', once=True)
+
+    recipients = sorted(rcpt for envelope in handler.envelopes for rcpt in envelope.rcpt_tos)
+    assert recipients == ['r%d@example.com' % i for i in range(5)]
+    assert b'Subject: [High] Water cut' in handler.envelopes[0].content
+    # One fan-out job and three batches of at most two, all acknowledged
+    statuses = [job['status'] for job in db.jobs.find()]
+    assert len(statuses) == 4 and set(statuses) == {'done'}
+    assert db.dead_jobs.count_documents({}) == 0
+
+
+def test_failed_delivery_backs_off_then_goes_to_dead_jobs(db, monkeypatch):
+    # Nothing listens on this port, so every connection is refused
+    monkeypatch.setattr(mailer, 'get_config', lambda: MailSettings(free_port()))
+    notice_id = add_notice(db, residents=1)
+    job_id = enqueue_job(db, 'notice_email_batch',
+                         {'notice_id': notice_id, 'recipients': ['r0@example.com']},
+                         max_attempts=2)
+
+    before = datetime.utcnow()
+    assert run_job(db, claim_job(db, 'test')) is False
+    job = db.jobs.find_one({'_id': job_id})
+    assert job['status'] == 'queued' and job['attempts'] == 1
+    assert 'ConnectionRefusedError' in job['last_error']
+    base = JOB_SETTINGS['backoff_base_seconds']
+    assert before + timedelta(seconds=base * 0.8) <= job['run_at']
+    assert job['run_at'] <= datetime.utcnow() + timedelta(seconds=base * 1.2)
+    # Not due yet
+    assert claim_job(db, 'test') is None
+
+    db.jobs.update_one({'_id': job_id}, {'$set': {'run_at': datetime.utcnow()}})
+    assert run_job(db, claim_job(db, 'test')) is False
+    assert db.jobs.count_documents({}) == 0
+    dead = db.dead_jobs.find_one({'_id': job_id})
+    assert dead['status'] == 'dead' and dead['attempts'] == 2
+
+
+def test_retry_delay_grows_exponentially_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(jobs.random, 'uniform', lambda low, high: 1.0)
+    base = JOB_SETTINGS['backoff_base_seconds']
+    assert [jobs.retry_delay(n) for n in (1, 2, 3)] == [base, base * 2, base * 4]
+    assert jobs.retry_delay(50) == JOB_SETTINGS['backoff_max_seconds']
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from config import MODERATION_SETTINGS
+from jobs import claim_job, run_job
+
+
+def add_messages(db, user_id, count):
+    now = datetime.utcnow()
+    db.messages.insert_many([
+        {'society_id': 'default', 'user_id': user_id, 'user_name': 'Spammer',
+         'content': 'buy now %d' % i, 'created_at': now - timedelta(minutes=i)}
+        for i in range(count)])
+
+
+def test_dry_run_counts_without_deleting(client, db, secretary):
+    spammer = ObjectId()
+    add_messages(db, spammer, 3)
+    response = client.post('/secretary/moderation/messages',
+                           data={'author_id': str(spammer), 'dry_run': '1'})
+    assert response.get_json()['matched'] == 3
+    assert db.messages.count_documents({}) == 3
+    assert db.jobs.count_documents({}) == 0
+
+
+def test_purge_runs_as_a_job(client, db, secretary, monkeypatch):
+    monkeypatch.setitem(MODERATION_SETTINGS, 'batch_size', 2)
+    monkeypatch.setitem(MODERATION_SETTINGS, 'batch_pause_seconds', 0)
+    spammer = ObjectId()
+    add_messages(db, spammer, 5)
+    add_messages(db, ObjectId(), 1)
+
+    response = client.post('/secretary/moderation/messages', data={'author_id': str(spammer)})
+    assert response.status_code == 202
+    status_url = response.get_json()['status_url']
+    # Nothing is deleted inside the request
+    assert db.messages.count_documents({}) == 6
+    assert client.get(status_url).get_json()['status'] == 'queued'
+
+    run_job(db, claim_job(db, 'test', kinds=['moderation_purge']))
+    status = client.get(status_url).get_json()
+    assert (status['status'], status['deleted'], status['batches']) == ('done', 5, 3)
+    assert db.messages.count_documents({}) == 1
+
+
+def test_purge_status_of_unknown_purge(client, secretary):
+    assert client.get('/secretary/moderation/purges/nope').status_code == 404
+    assert client.get('/secretary/moderation/purges/%s' % ObjectId()).status_code == 404
+
+
+def test_purge_status_does_not_need_the_api_json_provider(client, db, secretary, monkeypatch):
+    from flask.json.provider import DefaultJSONProvider
+    import app as app_module
+
+    monkeypatch.setattr(app_module.app, 'json', DefaultJSONProvider(app_module.app))
+    add_messages(db, ObjectId(), 1)
+    response = client.post('/secretary/moderation/messages', data={'author_id': str(ObjectId())})
+    status = client.get(response.get_json()['status_url']).get_json()
+    assert status['id'] == response.get_json()['purge_id']
+    assert status['status'] == 'queued'
+    assert status['at'].endswith('Z')
+    assert status['finished_at'] is None
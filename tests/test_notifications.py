@@ -0,0 +1,53 @@
+from datetime import datetime
+
+import notifications
+from notifications import CounterWatcher, stream_counts
+
+
+def touch(db, user_id, version):
+    db.user_counters.update_one(
+        {'_id': user_id},
+        {'$set': {'notices': version, 'requests': 0, 'version': version,
+                  'society_id': 'default', 'updated_at': datetime.utcnow()}},
+        upsert=True)
+
+
+def make_watcher(db):
+    # A long interval keeps the background thread out of the way; tests poll by hand
+    watcher = CounterWatcher(db, interval=3600)
+    watcher.since = datetime(2000, 1, 1)
+    return watcher
+
+
+def test_watcher_keeps_counts_only_for_subscribed_users(db):
+    watcher = make_watcher(db)
+    watcher.subscribe('alice')
+    touch(db, 'alice', 1)
+    touch(db, 'bob', 1)
+    watcher._poll()
+    assert set(watcher.counts) == {'alice'}
+    assert watcher.wait('alice', 0, timeout=0)['version'] == 1
+
+
+def test_counts_are_evicted_when_the_last_stream_closes(db):
+    watcher = make_watcher(db)
+    watcher.subscribe('alice')
+    watcher.subscribe('alice')
+    touch(db, 'alice', 1)
+    watcher._poll()
+
+    watcher.unsubscribe('alice')
+    assert 'alice' in watcher.counts
+    watcher.unsubscribe('alice')
+    assert watcher.counts == {} and watcher.subscribers == {}
+
+
+def test_disconnected_stream_unsubscribes(db, monkeypatch):
+    watcher = make_watcher(db)
+    monkeypatch.setattr(notifications, '_watcher', watcher)
+    events = stream_counts(db, 'alice', 'default')
+    assert next(events).startswith('retry:')
+    assert watcher.subscribers == {'alice': 1}
+
+    events.close()  # what the server does when the client goes away
+    assert watcher.subscribers == {}
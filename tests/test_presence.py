@@ -0,0 +1,154 @@
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+from presence import LocalPresenceStore, RedisPresenceStore
+
+
+class Broker:
+    """Stands in for a Redis server's pub/sub, delivering in process"""
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def publish(self, channel, data):
+        for pubsub in self.subscriptions:
+            if channel in pubsub.channels:
+                pubsub.messages.put({'type': 'message', 'channel': channel, 'data': data})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = BrokerPubSub()
+        self.subscriptions.append(pubsub)
+        return pubsub
+
+
+class BrokerPubSub:
+    def __init__(self):
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+
+    def get_message(self, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.channels.clear()
+
+
+@pytest.fixture
+def now():
+    return [0.0]
+
+
+@pytest.fixture
+def workers(now):
+    """Two web workers' stores sharing one broker"""
+    broker = Broker()
+    stores = [RedisPresenceStore(broker, LocalPresenceStore(50, 6, clock=lambda: now[0]))
+              for _ in range(2)]
+    yield stores
+    for store in stores:
+        store.close()
+
+
+def online(store, society_id='default'):
+    return json.loads(store.snapshot(society_id)[1])
+
+
+def changed(store, version, society_id='default'):
+    """The snapshot after the store's version moves past version"""
+    moved = store.wait(society_id, version, 5)
+    assert moved is not None
+    return json.loads(moved[1])
+
+
+def delivered(store, user_id, seen, society_id='default'):
+    """Wait for a heartbeat that changes nothing visible to reach store"""
+    deadline = time.monotonic() + 5
+    while store.local.societies[society_id]['users'][user_id]['seen'] != seen:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_workers_see_each_others_users(workers):
+    first, second = workers
+    version = second.snapshot('default')[0]
+    assert first.heartbeat('default', 'u1', 'Asha')
+    assert changed(second, version)['online'] == ['Asha']
+    assert not second.heartbeat('default', 'u1', 'Asha')  # still online
+
+    version = first.snapshot('default')[0]
+    second.heartbeat('default', 'u2', 'Ravi', typing=True)
+    state = changed(first, version)
+    assert state['online'] == ['Asha', 'Ravi']
+    assert state['typing'] == [{'id': 'u2', 'name': 'Ravi'}]
+    assert online(first, 'other')['count'] == 0
+
+    version = first.snapshot('default')[0]
+    second.leave('default', 'u1')
+    assert changed(first, version)['online'] == ['Ravi']
+
+
+def test_heartbeats_through_another_worker_keep_users_online(workers, now):
+    first, second = workers
+    version = second.snapshot('default')[0]
+    first.heartbeat('default', 'u1', 'Asha', typing=True)
+    changed(second, version)
+
+    now[0] = 30
+    first.heartbeat('default', 'u1', 'Asha')
+    delivered(second, 'u1', 30)
+    first.sweep()
+    second.sweep()
+    now[0] = 60
+    first.sweep()
+    second.sweep()
+    assert online(first)['online'] == online(second)['online'] == ['Asha']
+    assert online(second)['typing'] == []
+
+    now[0] = 200
+    first.sweep()
+    second.sweep()
+    assert online(first)['count'] == online(second)['count'] == 0
+
+
+def test_publish_failures_keep_the_local_copy(now):
+    class Down(Broker):
+        def publish(self, channel, data):
+            raise ConnectionError('redis is down')
+
+    store = RedisPresenceStore(Down(), LocalPresenceStore(50, 6, clock=lambda: now[0]))
+    try:
+        assert store.heartbeat('default', 'u1', 'Asha')
+        assert online(store)['online'] == ['Asha']
+    finally:
+        store.close()
+
+
+def test_local_store_expires_users():
+    now = [0.0]
+    store = LocalPresenceStore(50, 6, clock=lambda: now[0])
+    assert store.heartbeat('default', 'u1', 'Asha')
+    now[0] = 100
+    store.sweep()
+    assert json.loads(store.snapshot('default')[1])['count'] == 0
+
+
+def test_streams_wake_on_local_changes():
+    store = LocalPresenceStore(50, 6)
+    version = store.snapshot('default')[0]
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(store.wait('default', version, 5)))
+    waiter.start()
+    store.heartbeat('default', 'u1', 'Asha')
+    waiter.join()
+    assert json.loads(woken[0][1])['online'] == ['Asha']
+    assert store.wait('default', woken[0][0], 0.05) is None
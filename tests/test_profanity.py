@@ -0,0 +1,37 @@
+import pytest
+
+from profanity import ProfanityFilter, normalize
+
+WORDS = ['ass', 'shit', 'bastard']
+
+
+@pytest.fixture
+def profanity():
+    return ProfanityFilter(WORDS)
+
+
+@pytest.mark.parametrize('text', ['I scored 455 points', 'Flat 5417 is free',
+                                  'Call 8457 after 7', 'Pin: 455-5417'])
+def test_numbers_are_not_masked(profanity, text):
+    assert profanity.censor(text) == text
+
+
+def test_numbers_next_to_a_disguised_word(profanity):
+    assert profanity.censor('455 then 5h1t') == '455 then ****'
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('you a55', 'you ***'),
+    ('sh1t happens', '**** happens'),
+    ('B4STARD', '*******'),
+    ('ѕhit', '****'),
+    ('the class is open', 'the class is open'),
+])
+def test_disguised_words_are_masked(profanity, text, expected):
+    assert profanity.censor(text) == expected
+
+
+def test_normalize_maps_back_to_original_positions():
+    normalized, positions = normalize('Ｓh  1t')
+    assert normalized == 'sh it'
+    assert positions == [0, 1, 2, 4, 5]
@@ -0,0 +1,59 @@
+import json
+
+from flask import Flask, jsonify
+
+from config import PROFILING_SETTINGS
+from profiling import RequestProfiler
+
+PAYLOAD = json.dumps([{'title': 'Notice %d' % i, 'body': 'x' * 200} for i in range(2000)])
+
+
+def profiled_app(**settings):
+    app = Flask(__name__)
+
+    @app.route('/notices')
+    def notices():
+        notices = json.loads(PAYLOAD)  # allocates inside the json package
+        return jsonify(count=len(notices))
+
+    profiler = RequestProfiler(app, dict(PROFILING_SETTINGS, enabled=True, dump_dir=None,
+                                         **settings))
+    return app, profiler
+
+
+def test_sampled_requests_are_reported_per_endpoint():
+    app, profiler = profiled_app(sample_rate=1.0)
+    client = app.test_client()
+    for _ in range(3):
+        assert client.get('/notices').get_json() == {'count': 2000}
+
+    [row] = profiler.report()
+    assert row['endpoint'] == 'notices'
+    assert row['samples'] == 3
+    assert row['max_peak'] > len(PAYLOAD)
+    assert any('notices' in function['function'] for function in row['worst']['functions'])
+
+    profiler.reset()
+    assert profiler.report() == []
+
+
+def test_allocation_sites_point_at_project_code():
+    app, profiler = profiled_app(sample_rate=1.0)
+    app.test_client().get('/notices')
+
+    top = profiler.report()[0]['worst']['sites'][0]
+    # The list is built in json/decoder.py, on behalf of the route's line
+    assert top['where'].startswith('tests/test_profiling.py:')
+    assert top['via'].startswith('json/')
+
+
+def test_unsampled_requests_are_not_recorded():
+    app, profiler = profiled_app(sample_rate=0.0)
+    app.test_client().get('/notices')
+    assert profiler.report() == []
+
+
+def test_disabled_profiler_installs_no_hooks():
+    app = Flask(__name__)
+    RequestProfiler(app, dict(PROFILING_SETTINGS, enabled=False))
+    assert not app.before_request_funcs
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from bson.timestamp import Timestamp
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+import app as app_module
+from config import READ_PREFERENCE_SETTINGS
+from read_routing import TOKEN_KEY, ReadRouter, remember_writes, start_causal_session
+
+SECONDARY = SecondaryPreferred(max_staleness=READ_PREFERENCE_SETTINGS['max_staleness_seconds'])
+ENDPOINTS = sorted({rule.endpoint for rule in app_module.app.url_map.iter_rules()})
+
+
+def test_secondary_endpoints_exist():
+    assert READ_PREFERENCE_SETTINGS['secondary_endpoints'] <= set(ENDPOINTS)
+
+
+@pytest.mark.parametrize('endpoint', ENDPOINTS)
+def test_read_preference_per_route(db, endpoint):
+    expected = (SECONDARY if endpoint in READ_PREFERENCE_SETTINGS['secondary_endpoints']
+                else Primary())
+    assert ReadRouter(db).database(endpoint).read_preference == expected
+
+
+@pytest.mark.parametrize('endpoint', ['login', 'register', 'api.create_token', 'profile'])
+def test_authentication_reads_primary(db, endpoint):
+    assert ReadRouter(db).database(endpoint).read_preference == Primary()
+
+
+def test_everything_reads_primary_when_disabled(db):
+    router = ReadRouter(db, dict(READ_PREFERENCE_SETTINGS, enabled=False))
+    for endpoint in READ_PREFERENCE_SETTINGS['secondary_endpoints']:
+        assert router.database(endpoint).read_preference == Primary()
+
+
+def test_secondary_reads_fall_back_to_primary(db):
+    # With no secondary within the staleness bound, the driver reads the primary
+    assert ReadRouter(db).secondary.read_preference.mode == SecondaryPreferred().mode
+
+
+def test_causal_token_round_trip(client):
+    flask_session = {}
+    writer = app_module.mongo.cx.start_session()
+    remember_writes(writer, flask_session)
+    assert TOKEN_KEY in flask_session
+
+    reader = start_causal_session(app_module.mongo.cx, flask_session)
+    assert reader.advanced_to == writer.operation_time
+    assert reader.cluster_time == writer.cluster_time
+
+
+def test_reads_wait_for_the_users_own_write(client, db, resident, monkeypatch):
+    routed = []
+    database = app_module.read_router.database
+    monkeypatch.setattr(app_module.read_router, 'database',
+                        lambda endpoint: routed.append(endpoint) or database(endpoint))
+
+    client.post('/chat', data={'message': 'Water is back'})
+    write = app_module.mongo.cx.sessions[-1]
+    with client.session_transaction() as flask_session:
+        assert TOKEN_KEY in flask_session
+
+    response = client.get('/chat')
+    assert b'Water is back' in response.data
+    assert routed[-1] == 'chat'
+    # The secondary read resumed from the write's causal position
+    assert app_module.mongo.cx.sessions[-1].advanced_to == write.operation_time
+
+
+def test_reads_without_writes_leave_no_token(client, resident):
+    assert client.get('/notices').status_code == 200
+    with client.session_transaction() as flask_session:
+        assert TOKEN_KEY not in flask_session
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_REPLICA_SET_URI'),
+                    reason='set TEST_REPLICA_SET_URI to a replica set to run')
+def test_read_your_writes_on_replica_set():
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ['TEST_REPLICA_SET_URI'])
+    db = client.get_database('read_routing_test')
+    router = ReadRouter(db)
+    flask_session = {}
+    try:
+        with client.start_session(causal_consistency=True) as write:
+            db.messages.insert_one({'content': 'hello'}, session=write)
+            remember_writes(write, flask_session)
+        read = start_causal_session(client, flask_session)
+        try:
+            found = router.database('chat').messages.find_one({'content': 'hello'}, session=read)
+        finally:
+            read.end_session()
+        assert found is not None
+        assert isinstance(read.operation_time, Timestamp)
+        # The read had secondaries to go to, so the wait for the write mattered
+        assert len(client.secondaries) == 2
+    finally:
+        client.drop_database('read_routing_test')
@@ -0,0 +1,79 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+import rendering
+from rendering import (RENDER_VERSION, ensure_rendered, format_datetime, render_message,
+                       render_notice)
+
+POSTED = datetime(2026, 3, 5, 9, 30)  # naive UTC, as stored
+
+
+def test_message_html_is_escaped():
+    rendered = render_message({'content': '<script>alert(1)</script>\nbye & "thanks"',
+                               'created_at': POSTED})
+    assert rendered['html'] == ('&lt;script&gt;alert(1)&lt;/script&gt;<br>'
+                                'bye &amp; &#34;thanks&#34;')
+    assert rendered['v'] == RENDER_VERSION
+
+
+def test_stale_versions_are_rendered_again_and_stored(db):
+    stale = {'content': '<b>hi</b>', 'created_at': POSTED,
+             'rendered': {'v': RENDER_VERSION - 1, 'html': '<b>hi</b>', 'time': '03:30 PM'}}
+    current = {'content': 'kept', 'created_at': POSTED,
+               'rendered': {'v': RENDER_VERSION, 'html': 'as stored', 'time': '09:30 AM'}}
+    missing = {'content': 'old', 'created_at': POSTED}
+    db.messages.insert_many([stale, current, missing])
+
+    docs = list(db.messages.find().sort('_id', 1))
+    ensure_rendered(db.messages, docs, render_message)
+    assert [doc['rendered']['html'] for doc in docs] == ['&lt;b&gt;hi&lt;/b&gt;', 'as stored', 'old']
+    stored = {doc['content']: doc['rendered'] for doc in db.messages.find()}
+    assert stored['<b>hi</b>'] == {'v': RENDER_VERSION, 'html': '&lt;b&gt;hi&lt;/b&gt;',
+                                   'time': '09:30 AM'}
+    assert stored['kept']['html'] == 'as stored'
+
+
+@pytest.fixture
+def server_in_new_york():
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/New_York'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def test_times_do_not_depend_on_the_server_timezone(server_in_new_york):
+    assert format_datetime(POSTED) == 'March 05, 2026 at 09:30 AM'
+    assert render_notice({'content': '', 'created_at': POSTED})['posted_at'] == \
+        'March 05, 2026 at 09:30 AM'
+
+
+def test_times_use_the_configured_timezone(monkeypatch):
+    monkeypatch.setitem(rendering.RENDER_SETTINGS, 'timezone', 'Asia/Kolkata')
+    assert render_message({'content': '', 'created_at': POSTED})['time'] == '03:00 PM'
+
+
+def test_chat_stores_and_serves_escaped_html(client, db, resident):
+    client.post('/chat', data={'message': '<img src=x onerror=alert(1)>'})
+    message = db.messages.find_one()
+    assert message['rendered']['html'] == '&lt;img src=x onerror=alert(1)&gt;'
+    page = client.get('/chat').get_data(as_text=True)
+    assert '<img src=x' not in page
+    assert '&lt;img src=x onerror=alert(1)&gt;' in page
+
+
+def test_service_request_description_is_escaped(client, db, resident):
+    client.post('/service_requests', data={
+        'title': '<i>Leak</i>', 'description': '<script>alert(1)</script>',
+        'category': 'plumbing', 'priority': 'high'})
+    page = client.get('/service_requests').get_data(as_text=True)
+    assert '<script>alert(1)</script>' not in page
+    assert '&lt;script&gt;alert(1)&lt;/script&gt;' in page
+    assert '<i>Leak</i>' not in page
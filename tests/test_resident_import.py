@@ -0,0 +1,77 @@
+import re
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import resident_import
+from jobs import claim_job, run_job
+from resident_import import import_batch
+
+
+def run_jobs(db):
+    while True:
+        job = claim_job(db, 'test')
+        if not job:
+            break
+        run_job(db, job)
+
+
+def import_rows(db, monkeypatch, *rows):
+    monkeypatch.setattr(resident_import, 'hash_passwords',
+                        lambda passwords: [generate_password_hash(p) for p in passwords])
+    record = {'_id': 'import-1', 'society_id': 'default'}
+    return import_batch(db, record, list(enumerate(rows, start=2)), set())
+
+
+def test_rows_without_password_get_a_set_password_link(client, db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(resident_import, 'send_batch',
+                        lambda messages, settings=None: sent.extend(messages) or [])
+    inserted, errors = import_rows(
+        db, monkeypatch,
+        {'name': 'Ravi', 'email': 'ravi@example.com', 'apartment': 'A-101', 'password': ''},
+        {'name': 'Mina', 'email': 'mina@example.com', 'apartment': 'A-102',
+         'password': 'Own1pass'})
+    assert (inserted, errors) == (2, [])
+
+    ravi = db.users.find_one({'email': 'ravi@example.com'})
+    assert 'password_setup' in ravi
+    assert not check_password_hash(ravi['password'], '')
+    assert 'password_setup' not in db.users.find_one({'email': 'mina@example.com'})
+
+    run_jobs(db)
+    assert [message['To'] for message in sent] == ['ravi@example.com']
+    link = re.search(r'/set_password/\S+', sent[0].get_content()).group(0)
+
+    response = client.post(link, data={'password': 'Chosen1pw', 'confirm_password': 'Chosen1pw'})
+    assert response.status_code == 302
+    ravi = db.users.find_one({'_id': ravi['_id']})
+    assert check_password_hash(ravi['password'], 'Chosen1pw')
+    assert 'password_setup' not in ravi
+
+    # The link works once
+    client.post(link, data={'password': 'Other1pw', 'confirm_password': 'Other1pw'})
+    assert check_password_hash(db.users.find_one({'_id': ravi['_id']})['password'], 'Chosen1pw')
+
+
+def test_set_password_rejects_bad_links(client, db):
+    assert client.get('/set_password/nonsense/token').status_code == 302
+    user_id = db.users.insert_one({'email': 'x@example.com', 'password_setup': {}}).inserted_id
+    assert client.get('/set_password/%s/guess' % user_id).status_code == 302
+
+
+def test_secretary_can_resend_the_link(client, db, secretary):
+    user_id = db.users.insert_one({
+        'name': 'Ravi', 'email': 'ravi@example.com', 'apartment': 'A-101',
+        'society_id': 'default', 'is_secretary': False,
+        'password_setup': {'requested_at': None}}).inserted_id
+    assert b'Resend Link' in client.get('/secretary/users').data
+
+    client.post('/secretary/users/%s/password_link' % user_id)
+    assert db.jobs.find_one({'kind': 'password_link_batch'})['payload'] == {
+        'user_ids': [str(user_id)]}
+
+
+def test_import_status_of_a_malformed_id_is_not_found(client, secretary):
+    response = client.get('/secretary/import_residents/not-an-id/status')
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'Import not found'}
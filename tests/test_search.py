@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import search
+from search import index_document, rebuild_index, remove_document
+
+
+def add_message(db, content, society_id='default', minutes_ago=0):
+    message = {'society_id': society_id, 'content': content,
+               'created_at': datetime.utcnow() - timedelta(minutes=minutes_ago)}
+    message['_id'] = db.messages.insert_one(message).inserted_id
+    index_document(db, society_id, 'message', message, content)
+    return message
+
+
+def test_ranks_by_bm25(db):
+    add_message(db, 'water tank cleaning on sunday')
+    best = add_message(db, 'water water water')
+    add_message(db, 'lift repair')
+
+    hits, total = search.search(db, 'default', 'water')
+    assert total == 2
+    assert hits[0]['doc_id'] == best['_id']
+
+
+def test_reads_only_top_postings_per_term(db, monkeypatch):
+    monkeypatch.setitem(search.SEARCH_SETTINGS, 'max_postings_per_term', 3)
+    for minutes in range(10):
+        add_message(db, 'parking notice and some other words here', minutes_ago=minutes)
+    strong = add_message(db, 'parking parking')
+
+    hits, total = search.search(db, 'default', 'parking')
+    assert total == 3
+    assert hits[0]['doc_id'] == strong['_id']
+
+
+def test_rebuild_matches_incremental_index(db):
+    kept = add_message(db, 'generator test at noon')
+    removed = add_message(db, 'generator noise complaint')
+    remove_document(db, 'default', 'message', removed['_id'])
+    db.messages.delete_one({'_id': removed['_id']})
+    incremental = search.search(db, 'default', 'generator')
+
+    rebuild_index(db)
+    assert search.search(db, 'default', 'generator')[0][0]['doc_id'] == kept['_id']
+    assert search.search(db, 'default', 'generator')[1] == incremental[1] == 1
+    assert db.search_postings.find_one({'doc_id': kept['_id']})['impact'] > 0
+
+
+def test_rebuild_keeps_writes_made_while_it_ran(db, monkeypatch):
+    started = datetime.utcnow()
+    deleted = add_message(db, 'garbage pickup moved', minutes_ago=10)
+    kept = add_message(db, 'garbage chute blocked', minutes_ago=5)
+
+    class Clock(datetime):
+        times = iter([started, started + timedelta(minutes=30)])
+
+        @classmethod
+        def utcnow(cls):
+            return next(cls.times)
+
+    monkeypatch.setattr(search, 'datetime', Clock)
+    # Written to the old index after the rebuild's scan started
+    added = add_message(db, 'garbage bins replaced', minutes_ago=-10)
+    db.messages.delete_one({'_id': deleted['_id']})
+    db.deletions.insert_one({'society_id': 'default', 'kind': 'messages',
+                             'doc_id': deleted['_id'], 'at': started + timedelta(minutes=1)})
+
+    rebuild_index(db)
+    hits, total = search.search(db, 'default', 'garbage')
+    assert total == 2
+    assert {hit['doc_id'] for hit in hits} == {kept['_id'], added['_id']}
+    assert db.search_stats.find_one({'_id': 'default'})['docs'] == 2
+    assert 'search_postings_rebuild' not in db.list_collection_names()
+
+
+def test_removal_is_scoped_to_the_society(db):
+    message = add_message(db, 'lift inspection', society_id='north')
+    # The same document id indexed under another society is left alone
+    index_document(db, 'south', 'message', message, 'lift inspection')
+    remove_document(db, 'north', 'message', message['_id'])
+    assert search.search(db, 'north', 'lift')[1] == 0
+    assert search.search(db, 'south', 'lift')[1] == 1
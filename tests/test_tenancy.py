@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from models import create_indexes
+from tenancy import (build_email_directory, claim_email, claim_emails, create_society,
+                     find_user_by_email, invite_code, rotate_invite_code, society_for_invite)
+
+
+def test_email_is_unique_across_societies(db):
+    create_indexes(db)
+    first, second = ObjectId(), ObjectId()
+    assert claim_email(db, 'asha@example.com', 'north', first)
+    assert not claim_email(db, 'asha@example.com', 'south', second)
+
+    # The users index itself only covers one society, so it stays shardable
+    db.users.insert_one({'_id': first, 'society_id': 'north', 'email': 'asha@example.com'})
+    db.users.insert_one({'_id': second, 'society_id': 'south', 'email': 'asha@example.com'})
+    assert find_user_by_email(db, 'asha@example.com')['_id'] == first
+
+
+def test_accounts_are_found_only_through_the_directory(db):
+    db.users.insert_one({'society_id': 'default', 'email': 'old@example.com', 'name': 'Old'})
+    # No unscoped users lookup for accounts the migration has not listed yet
+    assert find_user_by_email(db, 'old@example.com') is None
+
+    assert build_email_directory(db) == 1
+    assert find_user_by_email(db, 'old@example.com', {'name': 1})['name'] == 'Old'
+    assert find_user_by_email(db, 'nobody@example.com') is None
+
+
+def test_claim_emails_takes_over_abandoned_claims(db):
+    stale = datetime.utcnow() - timedelta(minutes=5)
+    db.users.insert_one({'_id': ObjectId(), 'society_id': 'north', 'email': 'kept@example.com'})
+    db.user_emails.insert_many([
+        {'_id': 'kept@example.com', 'society_id': 'north',
+         'user_id': db.users.find_one()['_id'], 'claimed_at': stale},
+        # The importer died after claiming but before writing the user
+        {'_id': 'orphan@example.com', 'society_id': 'north', 'user_id': ObjectId(),
+         'claimed_at': stale},
+        {'_id': 'recent@example.com', 'society_id': 'north', 'user_id': ObjectId(),
+         'claimed_at': datetime.utcnow()}])
+
+    new_id = ObjectId()
+    taken = claim_emails(db, 'south', [('kept@example.com', ObjectId()),
+                                       ('orphan@example.com', new_id),
+                                       ('recent@example.com', ObjectId()),
+                                       ('fresh@example.com', ObjectId())])
+    assert taken == {'kept@example.com', 'recent@example.com'}
+    assert db.user_emails.find_one({'_id': 'orphan@example.com'})['user_id'] == new_id
+    assert db.user_emails.find_one({'_id': 'fresh@example.com'})['society_id'] == 'south'
+
+
+def test_invite_codes(db):
+    create_indexes(db)
+    code = invite_code(db, 'north')
+    assert invite_code(db, 'north') == code
+    assert society_for_invite(db, ' %s ' % code.lower()) == 'north'
+
+    new_code = rotate_invite_code(db, 'north')
+    assert new_code != code
+    assert society_for_invite(db, code) is None
+    assert society_for_invite(db, new_code) == 'north'
+    assert society_for_invite(db, '') is None
+
+
+def test_create_society(db):
+    create_indexes(db)
+    code = create_society(db, 'greenwood', 'sec@greenwood.example', 'S3cret!pass')
+    secretary = find_user_by_email(db, 'sec@greenwood.example')
+    assert secretary['society_id'] == 'greenwood' and secretary['is_secretary']
+    assert society_for_invite(db, code) == 'greenwood'
+
+
+def register(client, **fields):
+    form = {'name': 'Asha', 'email': 'asha@example.com', 'apartment': 'B-2',
+            'password': 'Str0ng!pass', 'confirm_password': 'Str0ng!pass'}
+    form.update(fields)
+    return client.post('/register', data=form)
+
+
+def test_register_requires_invite_code(client, db):
+    create_indexes(db)
+    assert b'Please enter the invite code' in register(client).data
+    assert b'That invite code is not valid' in register(client, invite_code='NOPE').data
+    assert db.users.count_documents({}) == 0
+
+    code = invite_code(db, 'north')
+    assert register(client, invite_code=code).status_code == 302
+    assert find_user_by_email(db, 'asha@example.com')['society_id'] == 'north'
+    assert b'Email already registered' in register(client, invite_code=code).data
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from jobs import claim_job, run_job
+from models import create_indexes
+from triage import queue, refresh_scores, schedule_refresh, triage_score
+
+NOW = datetime(2026, 3, 5, 9, 0)
+
+
+def add_request(db, **fields):
+    request_doc = dict({'society_id': 'default', 'user_id': ObjectId(), 'title': 'Leak',
+                        'category': 'plumbing', 'priority': 'urgent', 'status': 'pending',
+                        'triage_score': 10, 'created_at': datetime.utcnow()}, **fields)
+    return db.service_requests.insert_one(request_doc).inserted_id
+
+
+def test_claim_by_id(client, db, secretary):
+    request_id = add_request(db)
+    response = client.post('/secretary/queue/claim', data={'request_id': str(request_id)})
+    assert response.status_code == 200
+    assert db.service_requests.find_one({'_id': request_id})['status'] == 'in_progress'
+
+    response = client.post('/secretary/queue/claim', data={'request_id': str(request_id)})
+    assert response.status_code == 409
+
+
+def test_claim_with_malformed_ids(client, db, secretary):
+    add_request(db)
+    response = client.post('/secretary/queue/claim', data={'request_id': 'not-an-id'})
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'Request not found'}
+
+    response = client.post('/secretary/queue/claim', data={'assignee_id': 'nope'})
+    assert response.status_code == 400
+    assert db.service_requests.count_documents({'status': 'pending'}) == 1
+
+
+@pytest.mark.parametrize('fields, score', [
+    ({'priority': 'urgent'}, 1000),
+    ({'priority': 'low', 'created_at': NOW - timedelta(hours=10)}, 30 + 20),
+    ({'priority': 'unknown'}, 100),  # scored as medium
+    ({'priority': 'high', 'created_at': NOW - timedelta(days=60)}, 300 + 14 * 24 * 2),
+    ({'priority': 'urgent', 'status': 'in_progress'}, 0),
+    ({'priority': 'urgent', 'status': 'resolved'}, 0),
+])
+def test_triage_score(fields, score):
+    request_doc = dict({'status': 'pending', 'created_at': NOW}, **fields)
+    assert triage_score(request_doc, now=NOW) == score
+
+
+def test_queue_lists_pending_requests_best_first(db):
+    low = add_request(db, triage_score=30)
+    top = add_request(db, triage_score=1000)
+    middle = add_request(db, triage_score=300)
+    add_request(db, triage_score=5000, status='in_progress')
+    add_request(db, triage_score=5000, society_id='north')
+
+    assert [r['_id'] for r in queue(db, 'default')] == [top, middle, low]
+    assert [r['_id'] for r in queue(db, 'default', limit=2)] == [top, middle]
+
+
+def test_claim_without_id_takes_the_top_of_the_queue(client, db, secretary):
+    add_request(db, triage_score=30)
+    top = add_request(db, triage_score=1000)
+    response = client.post('/secretary/queue/claim')
+    assert response.status_code == 200
+    claimed = db.service_requests.find_one({'_id': top})
+    assert claimed['status'] == 'in_progress'
+    assert claimed['assigned_to'] == secretary['_id']
+    assert claimed['triage_score'] == 0
+
+
+def test_refresh_re_ages_pending_requests(db):
+    aged = add_request(db, priority='high', created_at=NOW - timedelta(hours=5), triage_score=300)
+    current = add_request(db, priority='low', created_at=NOW, triage_score=30)
+    claimed = add_request(db, status='in_progress', created_at=NOW - timedelta(hours=5),
+                          triage_score=0)
+
+    assert refresh_scores(db, now=NOW) == 1
+    assert db.service_requests.find_one({'_id': aged})['triage_score'] == 310
+    assert db.service_requests.find_one({'_id': aged})['triage_scored_at'] == NOW
+    assert db.service_requests.find_one({'_id': current})['triage_score'] == 30
+    assert db.service_requests.find_one({'_id': claimed})['triage_score'] == 0
+
+
+def test_schedule_refresh_queues_one_job_per_slot(db):
+    create_indexes(db)  # the unique dedupe_key index
+    assert schedule_refresh(db, now=NOW + timedelta(minutes=3)) is not None
+    # Another worker in the same 15 minute slot
+    assert schedule_refresh(db, now=NOW + timedelta(minutes=11)) is None
+    [job] = db.jobs.find({'kind': 'triage_refresh'})
+    assert job['run_at'] == NOW + timedelta(minutes=15)
+
+    assert schedule_refresh(db, now=NOW + timedelta(minutes=16)) is not None
+    assert db.jobs.count_documents({'kind': 'triage_refresh'}) == 2
+
+
+def test_refresh_job_schedules_the_next_one(db):
+    add_request(db, priority='low', created_at=datetime.utcnow() - timedelta(hours=2),
+                triage_score=30)
+    db.jobs.insert_one({'kind': 'triage_refresh', 'payload': {}, 'status': 'queued',
+                        'run_at': datetime.utcnow(), 'attempts': 0, 'max_attempts': 5})
+    assert run_job(db, claim_job(db, 'test', kinds=['triage_refresh']))
+    assert db.service_requests.find_one()['triage_score'] == pytest.approx(34, abs=0.1)
+    assert db.jobs.count_documents({'kind': 'triage_refresh', 'status': 'queued'}) == 1
@@ -0,0 +1,148 @@
+"""Triage score and claim queue for service requests.
+
+Each request carries a persisted ``triage_score``:
+    priority weight + age bonus (points per hour, capped)
+Only pending requests are queued, so requests in any other status score 0.
+The score is set when a request is created or changes status, and the
+'triage_refresh' job re-ages pending requests every refresh_minutes. The (society_id, status, triage_score) index lets the
+queue read the top pending requests with one range scan, and claiming uses
+find_one_and_update on status 'pending' so two secretaries never get the
+same request.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+
+from config import TRIAGE_SETTINGS
+from jobs import job_handler, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+QUEUE_PROJECTION = {'title': 1, 'category': 1, 'priority': 1, 'status': 1,
+                    'user_name': 1, 'apartment': 1, 'created_at': 1,
+                    'triage_score': 1, 'assigned_to': 1, 'assigned_name': 1}
+
+
+def triage_score(request_doc, status=None, now=None):
+    """Score of a request; higher means it should be handled sooner"""
+    if (status or request_doc.get('status')) != 'pending':
+        return 0
+    now = now or datetime.utcnow()
+    weight = TRIAGE_SETTINGS['priority_weights'].get(
+        request_doc.get('priority'), TRIAGE_SETTINGS['priority_weights']['medium'])
+    age_hours = 0
+    if request_doc.get('created_at'):
+        age_hours = max((now - request_doc['created_at']).total_seconds() / 3600, 0)
+    age_hours = min(age_hours, TRIAGE_SETTINGS['max_age_hours'])
+    return round(weight + age_hours * TRIAGE_SETTINGS['age_points_per_hour'], 2)
+
+
+def rescore(db, request_doc, status, now=None, session=None):
+    """Store the score of a request after it moved to status"""
+    now = now or datetime.utcnow()
+    db.service_requests.update_one(
+        {'_id': request_doc['_id']},
+        {'$set': {'triage_score': triage_score(request_doc, status, now),
+                  'triage_scored_at': now}},
+        session=session)
+
+
+def queue(db, society_id, limit=None, session=None):
+    """Top pending requests of a society, best score first"""
+    limit = min(limit or TRIAGE_SETTINGS['queue_size'], TRIAGE_SETTINGS['max_queue_size'])
+    return list(db.service_requests.find(
+        {'society_id': society_id, 'status': 'pending'},
+        QUEUE_PROJECTION, session=session
+    ).sort('triage_score', -1).limit(limit))
+
+
+def queue_item(request_doc):
+    """JSON-ready form of a queue entry"""
+    return {
+        'id': str(request_doc['_id']),
+        'title': request_doc.get('title'),
+        'category': request_doc.get('category'),
+        'priority': request_doc.get('priority'),
+        'status': request_doc.get('status'),
+        'resident': request_doc.get('user_name'),
+        'apartment': request_doc.get('apartment'),
+        'created_at': request_doc['created_at'].isoformat() + 'Z'
+        if request_doc.get('created_at') else None,
+        'score': request_doc.get('triage_score', 0),
+        'assigned_to': str(request_doc['assigned_to']) if request_doc.get('assigned_to') else None,
+        'assigned_name': request_doc.get('assigned_name')
+    }
+
+
+def claim(db, society_id, assignee, request_id=None, session=None):
+    """Assign a pending request to assignee and move it to in_progress.
+
+    Without request_id the top of the queue is taken. Returns the request as
+    it was before the claim (for rollups and notifications), or None if it
+    was not pending any more - someone else claimed or closed it first.
+    """
+    query = {'society_id': society_id, 'status': 'pending'}
+    if request_id is not None:
+        query['_id'] = request_id
+    now = datetime.utcnow()
+    previous = db.service_requests.find_one_and_update(
+        query,
+        {'$set': {'status': 'in_progress', 'status_changed_at': now,
+                  'assigned_to': assignee['_id'], 'assigned_name': assignee['name'],
+                  'assigned_at': now},
+         '$push': {'status_history': {'status': 'in_progress', 'at': now}}},
+        sort=[('triage_score', -1)],
+        projection=dict(QUEUE_PROJECTION, user_id=1, society_id=1),
+        return_document=ReturnDocument.BEFORE,
+        session=session)
+    if previous:
+        rescore(db, previous, 'in_progress', now, session=session)
+    return previous
+
+
+def refresh_scores(db, batch_size=500, now=None):
+    """Re-age the scores of all pending requests; returns how many changed"""
+    now = now or datetime.utcnow()
+    cursor = db.service_requests.find(
+        {'status': 'pending'},
+        {'status': 1, 'priority': 1, 'created_at': 1, 'triage_score': 1}
+    ).batch_size(batch_size)
+    updates = []
+    changed = 0
+    for request_doc in cursor:
+        score = triage_score(request_doc, now=now)
+        if score == request_doc.get('triage_score'):
+            continue
+        updates.append(UpdateOne(
+            {'_id': request_doc['_id'], 'status': request_doc['status']},
+            {'$set': {'triage_score': score, 'triage_scored_at': now}}))
+        if len(updates) >= batch_size:
+            changed += db.service_requests.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        changed += db.service_requests.bulk_write(updates, ordered=False).modified_count
+    return changed
+
+
+def schedule_refresh(db, now=None):
+    """Queue the refresh for the next time slot. Slots are aligned to
+    refresh_minutes and the dedupe key names the slot, so however many
+    workers call this there is one job per slot."""
+    interval = TRIAGE_SETTINGS['refresh_minutes'] * 60
+    elapsed = ((now or datetime.utcnow()) - EPOCH).total_seconds()
+    slot = int(elapsed // interval) + 1
+    return enqueue_job(db, 'triage_refresh', {},
+                       run_at=EPOCH + timedelta(seconds=slot * interval),
+                       dedupe_key='triage_refresh:%d' % slot)
+
+
+# Job handlers
+
+
+@job_handler('triage_refresh')
+def run_triage_refresh(db, job):
+    changed = refresh_scores(db)
+    logger.info('Triage refresh updated %d request(s)', changed)
+    schedule_refresh(db)
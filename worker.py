@@ -0,0 +1,41 @@
+"""Background worker: python worker.py
+
+Runs queued jobs (notice email fan-out, attachment thumbnails, resident imports, chat purges, ...) outside the web process.
+"""
+import logging
+import os
+
+from pymongo import MongoClient
+
+from config import DATABASE_SETTINGS
+from jobs import run_worker
+from models import create_indexes
+import mailer  # noqa: F401 - registers email job handlers
+import attachments  # noqa: F401 - registers thumbnail job handler
+import resident_import  # noqa: F401 - registers CSV import job handler
+import moderation  # noqa: F401 - registers chat purge job handler
+from triage import refresh_scores, schedule_refresh
+
+
+def get_database():
+    uri = os.environ.get(
+        'MONGO_URI') or 'mongodb://localhost:27017/hyperlocal_community'
+    client = MongoClient(
+        uri,
+        maxPoolSize=DATABASE_SETTINGS['max_pool_size'],
+        minPoolSize=DATABASE_SETTINGS['min_pool_size'],
+        maxIdleTimeMS=DATABASE_SETTINGS['max_idle_time_ms'],
+        serverSelectionTimeoutMS=DATABASE_SETTINGS['server_selection_timeout_ms'],
+        connectTimeoutMS=DATABASE_SETTINGS['connect_timeout_ms'],
+        socketTimeoutMS=DATABASE_SETTINGS['socket_timeout_ms'])
+    return client.get_default_database()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    db = get_database()
+    create_indexes(db)
+    refresh_scores(db)
+    schedule_refresh(db)
+    run_worker(db)